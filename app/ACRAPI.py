@@ -1,6 +1,12 @@
 from acrcloud.recognizer import ACRCloudRecognizer
 from acrcloud.recognizer import ACRCloudRecognizeType
 from SongIDCore import *
+from SongIDBuffer import readSource
+import SongIDPreprocess
+from SongIDPool import ClientPool
+from SongIDLazy import LazyModule
+from SongIDShazam import ShazamClients
+shazamio = LazyModule('shazamio')  # Optional, only needed when a recognition policy includes 'shazam' (imported on first use)
 
 
 
@@ -35,6 +41,53 @@ config = {
 logger.info('Loaded: ACR Config')
 
 
+# Create the recogniser pools once at startup and borrow from them for every request
+pools = {
+    project: ClientPool(
+        lambda project=project: ACRCloudRecognizer(config[project]),
+        size=int(env['pool']['size']),
+        idleTimeout=float(env['pool']['idle_timeout']),
+        name=f'acr-{project}'
+    )
+    for project in ('noisy', 'hum')
+}
+logger.info('Loaded: ACR Pools')
+
+
+# Shazam clients live on one event loop thread for the whole process, so connections are kept alive between files
+shazamClients = ShazamClients(
+    shazamio,
+    size=int(env['shazam']['pool_size']),
+    idleTimeout=float(env['pool']['idle_timeout']),
+    apiUrl=env['shazam']['api_url'] or None,
+    timeout=float(env['hedge']['timeout'])
+)
+
+
+# Reshape a Shazam response into the ACRCloud format dataProcess reads
+def shazamToACR(recognized):
+    if not recognized or 'track' not in recognized:
+        return {'status': {'code': 1001, 'msg': 'No result'}}
+    track = recognized['track']
+    music = {'title': track.get('title', 'Unknown'), 'artists': [{'name': track.get('subtitle', 'Unknown')}], 'score': 100, 'external_metadata': {}}
+    for section in track.get('sections', []):
+        for meta in section.get('metadata', []):
+            if meta.get('title') == 'Album':
+                music['album'] = {'name': meta.get('text')}
+            elif meta.get('title') == 'Released':
+                music['release_date'] = meta.get('text')
+    return {'status': {'code': 0, 'msg': 'Success'}, 'metadata': {'music': [music]}}
+
+
+# Decode just the window ACRCloud is going to fingerprint (as small mono WAV) before handing it over.
+# source is the downloaded file itself (bytes) or the path it was spilled to; ffmpeg reads a path directly,
+# so a spilled file is only read back into memory when preprocessing is off (or ffmpeg couldn't decode it).
+def preprocess(source, start, duration):
+    if env['preprocess']['enabled'] != '1':
+        return readSource(source)
+    return readSource(SongIDPreprocess.prepare(source, start, duration, int(env['preprocess']['sample_rate']), workspaces=workspaces))
+
+
 # Functions for sending files to the ACRCloud API and getting a response
 # These functions were pre-made on the ACRCloud GitHub: https://github.com/acrcloud/acrcloud_sdk_python/blob/master/windows/win64/python3/test.py
 class ACRAPI():
@@ -44,21 +97,22 @@ class ACRAPI():
 
 
 
-    def noisy(filePath):
+    def noisy(source):
 
         '''This module can recognize ACRCloud by most of audio/video file.
             Audio: mp3, wav, m4a, flac, aac, amr, ape, ogg ...
-            Video: mp4, mkv, wmv, flv, ts, avi ...'''
+            Video: mp4, mkv, wmv, flv, ts, avi ...
+            source: the file contents (bytes) or a path to the file'''
         re_config = config['noisy']
-        re = ACRCloudRecognizer(re_config)
 
         #recognize by file path, and skip 0 seconds from from the beginning of sys.argv[1].
         #re.recognize_by_file(filePath, 0, 10)
         logger.info('ACR: Processing Noisy request...')
         logger.debug(re_config)
-        buf = open(filePath, 'rb').read()
+        buf = preprocess(source, 0, 60)
         #recognize by file_audio_buffer that read from file path, and skip 0 seconds from from the beginning of sys.argv[1].
-        data = re.recognize_by_filebuffer(buf, 0, 60)
+        with pools['noisy'].borrow() as re:
+            data = re.recognize_by_filebuffer(buf, 0, 60)
         data = json.loads(data)
         logger.debug(data)
         logger.info('ACR: Processing complete!')
@@ -67,21 +121,35 @@ class ACRAPI():
 
 
 
-    def hum(filePath):
+    def shazam(source):
+        '''Recognise the file with Shazam (no API key or daily limit).
+            source: the file contents (bytes) or a path to the file'''
+        logger.info('Shazam: Processing request...')
+        buf = preprocess(source, 0, 60)
+        # Runs on a hedge worker thread, the request itself runs on the Shazam clients' event loop
+        data = shazamToACR(shazamClients.recognise(buf, timeout=float(env['hedge']['timeout'])))
+        logger.info('Shazam: Processing complete!')
+        return data
+
+
+
+
+    def hum(source):
 
         '''This module can recognize ACRCloud by most of audio/video file.
             Audio: mp3, wav, m4a, flac, aac, amr, ape, ogg ...
-            Video: mp4, mkv, wmv, flv, ts, avi ...'''
+            Video: mp4, mkv, wmv, flv, ts, avi ...
+            source: the file contents (bytes) or a path to the file'''
         re_config = config['hum']
-        re = ACRCloudRecognizer(re_config)
 
         #recognize by file path, and skip 0 seconds from from the beginning of sys.argv[1].
         #re.recognize_by_file(filePath, 0, 10)
         logger.info('ACR: Processing Hum request...')
         logger.debug(re_config)
-        buf = open(filePath, 'rb').read()
+        buf = preprocess(source, 0, 10)
         #recognize by file_audio_buffer that read from file path, and skip 0 seconds from from the beginning of sys.argv[1].
-        data = re.recognize_by_filebuffer(buf, 0, 10)
+        with pools['hum'].borrow() as re:
+            data = re.recognize_by_filebuffer(buf, 0, 10)
         data = json.loads(data)
         logger.debug(data)
         logger.info('ACR: Processing complete!')
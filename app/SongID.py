@@ -1,27 +1,23 @@
 print('        _ _  ---====  SongID  ====---  _ _\n')
 
 
-from SongIDProcessor import SIDProcessor
+from SongIDProcessor import SIDProcessor, hedger
 from SongIDCore import *
+from ACRAPI import pools as acrPools, shazamClients
+from SongIDWorkers import ChatWorkerPool
+from SongIDHealth import HealthChecks, urlCheck
 from telegram import ParseMode
 from telegram.utils.helpers import mention_html
-import sys, traceback
+import secrets, sys, traceback
 from threading import Thread
-import urllib.request  # Check for internet connectivity
 
 
-while True:
-    try:
-        ACR_PING_CODE = urllib.request.urlopen("https://identify-eu-west-1.acrcloud.com").getcode()
-        if ACR_PING_CODE == 200:
-            logger.info('ACR Cloud pinged successfully!')
-            break
-        else:
-            logger.warning('ACR Cloud ping error code: '+str(ACR_PING_CODE)+', retrying in 20 seconds')
-            time.sleep(20)
-    except:
-        logger.warning('Unable to ping ACR Cloud, retrying in 10 seconds')
-        time.sleep(10)
+# Check ACR Cloud and Telegram can be reached in the background (each on its own thread), instead of
+# waiting for them before handling any updates. Their state is logged, shown in /stats and served at /ready.
+health = HealthChecks({
+    'acrcloud': urlCheck(env['acr_ping_url']),
+    'telegram': lambda: u.bot.get_me(timeout=10)
+}, interval=float(env['health']['interval']), retry=float(env['health']['retry']))
 
 
 
@@ -62,7 +58,7 @@ def error(update, context):
     else:
         if update != None:
             text = "⚠️ An error occured, sorry for any inconvenience caused.\nThe developer has been notified and will look into this issue as soon as possible."
-            update.effective_message.reply_text(text)
+            outbox.send(update.effective_chat.id, update.effective_message.reply_text, text)
         # This traceback is created with accessing the traceback object from the sys.exc_info, which is returned as the
         # third value of the returned tuple. Then we use the traceback.format_tb to get the traceback as a string, which
         # for a weird reason separates the line breaks in a list, but keeps the linebreaks itself. So just joining an
@@ -84,8 +80,8 @@ def error(update, context):
         # lets put this in a "well" formatted text
         text = f"⚠️ Uncaught error\n\nThe error <code>{context.error}</code> occured{payload}. The full traceback:\n\n<code>{trace}" \
             f"</code>"
-        # and send it to the dev
-        context.bot.send_message(devid, text, parse_mode=ParseMode.HTML)
+        # and send it to the dev (errors aren't batched into the digest)
+        outbox.send(devid, context.bot.send_message, devid, text, parse_mode=ParseMode.HTML)
     # we raise the error again, so the logger module catches it. If you don't use the logger module, use it.
     raise
 
@@ -93,6 +89,13 @@ def error(update, context):
 def stop_and_restart():
     # Gracefully stop the Updater and replace the current process with a new one
     u.stop()
+    fileWorkers.stop(timeout=30)  # Let files that are already being processed finish
+    devDigest.stop()  # Send what has been counted since the last digest
+    outbox.stop(timeout=30)  # Let queued replies go out
+    metrics.stop()  # Free the metrics port for the new process
+    health.stop()
+    workspaces.stop()
+    shazamClients.stop()
     os.execl(sys.executable, sys.executable, *sys.argv)
 
 
@@ -116,9 +119,9 @@ def sendMsg(update, context):
         user = processed[0]
         message = processed[1]
         if user[0] == '@':
-            user = SIDProcessor.find_key(userdata, user[1:])[0]
+            user = userStore.findByUsername(user[1:])
 
-        context.bot.send_message(int(user), message, parse_mode=telegram.ParseMode.HTML)
+        outbox.send(int(user), context.bot.send_message, int(user), message, parse_mode=telegram.ParseMode.HTML)
         logbotsend(update, context, 'Message sent!')
 
 
@@ -183,7 +186,7 @@ If you exceed this limit, we won't be able to scan your file for music!''')
 def invalidFiletype(update, context):
     logusr(update)
     botsend(update, context, 'Sorry, we don\'t scan those types of files.\nPlease upload an <b>audio</b> or <b>video</b> file containing the music you wish to scan, or <b>record/hum</b> a <b>Telegram Voice Message</b>.\n\n<i>20MB file size limit</i>')
-    context.bot.send_message(devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) sent an invalid filetype')
+    devDigest.record('invalid_file', update.effective_user.id)
     logbot(update, '*Sent invalid-filetype response*')
 
 
@@ -212,10 +215,67 @@ def mydataCMD(update, context):
     logbot(update, '*Sent user data*')
 
 
+# Send the developer cache and connection pool statistics when they send '/stats'
+def statsCMD(update, context):
+    logusr(update)
+    cache = recognitionCache.stats()
+    msg = f'''<b>Recognition cache</b>
+Hits: {cache["hits"]:,}
+Misses: {cache["misses"]:,}
+Hit rate: {round(cache["hit_rate"] * 100, 2)}%
+Stored: {cache["disk"]["entries"]:,} results ({round(cache["disk"]["bytes"] / 1024 / 1024, 2)}MB)
+'''
+    for pool in [*acrPools.values(), shazamClients]:
+        pool = pool.stats()
+        msg += f'''
+<b>{pool["name"]}</b>: {pool["in_use"]}/{pool["size"]} in use (peak {pool["peak_in_use"]}), {pool["waiting"]} waiting
+Avg wait: {pool["avg_wait_ms"]}ms over {pool["borrows"]:,} requests'''
+    quota = quotaTracker.stats()
+    msg += f'''
+
+<b>ACR quota</b> ({quota["period"]}, resets in {round(quota["resets_in"] / 3600, 1)}h, {quota["rejected"]:,} turned away)'''
+    for project, used in quota["projects"].items():
+        budget = used["budget"] if used["budget"] else 'no budget'
+        msg += f'''
+{project}: {used["used"]:,}/{budget}{' (exhausted)' if used["exhausted"] else ''}'''
+    hedge = hedger.stats()
+    msg += f'''
+
+<b>Recognition</b>: {hedge["requests"]:,} files, {hedge["unmatched"]:,} without a confident match'''
+    for name, backend in hedge["backends"].items():
+        msg += f'''
+{name}: won {backend["wins"]:,}/{backend["started"]:,} ({round(backend["win_rate"] * 100, 1)}%), avg {backend["avg_ms"]}ms, p95 {backend["p95_ms"]}ms, {backend["errors"]:,} errors, {backend["lost"] + backend["cancelled"]:,} cancelled'''
+    workers = fileWorkers.stats()
+    msg += f'''
+
+<b>File workers</b>: {workers["running"]}/{workers["workers"]} busy, {workers["queued"]} queued (peak {workers["peak_queued"]}), {workers["rejected"]:,} turned away'''
+    for name, handler in workers["handlers"].items():
+        msg += f'''
+{name}: {handler["calls"]:,} files, avg {handler["avg_ms"]}ms, p95 {handler["p95_ms"]}ms, avg wait {handler["avg_wait_ms"]}ms'''
+    sending = outbox.stats()
+    msg += f'''
+
+<b>Outbox</b>: {sending["queued"]:,} queued (peak {sending["peak_queued"]:,}), {sending["sent"]:,} sent, avg wait {sending["avg_wait_ms"]}ms
+{sending["retried"]:,} flood limit retries, {sending["failed"]:,} failed, {sending["rejected"]:,} dropped'''
+    msg += f'''
+
+<b>Health</b>: user store {f'loaded in {round(userStore.loadSeconds * 1000)}ms' if userStore.ready else 'loading'}'''
+    for name, check in health.status().items():
+        state = 'pending' if check["ok"] is None else 'ok' if check["ok"] else f'unavailable ({check["error"]})'
+        msg += f'''
+{name}: {state}, {check["latency_ms"]}ms, {check["failures"]:,}/{check["checks"]:,} checks failed'''
+    scratch = workspaces.stats()
+    msg += f'''
+
+<b>Workspaces</b>: {scratch["active"]:,} open, {round((scratch["reserved_bytes"] + scratch["kept_bytes"]) / 1048576)}/{round(scratch["quota_bytes"] / 1048576)}MB used (peak {round(scratch["peak_bytes"] / 1048576)}MB), {'tmpfs' if scratch["tmpfs"] else 'disk'}
+{scratch["opened"]:,} opened, {scratch["rejected"]:,} over quota, {scratch["orphans_removed"]:,} orphans removed'''
+    logbotsend(update, context, msg)
+
+
 # Respond to the user entering a command when in debug mode
 def maintenanceINFO(update, context):
     logusr(update)
-    context.bot.send_message(devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) [MAINTENANCE MODE]: \'{update.message.text}\'')
+    devDigest.record('maintenance', update.effective_user.id)
     logbotsend(update, context, 'We\'re currently under maintenance, please try again later')
 
 
@@ -234,6 +294,27 @@ def humProcess(update, context):
     SIDProcessor.addUserIfNotExists(update)
     SIDProcessor.fileProcess(update, context, 'hum')
 
+
+# Errors raised on a worker thread never reach the dispatcher, so hand them to its error handlers
+def workerError(args, e):
+    update, context = args
+    dp.dispatch_error(update, e)
+
+
+def workersFull(args):
+    update, context = args
+    logbotsend(update, context, 'We\'re very busy right now, please send your file again in a minute')
+    logger.warning(f'SongIDWorkers: Queue full, turned away a file from {update.effective_chat.id}')
+
+
+# Downloading and recognising a file can take a while, so it happens on the worker pool instead of the dispatcher thread
+fileWorkers = ChatWorkerPool(
+    workers=int(env['workers']['threads']),
+    maxQueued=int(env['workers']['max_queued']),
+    onError=workerError,
+    onFull=workersFull
+)
+
 maintenance = 0
 
 dp.add_error_handler(error)  # Handle uncaught exceptions
@@ -246,14 +327,15 @@ if maintenance == 1:
     dp.add_handler(CommandHandler('limit', limitCMD, filters=Filters.user(username=devusername)))  # Respond to '/limit'
 
     # Handle different types of file uploads
-    dp.add_handler(MessageHandler(Filters.audio & Filters.user(username=devusername), noisyProcess))
-    dp.add_handler(MessageHandler(Filters.video & Filters.user(username=devusername), noisyProcess))
-    dp.add_handler(MessageHandler(Filters.voice & Filters.user(username=devusername), humProcess))
+    dp.add_handler(MessageHandler(Filters.audio & Filters.user(username=devusername), fileWorkers.dispatch(noisyProcess)))
+    dp.add_handler(MessageHandler(Filters.video & Filters.user(username=devusername), fileWorkers.dispatch(noisyProcess)))
+    dp.add_handler(MessageHandler(Filters.voice & Filters.user(username=devusername), fileWorkers.dispatch(humProcess)))
 
     dp.add_handler(MessageHandler(Filters.photo & Filters.user(username=devusername), invalidFiletype))  # Notify user of invalid file upload
     dp.add_handler(MessageHandler(Filters.document & Filters.user(username=devusername), invalidFiletype))  # Notify user of invalid file upload
     dp.add_handler(CommandHandler('r', restart, filters=Filters.user(username=devusername)))  # Allow the developer to restart the bot
     dp.add_handler(CommandHandler('send', sendMsg, filters=Filters.user(username=devusername)))  # Allow the developer to send messages to users
+    dp.add_handler(CommandHandler('stats', statsCMD, filters=Filters.user(username=devusername)))  # Allow the developer to view cache/pool statistics
     dp.add_handler(MessageHandler(Filters.command, unknownCMD))  # Notify user of invalid command
     #dp.add_handler(MessageHandler(Filters.text & Filters.user(username=devusername), helpCMD))  # Respond to '/help'
 
@@ -266,21 +348,36 @@ elif maintenance == 0:
     dp.add_handler(CommandHandler('limit', limitCMD))  # Respond to '/limit'
 
     # Handle different types of file uploads
-    dp.add_handler(MessageHandler(Filters.audio, noisyProcess))
-    dp.add_handler(MessageHandler(Filters.video, noisyProcess))
-    dp.add_handler(MessageHandler(Filters.voice, humProcess))
+    dp.add_handler(MessageHandler(Filters.audio, fileWorkers.dispatch(noisyProcess)))
+    dp.add_handler(MessageHandler(Filters.video, fileWorkers.dispatch(noisyProcess)))
+    dp.add_handler(MessageHandler(Filters.voice, fileWorkers.dispatch(humProcess)))
 
 
     dp.add_handler(MessageHandler(Filters.photo, invalidFiletype))  # Notify user of invalid file upload
     dp.add_handler(MessageHandler(Filters.document, invalidFiletype))  # Notify user of invalid file upload
     dp.add_handler(CommandHandler('r', restart, filters=Filters.user(username=devusername)))  # Allow the developer to restart the bot
     dp.add_handler(CommandHandler('send', sendMsg, filters=Filters.user(username=devusername)))  # Allow the developer to send messages to users
+    dp.add_handler(CommandHandler('stats', statsCMD, filters=Filters.user(username=devusername)))  # Allow the developer to view cache/pool statistics
     dp.add_handler(MessageHandler(Filters.command, unknownCMD))  # Notify user of invalid command
     dp.add_handler(MessageHandler(Filters.text, helpCMD))  # Respond to text
 logger.info('Loaded: Handlers')
 
 
+workspaces.startJanitor()
 logger.info('Loading Complete!')
-u.start_polling()
-logger.info('Standard polling initialised')
+if metrics.enabled:
+    metrics.serve(env['metrics']['listen'], int(env['metrics']['port']), ready=lambda: (health.ready() and userStore.ready, {'user_store': userStore.ready, **health.status()}))
+if env['webhook']['url']:
+    webhookPath = env['webhook']['secret'] or secrets.token_urlsafe(32)
+    u.start_webhook(
+        listen=env['webhook']['listen'],
+        port=int(env['webhook']['port']),
+        url_path=webhookPath,
+        webhook_url=env['webhook']['url'].rstrip('/') + '/' + webhookPath,
+        max_connections=int(env['webhook']['max_connections'])
+    )
+    logger.info('Webhook initialised')
+else:
+    u.start_polling()
+    logger.info('Standard polling initialised')
 u.idle()
\ No newline at end of file
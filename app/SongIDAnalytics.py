@@ -0,0 +1,230 @@
+# SongID analytics
+# Usage statistics from the user store without loading every user into memory.
+#  - Aggregates keeps running totals (users, active users, calls) and calls per day/hour/user-day
+#    in the store's database, updated in the same transaction as each batch of user writes.
+#  - summary() reads those totals back instantly; scan() walks the tables in bounded memory for
+#    windowed stats such as DAU/WAU/MAU and the calls-per-user distribution.
+#
+#    python SongIDAnalytics.py              # Totals and the last few days, from the aggregates
+#    python SongIDAnalytics.py scan --days 30 --json stats.json
+
+
+import argparse, json, logging, os, sqlite3, time
+from collections import Counter
+from datetime import datetime, timezone
+
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _day(at):
+    return datetime.fromtimestamp(at, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _hour(at):
+    return datetime.fromtimestamp(at, timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+# Running aggregates kept next to the users table.
+# The store calls userChanged()/callMade() as records change (under its own lock) and write()
+# inside the transaction that flushes them, so the aggregates never disagree with the users.
+class Aggregates():
+
+    def __init__(self, db, retentionDays=400):
+        self._db = db
+        self.retentionDays = retentionDays
+        self._totals = Counter()  # Pending changes to the totals table
+        self._userDays = Counter()  # (day, userID) -> calls not written yet
+        self._hours = Counter()  # hour -> calls not written yet
+        self._prunedOn = None
+        db.execute('CREATE TABLE IF NOT EXISTS totals (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS user_days (day TEXT NOT NULL, user_id TEXT NOT NULL, calls INTEGER NOT NULL, PRIMARY KEY (day, user_id)) WITHOUT ROWID')
+        db.execute('CREATE TABLE IF NOT EXISTS call_hours (hour TEXT PRIMARY KEY, calls INTEGER NOT NULL)')
+        if db.execute("SELECT 1 FROM totals WHERE key = 'users'").fetchone() is None:
+            self.backfill()
+        db.commit()
+
+    # Work the totals out from the users table once, e.g. for a store created before the aggregates existed.
+    # Calls made before then can't be split by day, so the per day/hour tables start empty.
+    def backfill(self):
+        users, active, calls = self._db.execute('SELECT COUNT(*), COALESCE(SUM(api_calls > 0), 0), COALESCE(SUM(api_calls), 0) FROM users').fetchone()
+        self._db.executemany('INSERT OR REPLACE INTO totals (key, value) VALUES (?, ?)', [('users', users), ('active_users', active), ('calls', calls)])
+        logger.info(f'SongIDAnalytics: Backfilled totals for {users:,} users')
+
+    # A user's record went from previous (None for a new user) to record
+    def userChanged(self, previous, record):
+        if previous is None:
+            self._totals['users'] += 1
+        before = previous['api_calls'] if previous is not None else 0
+        self._totals['calls'] += record['api_calls'] - before
+        self._totals['active_users'] += (record['api_calls'] > 0) - (before > 0)
+
+    # The user made a recognition request at `at` (seconds since the epoch)
+    def callMade(self, userID, at):
+        self._userDays[(_day(at), str(userID))] += 1
+        self._hours[_hour(at)] += 1
+
+    # Add the pending changes in the caller's transaction
+    def write(self):
+        if self._totals:
+            self._db.executemany('INSERT INTO totals (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = value + excluded.value', list(self._totals.items()))
+        if self._userDays:
+            self._db.executemany('INSERT INTO user_days (day, user_id, calls) VALUES (?, ?, ?) ON CONFLICT (day, user_id) DO UPDATE SET calls = calls + excluded.calls', [(day, userID, calls) for (day, userID), calls in self._userDays.items()])
+        if self._hours:
+            self._db.executemany('INSERT INTO call_hours (hour, calls) VALUES (?, ?) ON CONFLICT (hour) DO UPDATE SET calls = calls + excluded.calls', list(self._hours.items()))
+        self._totals, self._userDays, self._hours = Counter(), Counter(), Counter()
+        today = _day(time.time())
+        if self._prunedOn != today:
+            # Per user-day rows are only needed for the windows scan() looks at
+            cutoff = _day(time.time() - self.retentionDays * 86400)
+            self._db.execute('DELETE FROM user_days WHERE day < ?', (cutoff,))
+            self._db.execute('DELETE FROM call_hours WHERE hour < ?', (cutoff,))
+            self._prunedOn = today
+
+
+# Open the store read-only, so analytics never block or change the running bot
+def connect(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No user store at {path}')
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def _hasTable(db, name):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+# Totals plus calls and active users for the last `days` days, read from the aggregates.
+# Costs a handful of indexed lookups however many users there are.
+def summary(db, days=7, now=None):
+    now = time.time() if now is None else now
+    if _hasTable(db, 'totals'):
+        totals = dict(db.execute('SELECT key, value FROM totals').fetchall())
+    else:
+        # The bot hasn't run with aggregates yet, fall back to one pass over the users table
+        users, active, calls = db.execute('SELECT COUNT(*), COALESCE(SUM(api_calls > 0), 0), COALESCE(SUM(api_calls), 0) FROM users').fetchone()
+        totals = {'users': users, 'active_users': active, 'calls': calls}
+    users = totals.get('users', 0)
+    active = totals.get('active_users', 0)
+    result = {
+        'users': users,
+        'calls': totals.get('calls', 0),
+        'active_users': active,
+        'inactive_users': users - active,
+        'active_percent': round(active / users * 100, 2) if users else 0.0,
+        'days': []
+    }
+    if _hasTable(db, 'user_days'):
+        for offset in range(days):
+            day = _day(now - offset * 86400)
+            calls, dau = db.execute('SELECT COALESCE(SUM(calls), 0), COUNT(*) FROM user_days WHERE day = ?', (day,)).fetchone()
+            result['days'].append({'day': day, 'calls': calls, 'active_users': dau})
+        since = _hour(now - 23 * 3600)
+        result['calls_last_24h'] = db.execute('SELECT COALESCE(SUM(calls), 0) FROM call_hours WHERE hour >= ?', (since,)).fetchone()[0]
+        result['busiest_hour'] = dict(zip(('hour', 'calls'), db.execute('SELECT hour, calls FROM call_hours WHERE hour >= ? ORDER BY calls DESC LIMIT 1', (since,)).fetchone() or (None, 0)))
+    return result
+
+
+# Percentiles of a distribution given as value -> how many times it occurred
+def percentiles(counts, qs=PERCENTILES):
+    total = sum(counts.values())
+    if not total:
+        return {f'p{q}': 0 for q in qs}
+    result = {}
+    values = sorted(counts.items())
+    for q in qs:
+        rank = max(1, -(-q * total // 100))  # Nearest rank
+        seen = 0
+        for value, count in values:
+            seen += count
+            if seen >= rank:
+                result[f'p{q}'] = value
+                break
+    return result
+
+
+def _distribution(rows):
+    # Only the distinct call counts are kept, so memory doesn't grow with the number of users
+    counts = Counter()
+    for (calls,) in rows:
+        counts[calls] += 1
+    users = sum(counts.values())
+    calls = sum(value * count for value, count in counts.items())
+    return {
+        'users': users,
+        'mean': round(calls / users, 2) if users else 0.0,
+        'max': max(counts) if counts else 0,
+        **percentiles(counts),
+        'histogram': {label: sum(count for value, count in counts.items() if low <= value <= high) for label, low, high in (
+            ('0', 0, 0), ('1', 1, 1), ('2-5', 2, 5), ('6-20', 6, 20), ('21-100', 21, 100), ('100+', 101, float('inf')))}
+    }
+
+
+# Windowed statistics from a pass over user_days and the users table, streamed row by row
+def scan(db, days=30, now=None):
+    now = time.time() if now is None else now
+    today = _day(now)
+    result = {'window_days': days}
+    if _hasTable(db, 'user_days'):
+        since = _day(now - (days - 1) * 86400)
+        result['dau'] = db.execute('SELECT COUNT(*) FROM user_days WHERE day = ?', (today,)).fetchone()[0]
+        result['wau'] = db.execute('SELECT COUNT(DISTINCT user_id) FROM user_days WHERE day >= ?', (_day(now - 6 * 86400),)).fetchone()[0]
+        result['mau'] = db.execute('SELECT COUNT(DISTINCT user_id) FROM user_days WHERE day >= ?', (_day(now - 29 * 86400),)).fetchone()[0]
+        result['stickiness'] = round(result['dau'] / result['mau'], 3) if result['mau'] else 0.0
+        daily = db.execute('SELECT day, SUM(calls), COUNT(*) FROM user_days WHERE day >= ? GROUP BY day ORDER BY day', (since,)).fetchall()
+        result['daily'] = [{'day': day, 'calls': calls, 'active_users': users} for day, calls, users in daily]
+        result['calls_per_active_user'] = _distribution(db.execute('SELECT SUM(calls) FROM user_days WHERE day >= ? GROUP BY user_id', (since,)))
+    result['calls_per_user_all_time'] = _distribution(db.execute('SELECT api_calls FROM users'))
+    result['users_seen_in_window'] = db.execute('SELECT COUNT(*) FROM users WHERE last_call >= ?', (int(now - days * 86400),)).fetchone()[0]
+    return result
+
+
+def _printSummary(stats):
+    print(f'Total users: {stats["users"]:,}')
+    print(f'Total songs processed: {stats["calls"]:,}')
+    print(f'\nUsers who have used SongID: {stats["active_users"]:,}')
+    print(f'Users who have not used SongID: {stats["inactive_users"]:,}')
+    print(f'Percentage of users who have used SongID: {stats["active_percent"]}%')
+    if stats['days']:
+        print(f'\nCalls in the last 24 hours: {stats["calls_last_24h"]:,}')
+        for day in stats['days']:
+            print(f'{day["day"]}: {day["calls"]:,} calls from {day["active_users"]:,} users')
+
+
+def _printScan(stats):
+    if 'mau' in stats:
+        print(f'DAU: {stats["dau"]:,}  WAU: {stats["wau"]:,}  MAU: {stats["mau"]:,}  (DAU/MAU {stats["stickiness"]})')
+        window = stats['calls_per_active_user']
+        print(f'\nCalls per active user over {stats["window_days"]} days: mean {window["mean"]}, p50 {window["p50"]}, p90 {window["p90"]}, p99 {window["p99"]}, max {window["max"]}')
+    allTime = stats['calls_per_user_all_time']
+    print(f'Calls per user (all time): mean {allTime["mean"]}, p50 {allTime["p50"]}, p90 {allTime["p90"]}, p99 {allTime["p99"]}, max {allTime["max"]}')
+    print('  ' + ', '.join(f'{label}: {count:,}' for label, count in allTime['histogram'].items()))
+    print(f'\nUsers seen in the last {stats["window_days"]} days: {stats["users_seen_in_window"]:,}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SongID usage statistics')
+    parser.add_argument('command', nargs='?', choices=['summary', 'scan'], default='summary', help='summary: precomputed totals (instant); scan: windowed stats (DAU/MAU, percentiles)')
+    parser.add_argument('--store', default=os.getenv('SONGID_STORE_PATH') or 'data/userdata.sqlite')
+    parser.add_argument('--days', type=int, help='days to show (summary, default 7) or to scan (default 30)')
+    parser.add_argument('--json', help='also write the statistics to this file')
+    args = parser.parse_args(argv)
+
+    db = connect(args.store)
+    try:
+        if args.command == 'summary':
+            stats = summary(db, days=args.days or 7)
+            _printSummary(stats)
+        else:
+            stats = scan(db, days=args.days or 30)
+            _printScan(stats)
+    finally:
+        db.close()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# SongID media buffers
+# Keep downloaded files in memory on their way to the recogniser, and only spill them
+# to disk when they are larger than a configurable threshold.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+
+
+import os, tempfile
+
+
+# A downloaded file that is either held in memory (data) or spilled to disk (path).
+# Spilled files are owned by the buffer and removed by close() / leaving the with block,
+# which also calls onClose (e.g. to release the workspace the file was downloaded into).
+class MediaBuffer():
+
+    def __init__(self, data=None, path=None, owned=False, onClose=None):
+        if (data is None) == (path is None):
+            raise ValueError('MediaBuffer needs exactly one of data or path')
+        self.data = data
+        self.path = path
+        self.owned = owned
+        self.onClose = onClose
+
+    # Wrap downloaded bytes, writing them to spillDir if they are larger than spillThreshold
+    @classmethod
+    def fromBytes(cls, data, spillThreshold, spillDir=None, suffix=''):
+        if spillThreshold is None or len(data) <= spillThreshold:
+            return cls(data=data)
+        if spillDir:
+            os.makedirs(spillDir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix='spill_', dir=spillDir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return cls(path=path, owned=True)
+
+    @property
+    def inMemory(self):
+        return self.data is not None
+
+    @property
+    def size(self):
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.path)
+
+    # What to hand to a recogniser: the bytes themselves, or the spill file path
+    def source(self):
+        return self.data if self.data is not None else self.path
+
+    # A zero-copy view of the contents (reads the spill file if there is one)
+    def view(self):
+        if self.data is not None:
+            return memoryview(self.data)
+        with open(self.path, 'rb') as f:
+            return memoryview(f.read())
+
+    def close(self):
+        self.data = None
+        if self.owned and self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        if self.onClose is not None:
+            onClose, self.onClose = self.onClose, None
+            onClose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Read a recogniser input (bytes-like or a file path) into a buffer
+def readSource(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    with open(source, 'rb') as f:
+        return f.read()
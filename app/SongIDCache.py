@@ -0,0 +1,246 @@
+# SongID recognition cache
+# Two tier (memory LRU + on-disk SQLite) cache for recognition results, keyed on
+# Telegram's file_unique_id and on a hash of the file contents.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+
+
+import hashlib, json, os, sqlite3, threading, time
+from collections import OrderedDict
+
+
+# In-memory LRU with an optional per-entry time to live
+class LRUCache():
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self.getEntry(key)
+        return default if entry is None else entry[0]
+
+    # (value, expires) or None, expires being None for entries that never expire
+    def getEntry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, expires
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# Persistent JSON value store with a time to live and a total size limit.
+# When the stored values grow past max_bytes the least recently used entries are dropped.
+# A hit only records when the entry was used if that is more than touchSlack seconds out of date,
+# so most reads don't write (the file may be shared by several processes).
+class DiskCache():
+
+    def __init__(self, path, ttl=7*24*3600, max_bytes=64*1024*1024, touchSlack=300):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.touchSlack = touchSlack
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, expires REAL, accessed REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.purgeExpired()
+
+    def get(self, key, default=None):
+        entry = self.getEntry(key)
+        return default if entry is None else entry[0]
+
+    # (value, expires) or None, expires being None for entries that never expire
+    def getEntry(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, expires, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, expires, accessed = row
+            if expires is not None and expires <= now:
+                self._delete(key)
+                self.misses += 1
+                return None
+            if now - accessed > self.touchSlack:
+                self._db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(value), expires
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        value = json.dumps(value, separators=(',', ':'))
+        size = len(value) + len(key)
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._delete(key)
+            self._db.execute('INSERT INTO entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)', (key, value, size, expires, now))
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            return self._delete(key)
+
+    # Remove every entry whose time to live has passed
+    def purgeExpired(self):
+        with self._lock:
+            cur = self._db.execute('DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            if cur.rowcount:
+                self.evictions += cur.rowcount
+                self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        entries = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {'entries': entries, 'bytes': self._size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _delete(self, key):
+        row = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False
+        self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self._size -= row[0]
+        return True
+
+    # Drop expired entries, then the least recently used ones until we are back under 90% of max_bytes
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        self._db.execute('DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if self._size <= target:
+            return
+        doomed = []
+        for key, size in self._db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if self._size <= target:
+                break
+            doomed.append((key,))
+            self._size -= size
+        self._db.executemany('DELETE FROM entries WHERE key = ?', doomed)
+        self.evictions += len(doomed)
+
+
+# Hash file contents so the same audio forwarded under a different file_unique_id still hits.
+# Accepts bytes, bytearray, memoryview or a path on disk.
+def contentHash(content):
+    digest = hashlib.sha256()
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        digest.update(content)
+    else:
+        with open(content, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Recognition result cache used by both the Shazam (bot.py) and ACRCloud (app/) pipelines.
+# The scope keeps results from different recognisers (eg. noisy vs hum) apart.
+class RecognitionCache():
+
+    def __init__(self, path, memory_entries=1024, ttl=7*24*3600, max_bytes=64*1024*1024):
+        self.memory = LRUCache(memory_entries, ttl)
+        self.disk = DiskCache(path, ttl, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def _keys(self, scope, file_unique_id, content_hash):
+        keys = []
+        if file_unique_id:
+            keys.append(f'fid:{scope}:{file_unique_id}')
+        if content_hash:
+            keys.append(f'sha:{scope}:{content_hash}')
+        return keys
+
+    # Return the cached result, or None on a miss.
+    # Pass file_unique_id before downloading, and content (or content_hash) once the file is in hand.
+    def lookup(self, scope='', file_unique_id=None, content=None, content_hash=None):
+        if content is not None and content_hash is None:
+            content_hash = contentHash(content)
+        keys = self._keys(scope, file_unique_id, content_hash)
+        for key in keys:
+            entry = self.memory.getEntry(key)
+            if entry is None:
+                entry = self.disk.getEntry(key)
+            if entry is not None:
+                value, expires = entry
+                # Copied into memory for no longer than the entry has left, so a miss cached for hours doesn't stay for days
+                ttl = None if expires is None else expires - time.time()
+                if ttl is None or ttl > 0:
+                    # Backfill the other keys so the next lookup is served from the cheapest one
+                    for other in keys:
+                        self.memory.set(other, value, ttl)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def store(self, result, scope='', file_unique_id=None, content=None, content_hash=None, ttl=None):
+        if content is not None and content_hash is None:
+            content_hash = contentHash(content)
+        for key in self._keys(scope, file_unique_id, content_hash):
+            self.memory.set(key, result, ttl)
+            self.disk.set(key, result, ttl)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'memory': self.memory.stats(),
+            'disk': self.disk.stats()
+        }
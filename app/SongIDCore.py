@@ -1,5 +1,12 @@
-import telegram, json, time, os, logging, sentry_sdk
+import telegram, json, time, os, logging, threading
 from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, MessageQueue
+from SongIDCache import RecognitionCache, contentHash
+from SongIDBuffer import MediaBuffer
+from SongIDStore import UserStore
+from SongIDQuota import QuotaTracker, TokenBucket
+from SongIDMetrics import Metrics
+from SongIDOutbox import Outbox, OutboxFull, DevDigest
+from SongIDWorkspace import Workspaces
 
 
 ver='1.0.1'
@@ -18,8 +25,10 @@ env = {
     'telegram': {
         'bot_token': os.getenv('SONGID_TELEGRAM_BOT_TOKEN'),
         'dev_id': os.getenv('SONGID_TELEGRAM_DEV_ID'),
-        'dev_username': os.getenv('SONGID_TELEGRAM_DEV_USERNAME')
+        'dev_username': os.getenv('SONGID_TELEGRAM_DEV_USERNAME'),
+        'api_url': os.getenv('SONGID_TELEGRAM_API_URL') or 'https://api.telegram.org'  # Override for local Bot API servers
     },
+    'acr_ping_url': os.getenv('SONGID_ACR_PING_URL') or 'https://identify-eu-west-1.acrcloud.com',  # Checked in the background by SongIDHealth
     'acr': {
         'clear': {
             'host': os.getenv('SONGID_ACR_CLEAR_HOST'),
@@ -42,6 +51,101 @@ env = {
             'recognize_type': os.getenv('SONGID_ACR_HUM_RECOGNIZE_TYPE'),
             'timeout': os.getenv('SONGID_ACR_HUM_TIMEOUT')
         }
+    },
+    'cache': {
+        'path': os.getenv('SONGID_CACHE_PATH') or 'data/recognition_cache.sqlite',
+        'memory_entries': os.getenv('SONGID_CACHE_MEMORY_ENTRIES') or '1024',
+        'ttl': os.getenv('SONGID_CACHE_TTL') or '604800',  # 7 days
+        'miss_ttl': os.getenv('SONGID_CACHE_MISS_TTL') or '21600',  # 6 hours
+        'max_bytes': os.getenv('SONGID_CACHE_MAX_BYTES') or '67108864'  # 64MB
+    },
+    # Downloads up to this many bytes are kept in memory, larger ones are written to a workspace.
+    # Defaults to the 20MB file size limit, so nothing touches the disk unless this is lowered.
+    'spill_threshold': os.getenv('SONGID_SPILL_THRESHOLD') or '20000000',
+    # Scratch directories for spilled downloads (tmpfs when there is room), within a disk quota
+    'workspace': {
+        'dir': os.getenv('SONGID_WORKSPACE_DIR') or '',  # Empty picks /dev/shm/songid or the system temp directory
+        'quota': os.getenv('SONGID_WORKSPACE_QUOTA') or '1073741824',  # 1GB
+        'orphan_age': os.getenv('SONGID_WORKSPACE_ORPHAN_AGE') or '3600'  # Seconds before leftover files are removed
+    },
+    # Decode and trim uploads to mono WAV with ffmpeg before sending them to ACRCloud
+    'preprocess': {
+        'enabled': os.getenv('SONGID_PREPROCESS') or '1',
+        'sample_rate': os.getenv('SONGID_PREPROCESS_SAMPLE_RATE') or '16000'
+    },
+    # Long-lived ACRCloud recognisers per project (clear/noisy/hum)
+    'pool': {
+        'size': os.getenv('SONGID_ACR_POOL_SIZE') or '4',
+        'idle_timeout': os.getenv('SONGID_ACR_POOL_IDLE_TIMEOUT') or '300'  # Seconds
+    },
+    # Shazam clients shared by every file, on one long-lived event loop
+    'shazam': {
+        'pool_size': os.getenv('SONGID_SHAZAM_POOL_SIZE') or '4',
+        'api_url': os.getenv('SONGID_SHAZAM_API_URL') or ''  # Send Shazam requests to this server instead (local benchmarks)
+    },
+    # Receive updates over HTTPS instead of polling when a public URL is set.
+    # The secret is used as the webhook path, so only Telegram knows where to post updates.
+    'webhook': {
+        'url': os.getenv('SONGID_WEBHOOK_URL') or '',
+        'listen': os.getenv('SONGID_WEBHOOK_LISTEN') or '0.0.0.0',
+        'port': os.getenv('SONGID_WEBHOOK_PORT') or '8443',
+        'secret': os.getenv('SONGID_WEBHOOK_SECRET') or '',
+        'max_connections': os.getenv('SONGID_WEBHOOK_MAX_CONNECTIONS') or '40'
+    },
+    # Threads that download and recognise files (updates from one chat are still handled in order)
+    'workers': {
+        'threads': os.getenv('SONGID_WORKERS') or '4',
+        'max_queued': os.getenv('SONGID_WORKERS_MAX_QUEUED') or '500'  # Files waiting before new ones are turned away
+    },
+    # Daily ACRCloud call budgets per project (0 = no local budget, only stop on a 3003 response)
+    'quota': {
+        'path': os.getenv('SONGID_QUOTA_PATH') or 'data/quota.sqlite',
+        'clear': os.getenv('SONGID_ACR_CLEAR_DAILY_BUDGET') or '0',
+        'noisy': os.getenv('SONGID_ACR_NOISY_DAILY_BUDGET') or '0',
+        'hum': os.getenv('SONGID_ACR_HUM_DAILY_BUDGET') or '0',
+        'reset_hour': os.getenv('SONGID_ACR_QUOTA_RESET_HOUR') or '0'  # Hour (UTC) the provider resets its counters
+    },
+    # Backends each kind of upload is sent to, as backend:delay pairs (backends: noisy, hum, shazam).
+    # A backend starts `delay` seconds in, or as soon as the ones before it miss; the first confident match wins.
+    # e.g. 'noisy:0,shazam:2' waits 2s for ACRCloud before also asking Shazam; 'noisy:0,shazam:0' races both.
+    'hedge': {
+        'noisy': os.getenv('SONGID_HEDGE_NOISY') or 'noisy:0',
+        'hum': os.getenv('SONGID_HEDGE_HUM') or 'hum:0',
+        'min_score': os.getenv('SONGID_HEDGE_MIN_SCORE') or '70',  # ACRCloud score that counts as a confident match
+        'workers': os.getenv('SONGID_HEDGE_WORKERS') or '8',
+        'timeout': os.getenv('SONGID_HEDGE_TIMEOUT') or '60'  # Seconds before giving up on every backend
+    },
+    # Per-user request cooldown
+    'rate': {
+        'interval': os.getenv('SONGID_RATE_INTERVAL') or '20',  # Seconds to earn another request
+        'burst': os.getenv('SONGID_RATE_BURST') or '1'  # Requests a user may make back to back
+    },
+    # Prometheus metrics (per-stage latency histograms and counters) served at /metrics
+    'metrics': {
+        'enabled': os.getenv('SONGID_METRICS') or '0',
+        'listen': os.getenv('SONGID_METRICS_LISTEN') or '0.0.0.0',
+        'port': os.getenv('SONGID_METRICS_PORT') or '9464'
+    },
+    # Outgoing messages are queued per chat and sent within Telegram's flood limits
+    'outbox': {
+        'global_rate': os.getenv('SONGID_OUTBOX_GLOBAL_RATE') or '30',  # Messages a second across all chats
+        'chat_interval': os.getenv('SONGID_OUTBOX_CHAT_INTERVAL') or '1',  # Seconds between messages to one user
+        'group_interval': os.getenv('SONGID_OUTBOX_GROUP_INTERVAL') or '3',  # Seconds between messages to one group
+        'senders': os.getenv('SONGID_OUTBOX_SENDERS') or '4',
+        'max_queued': os.getenv('SONGID_OUTBOX_MAX_QUEUED') or '10000'
+    },
+    # Background checks that ACR Cloud and Telegram can be reached
+    'health': {
+        'interval': os.getenv('SONGID_HEALTH_INTERVAL') or '60',  # Seconds between checks while a service is up
+        'retry': os.getenv('SONGID_HEALTH_RETRY') or '10'  # Seconds between checks while it is down
+    },
+    # Seconds between the developer's activity digests (matches, misses, limit hits, commands...)
+    'digest_interval': os.getenv('SONGID_DIGEST_INTERVAL') or '300',
+    # User data (imported from data/userdata.json on first start)
+    'store': {
+        'path': os.getenv('SONGID_STORE_PATH') or 'data/userdata.sqlite',
+        'flush_interval': os.getenv('SONGID_STORE_FLUSH_INTERVAL') or '2',  # Seconds before a change reaches disk
+        'max_pending': os.getenv('SONGID_STORE_MAX_PENDING') or '500'  # Changed users that force an early flush
     }
 }
 
@@ -73,26 +177,94 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Importing and initialising Sentry takes a while, so do it in the background instead of holding up start-up
+def initSentry():
+    try:
+        import sentry_sdk
+        sentry_sdk.init(
+        dsn=sentry_dsn,
+        release=ver,
+        environment=env['environment']
+        )
+        logger.info('Loaded: Sentry')
+    except Exception as e:
+        logger.error(f'Unable to initialise Sentry: {e}')
+
 if env['environment'] != 'development':
-    sentry_sdk.init(
-    dsn=sentry_dsn,
-    release=ver,
-    environment=env['environment']
-    )
+    threading.Thread(target=initSentry, name='SentryInit', daemon=True).start()
 
 
-# Load data/userdata.json into the variable 'userdata'
-with open('data/userdata.json') as f:
-    userdata = json.load(f)
+# Open the user store in the background, importing data/userdata.json the first time.
+# Commands that need a user's record wait for it, everything else can be served straight away.
+userStore = UserStore(
+    env['store']['path'],
+    jsonPath='data/userdata.json',
+    flushInterval=float(env['store']['flush_interval']),
+    maxPending=int(env['store']['max_pending']),
+    background=True
+)
+
+
+# ACRCloud calls made today per project, so uploads can be turned away before they are downloaded once the budget is spent
+quotaTracker = QuotaTracker(
+    env['quota']['path'],
+    {project: int(env['quota'][project]) for project in ('clear', 'noisy', 'hum')},
+    resetHour=int(env['quota']['reset_hour'])
+)
+
+
+# Every spilled download gets its own directory, removed once it has been processed.
+# The janitor also clears out downloads left in downloadDIR by older versions.
+workspaces = Workspaces(
+    root=env['workspace']['dir'] or None,
+    quota=int(env['workspace']['quota']),
+    orphanAge=int(env['workspace']['orphan_age']),
+    legacy=[f'{downloadDIR}/*']
+)
+
+
+# Request cooldown per user, kept in memory instead of re-reading the user store
+userRate = TokenBucket(interval=float(env['rate']['interval']), burst=int(env['rate']['burst']))
+
+
+# Per-stage latency and outcome counters, a no-op unless enabled
+metrics = Metrics(enabled=env['metrics']['enabled'] == '1')
+
+
+# Cache of ACRCloud responses, so files that are forwarded around are only sent to the API once
+recognitionCache = RecognitionCache(
+    env['cache']['path'],
+    memory_entries=int(env['cache']['memory_entries']),
+    ttl=int(env['cache']['ttl']),
+    max_bytes=int(env['cache']['max_bytes'])
+)
 
 
 
 
 #  Initialise the required telegram bot data
-u=Updater(token=token, use_context=True, request_kwargs={'read_timeout': 6, 'connect_timeout': 7})
+#  Each file worker may be talking to Telegram at the same time, so size the connection pool to match
+u=Updater(token=token, use_context=True, base_url=f"{env['telegram']['api_url'].rstrip('/')}/bot", base_file_url=f"{env['telegram']['api_url'].rstrip('/')}/file/bot", request_kwargs={'read_timeout': 6, 'connect_timeout': 7, 'con_pool_size': int(env['workers']['threads']) + int(env['outbox']['senders']) + 4})
 dp = u.dispatcher
 
 
+# Replies and notifications go out through the outbox instead of being sent from the handler threads
+outbox = Outbox(
+    globalRate=float(env['outbox']['global_rate']),
+    chatInterval=float(env['outbox']['chat_interval']),
+    groupInterval=float(env['outbox']['group_interval']),
+    senders=int(env['outbox']['senders']),
+    maxQueued=int(env['outbox']['max_queued'])
+)
+
+
+# Developer notifications are collected into one message every few minutes instead of one per event
+devDigest = DevDigest(
+    lambda text: outbox.send(devid, u.bot.send_message, devid, f'<b>{botName} activity</b>\n{text}', parse_mode=telegram.ParseMode.HTML),
+    interval=float(env['digest_interval'])
+)
+
+
 
 # Log the users previous message (debugging)
 def logusr(update):
@@ -106,20 +278,21 @@ def logusr(update):
 # Send a message to the user
 def botsend(update, context, msg):
     if hasattr(update.message, 'reply_text'):
-        update.message.reply_text(str(msg)+f'\n\n<i>{botAt} <code>{ver}</code></i>', parse_mode=telegram.ParseMode.HTML)
+        outbox.send(update.effective_chat.id, update.message.reply_text, str(msg)+f'\n\n<i>{botAt} <code>{ver}</code></i>', parse_mode=telegram.ParseMode.HTML)
 
+# Count the user's message towards the developer's next digest
 def devsend(update, context, msg):
     if '{update.message.text}' in msg:
-        if hasattr(update.message, 'text'):
+        if hasattr(update.message, 'text') and update.message.text:
             msg = update.message.text
         else:
             msg = '[No message]'
-    context.bot.send_message(devid, f'User @{update.effective_user.username} ({update.effective_chat.id}): \'{msg}\'')
+    devDigest.command(msg, update.effective_user.id)
 
 
 # Send a message to the user and log the message sent
 def logbotsend(update, context, msg):
-    update.message.reply_text(str(msg)+f'\n\n<i>{botAt} <code>{ver}</code></i>', parse_mode=telegram.ParseMode.HTML)
+    outbox.send(update.effective_chat.id, update.message.reply_text, str(msg)+f'\n\n<i>{botAt} <code>{ver}</code></i>', parse_mode=telegram.ParseMode.HTML)
     logger.info(f'[@{botUsername}][{botName}][M:{update.effective_message.message_id}]: {msg}')
 
 
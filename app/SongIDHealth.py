@@ -0,0 +1,91 @@
+# SongID health checks
+# Readiness checks for the services SongID depends on (ACRCloud, Telegram...), run concurrently
+# on background threads instead of blocking start-up until each one answers. A failing check is
+# retried every `retry` seconds and a passing one re-checked every `interval` seconds; changes
+# are logged, and status() is shown in /stats and served at /ready alongside the metrics.
+
+
+import logging, threading, time, urllib.request
+
+
+logger = logging.getLogger(__name__)
+
+
+# A check for a URL that should answer 200
+def urlCheck(url, timeout=10):
+    def check():
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            code = response.getcode()
+        if code != 200:
+            raise RuntimeError(f'HTTP {code}')
+    return check
+
+
+class HealthChecks():
+
+    # checks: name -> function that raises (or returns False) when the service isn't usable
+    def __init__(self, checks, interval=60, retry=10):
+        self.interval = interval
+        self.retry = retry
+        self._checks = dict(checks)
+        self._lock = threading.Lock()
+        self._state = {name: {'ok': None, 'since': time.time(), 'error': None, 'latency_ms': None, 'checks': 0, 'failures': 0} for name in self._checks}
+        self._changed = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._threads = [threading.Thread(target=self._run, args=(name,), name=f'SongIDHealth-{name}', daemon=True) for name in self._checks]
+        for thread in self._threads:
+            thread.start()
+
+    def _check(self, name):
+        start = time.monotonic()
+        try:
+            ok, error = self._checks[name]() is not False, None
+        except Exception as e:
+            ok, error = False, str(e) or type(e).__name__
+        latency = round((time.monotonic() - start) * 1000, 1)
+        with self._lock:
+            state = self._state[name]
+            state['checks'] += 1
+            state['latency_ms'] = latency
+            state['error'] = error
+            if not ok:
+                state['failures'] += 1
+            if state['ok'] != ok:
+                state['ok'] = ok
+                state['since'] = time.time()
+                if ok:
+                    logger.info(f'SongIDHealth: {name} is ready ({latency}ms)')
+                else:
+                    logger.warning(f'SongIDHealth: {name} is unavailable ({error}), retrying every {self.retry}s')
+                self._changed.notify_all()
+        return ok
+
+    def _run(self, name):
+        while not self._stopped.is_set():
+            ok = self._check(name)
+            self._stopped.wait(self.interval if ok else self.retry)
+
+    # Whether the named check (or every check) last passed
+    def ready(self, name=None):
+        with self._lock:
+            if name is not None:
+                return self._state[name]['ok'] is True
+            return all(state['ok'] is True for state in self._state.values())
+
+    # Block until every check has passed once, or timeout seconds have gone by
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while not all(state['ok'] is True for state in self._state.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def status(self):
+        with self._lock:
+            return {name: dict(state) for name, state in self._state.items()}
+
+    def stop(self):
+        self._stopped.set()
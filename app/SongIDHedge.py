@@ -0,0 +1,172 @@
+# SongID hedged recognition
+# Sends a file to several recognition backends (ACRCloud projects, Shazam) according to a
+# policy, and answers with the first confident match instead of waiting on a single backend.
+#
+# A policy is a list of (backend, delay) pairs, e.g. 'noisy:0,shazam:1.5,hum:4':
+#  - each backend is started `delay` seconds after the request began,
+#  - if every backend started so far has answered without a confident match, the next one is
+#    started straight away instead of waiting for its delay,
+#  - the first confident match wins and backends that haven't started yet are cancelled.
+# Delays of 0 race every backend at once (lowest latency, highest cost); a single backend
+# behaves exactly like calling it directly.
+
+
+import logging, threading, time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+logger = logging.getLogger(__name__)
+
+
+# No backend answered in time. Backends that had started are still running and can't be stopped,
+# so callers shouldn't retry straight away: that would send (and bill) the same file again.
+class HedgeTimeout(TimeoutError):
+    pass
+
+
+# Turn 'noisy:0,shazam:1.5' into [('noisy', 0.0), ('shazam', 1.5)]
+def parsePolicy(text):
+    policy = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, delay = part.partition(':')
+        policy.append((name.strip(), float(delay or 0)))
+    return sorted(policy, key=lambda step: step[1])
+
+
+class _BackendStats():
+
+    def __init__(self, window=500):
+        self.started = 0
+        self.wins = 0
+        self.matches = 0  # Confident matches, whether or not they won the race
+        self.errors = 0
+        self.lost = 0  # Still running when another backend won
+        self.cancelled = 0  # Never started because another backend won first
+        self.seconds = 0.0
+        self.finished = 0
+        self._recent = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.finished += 1
+        self.seconds += seconds
+        self._recent.append(seconds)
+
+    def stats(self):
+        recent = sorted(self._recent)
+        return {
+            'started': self.started,
+            'wins': self.wins,
+            'win_rate': round(self.wins / self.started, 3) if self.started else 0.0,
+            'matches': self.matches,
+            'errors': self.errors,
+            'lost': self.lost,
+            'cancelled': self.cancelled,
+            'avg_ms': round(self.seconds / self.finished * 1000, 1) if self.finished else 0.0,
+            'p95_ms': round(recent[int(0.95 * (len(recent) - 1))] * 1000, 1) if recent else 0.0
+        }
+
+
+# Races backends (name -> fn(source) returning an ACRCloud style response) following a policy.
+# confident(response) decides whether a response is good enough to stop early.
+# Backends run on worker threads; a backend that is already running when another wins can't be
+# interrupted, its answer is simply ignored.
+class HedgedRecogniser():
+
+    def __init__(self, backends, confident, workers=8, timeout=60):
+        self.backends = backends
+        self.confident = confident
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='SongIDHedge')
+        self._lock = threading.Lock()
+        self._stats = defaultdict(_BackendStats)
+        self.requests = 0
+        self.unmatched = 0
+
+    def _run(self, name, source):
+        start = time.monotonic()
+        try:
+            return self.backends[name](source)
+        finally:
+            with self._lock:
+                self._stats[name].record(time.monotonic() - start)
+
+    # Returns (backend name, response). With no confident match, the best response seen is returned
+    # (a low scoring match before a clean miss before an error); raises if every backend failed.
+    def recognise(self, policy, source):
+        policy = [(name, delay) for name, delay in policy if name in self.backends]
+        if not policy:
+            raise ValueError('No configured backend in the recognition policy')
+        with self._lock:
+            self.requests += 1
+        start = time.monotonic()
+        waiting = deque(policy)
+        running = {}  # future -> backend name
+        fallback = None  # (rank, name, response)
+        error = None
+        try:
+            while waiting or running:
+                elapsed = time.monotonic() - start
+                # Start the backends that are due, or the next one if nothing is running any more
+                while waiting and (waiting[0][1] <= elapsed or not running):
+                    name, delay = waiting.popleft()
+                    with self._lock:
+                        self._stats[name].started += 1
+                    running[self._pool.submit(self._run, name, source)] = name
+                if elapsed >= self.timeout:
+                    break
+                nextStart = waiting[0][1] - elapsed if waiting else None
+                remaining = self.timeout - elapsed
+                done, _ = wait(running, timeout=min(remaining, nextStart) if nextStart is not None else remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        logger.warning(f'SongIDHedge: {name} failed: {e}')
+                        with self._lock:
+                            self._stats[name].errors += 1
+                        error = e
+                        continue
+                    if self.confident(response):
+                        with self._lock:
+                            self._stats[name].matches += 1
+                            self._stats[name].wins += 1
+                        logger.info(f'SongIDHedge: {name} won after {round(time.monotonic() - start, 2)}s')
+                        return name, response
+                    rank = self._rank(response)
+                    if fallback is None or rank < fallback[0]:
+                        fallback = (rank, name, response)
+        finally:
+            # Whatever is still pending lost the race (or the request timed out)
+            with self._lock:
+                for future, name in running.items():
+                    if future.cancel():
+                        self._stats[name].cancelled += 1
+                    else:
+                        self._stats[name].lost += 1
+                for name, delay in waiting:
+                    self._stats[name].cancelled += 1
+        with self._lock:
+            self.unmatched += 1
+        if fallback is not None:
+            return fallback[1], fallback[2]
+        if error is not None:
+            raise error
+        raise HedgeTimeout(f'No backend answered within {self.timeout}s')
+
+    # Lower is better: any match, then no match, then everything else (limits, errors)
+    def _rank(self, response):
+        code = response['status']['code']
+        return 0 if code == 0 else 1 if code == 1001 else 2
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'unmatched': self.unmatched,
+                'backends': {name: backend.stats() for name, backend in self._stats.items()}
+            }
@@ -0,0 +1,44 @@
+# SongID lazy imports
+# Optional backends (shazamio, pytube, instaloader, mutagen) take a noticeable share of start-up
+# time to import, yet most of them are only needed by a few requests. A LazyModule stands in for
+# the module and imports it the first time one of its attributes is used.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+
+
+import importlib, importlib.util
+
+
+class LazyModule():
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._available = None
+
+    # Whether the module is installed, found without importing it
+    @property
+    def available(self):
+        if self._available is None:
+            try:
+                self._available = importlib.util.find_spec(self._name) is not None
+            except (ImportError, ValueError):
+                self._available = False
+        return self._available
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    # Import the module now (raises ImportError if it isn't installed)
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f"<LazyModule '{self._name}' ({'loaded' if self.loaded else 'not loaded'})>"
@@ -0,0 +1,218 @@
+# SongID metrics
+# Counters and latency histograms for the hot paths, exposed in the Prometheus text format.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+#
+# Stages are timed with a context manager:
+#     with metrics.stage('download_file', handler='media', provider='telegram') as timer:
+#         data = download()
+#         timer.outcome = 'too_big'  # Optional, defaults to 'ok' (or 'error'/'cancelled' if the block raised)
+# When metrics are disabled stage() hands back a shared do-nothing timer, so instrumented code
+# costs one attribute check per stage.
+# Gauges are functions registered with gauge() and read each time the metrics are rendered.
+
+
+import asyncio, json, logging, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, from a cache hit up to a slow download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'stage_seconds': 'Time spent in each stage of handling an update',
+    'requests_total': 'Updates handled, by handler and outcome',
+    'sessions_live': 'Unexpired per-user sessions, by kind',
+    'sessions_disk_bytes': 'Bytes on disk held by live sessions, by kind',
+    'tag_bytes_written_total': 'Bytes written by metadata edits, by file format',
+}
+
+
+class _Timer():
+    __slots__ = ('metrics', 'stage', 'labels', 'outcome', 'start')
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+        self.outcome = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        outcome = self.outcome
+        if outcome is None:
+            if excType is None:
+                outcome = 'ok'
+            else:
+                outcome = 'cancelled' if issubclass(excType, asyncio.CancelledError) else 'error'
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.start, stage=self.stage, outcome=outcome, **self.labels)
+        return False
+
+
+# Stand-in timer for when metrics are disabled; setting .outcome on it is harmless
+class _NullTimer():
+
+    outcome = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Histogram():
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics():
+
+    def __init__(self, enabled=True, prefix='songid', buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {label items: value}
+        self._histograms = {}  # name -> {label items: _Histogram}
+        self._gauges = {}  # name -> {label items: function returning the current value}
+        self._server = None
+
+    def stage(self, stage, **labels):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage, labels)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    # Report fn() as the gauge's value whenever the metrics are rendered
+    def gauge(self, name, fn, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = fn
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram.counts[i] += 1
+                    break
+            histogram.sum += seconds
+            histogram.count += 1
+
+    # Everything recorded so far in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+        # Read outside the lock, a gauge function may take locks of its own
+        for name, series in sorted(gauges.items()):
+            fullName = f'{self.prefix}_{name}'
+            lines += self._header(name, fullName, 'gauge')
+            for key, fn in sorted(series.items(), key=lambda item: item[0]):
+                try:
+                    lines.append(f'{fullName}{_labels(key)} {fn()}')
+                except Exception as e:
+                    logger.warning(f'SongIDMetrics: gauge {name} failed: {e}')
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                fullName = f'{self.prefix}_{name}'
+                lines += self._header(name, fullName, 'counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{fullName}{_labels(key)} {value}')
+            for name, series in sorted(self._histograms.items()):
+                fullName = f'{self.prefix}_{name}'
+                lines += self._header(name, fullName, 'histogram')
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{fullName}_bucket{_labels(key + (("le", repr(float(bound))),))} {cumulative}')
+                    lines.append(f'{fullName}_bucket{_labels(key + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{fullName}_sum{_labels(key)} {histogram.sum}')
+                    lines.append(f'{fullName}_count{_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, fullName, kind):
+        header = [f'# TYPE {fullName} {kind}']
+        if name in HELP:
+            header.insert(0, f'# HELP {fullName} {HELP[name]}')
+        return header
+
+    # Serve render() at /metrics from a background thread.
+    # ready, if given, returns (ok, status) for a /ready endpoint that answers 200 or 503 with the status as JSON.
+    def serve(self, host='0.0.0.0', port=9464, ready=None):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/ready' and ready is not None:
+                    ok, status = ready()
+                    body = json.dumps(status).encode()
+                    self.send_response(200 if ok else 503)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='SongIDMetrics', daemon=True).start()
+        logger.info(f'SongIDMetrics: serving on {host}:{self._server.server_address[1]}/metrics')
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _labels(items):
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,264 @@
+# SongID outbox
+# Sends messages to Telegram from a queue per chat instead of straight from the handlers, keeping
+# under the Bot API flood limits (about 30 messages a second overall, one a second per chat and
+# 20 a minute per group) and backing off for retry_after whenever Telegram answers 429 anyway.
+# Developer notifications are counted and sent as a periodic digest instead of one per event.
+
+
+import logging, threading, time
+from collections import deque, Counter
+from concurrent.futures import Future
+from telegram.error import RetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class _Message():
+    __slots__ = ('fn', 'args', 'kwargs', 'future', 'queuedAt', 'retries')
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.queuedAt = time.monotonic()
+        self.retries = 0
+
+
+# Rate limited sender threads with a queue per chat.
+# A chat's messages go out one at a time, in order, at most one per chatInterval seconds
+# (groupInterval for groups, which have negative ids). All chats share a budget of globalRate
+# messages a second. A 429 pauses every sender for the retry_after Telegram asks for, then the
+# message is retried up to maxRetries times.
+class Outbox():
+
+    def __init__(self, globalRate=30, chatInterval=1.0, groupInterval=3.0, senders=4, maxQueued=10000, maxRetries=5, name='SongIDOutbox'):
+        self.globalRate = globalRate
+        self.chatInterval = chatInterval
+        self.groupInterval = groupInterval
+        self.maxQueued = maxQueued
+        self.maxRetries = maxRetries
+        self._chats = {}  # chatID -> deque of _Message waiting to be sent
+        self._ready = deque()  # Chats with waiting messages and no sender working on them
+        self._nextAt = {}  # chatID -> earliest time its next message may go out
+        self._cond = threading.Condition()
+        self._tokens = 1.0  # Messages are spaced out evenly rather than sent in bursts
+        self._refilledAt = time.monotonic()
+        self._pausedUntil = 0.0
+        self._queued = 0
+        self._sending = 0
+        self._stopped = False
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retried = 0
+        self.peakQueued = 0
+        self.waitSeconds = 0.0
+        self._threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True) for i in range(senders)]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue fn(*args, **kwargs) (a Bot method that sends to chatID) behind the chat's earlier messages.
+    # Returns a Future with the method's result.
+    def send(self, chatID, fn, *args, **kwargs):
+        message = _Message(fn, args, kwargs)
+        with self._cond:
+            if self._queued >= self.maxQueued or self._stopped:
+                self.rejected += 1
+                message.future.set_exception(OutboxFull(f'{self._queued} messages already waiting'))
+                logger.warning(f'SongIDOutbox: Queue full, dropped a message to {chatID}')
+                return message.future
+            messages = self._chats.get(chatID)
+            if messages is None:
+                messages = self._chats[chatID] = deque()
+                self._ready.append(chatID)
+                self._cond.notify()
+            messages.append(message)
+            self._queued += 1
+            self.peakQueued = max(self.peakQueued, self._queued)
+        return message.future
+
+    def _interval(self, chatID):
+        return self.groupInterval if str(chatID).startswith('-') else self.chatInterval
+
+    def _refill(self, now):
+        self._tokens = min(1.0, self._tokens + (now - self._refilledAt) * self.globalRate)
+        self._refilledAt = now
+
+    # Wait for a chat whose next message may go out now, and take a global token for it
+    def _take(self):
+        with self._cond:
+            while True:
+                if self._stopped and not self._queued and not self._sending:
+                    return None, None
+                now = time.monotonic()
+                self._refill(now)
+                wait = None
+                if now < self._pausedUntil:
+                    wait = self._pausedUntil - now
+                elif self._tokens < 1:
+                    wait = (1 - self._tokens) / self.globalRate
+                else:
+                    # First chat in line that isn't still cooling down from its last message
+                    for _ in range(len(self._ready)):
+                        chatID = self._ready.popleft()
+                        nextAt = self._nextAt.get(chatID, 0)
+                        if nextAt <= now:
+                            self._tokens -= 1
+                            self._queued -= 1
+                            self._sending += 1
+                            return chatID, self._chats[chatID][0]
+                        self._ready.append(chatID)
+                        wait = nextAt - now if wait is None else min(wait, nextAt - now)
+                self._cond.wait(wait)
+
+    def _work(self):
+        while True:
+            chatID, message = self._take()
+            if message is None:
+                return
+            start = time.monotonic()
+            retryAfter = None
+            try:
+                result = message.fn(*message.args, **message.kwargs)
+            except RetryAfter as e:
+                retryAfter = float(e.retry_after)
+            except Exception as e:
+                logger.warning(f'SongIDOutbox: Sending to {chatID} failed: {e}')
+                with self._cond:
+                    self.failed += 1
+                message.future.set_exception(e)
+            else:
+                with self._cond:
+                    self.sent += 1
+                    self.waitSeconds += start - message.queuedAt
+                message.future.set_result(result)
+            with self._cond:
+                self._sending -= 1
+                messages = self._chats[chatID]
+                if retryAfter is not None and message.retries < self.maxRetries:
+                    # Telegram's flood limit applies to the whole bot, so everyone waits, then this message goes again
+                    logger.warning(f'SongIDOutbox: Flood limit hit, pausing for {retryAfter}s')
+                    message.retries += 1
+                    self.retried += 1
+                    self._queued += 1
+                    self._pausedUntil = max(self._pausedUntil, time.monotonic() + retryAfter)
+                else:
+                    messages.popleft()
+                    if retryAfter is not None:
+                        self.failed += 1
+                        message.future.set_exception(RetryAfter(retryAfter))
+                self._nextAt[chatID] = time.monotonic() + self._interval(chatID)
+                if messages:
+                    self._ready.append(chatID)
+                else:
+                    del self._chats[chatID]
+                    self._forget(time.monotonic())
+                self._cond.notify_all()
+
+    # Drop cooldowns that have passed, so _nextAt doesn't grow with every chat ever seen
+    def _forget(self, now):
+        if len(self._nextAt) > 2 * len(self._chats) + 1000:
+            self._nextAt = {chatID: nextAt for chatID, nextAt in self._nextAt.items() if nextAt > now or chatID in self._chats}
+
+    # Send what is queued, then end the threads
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': self._queued,
+                'sending': self._sending,
+                'peak_queued': self.peakQueued,
+                'chats': len(self._chats),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'rejected': self.rejected,
+                'paused_for': round(max(0.0, self._pausedUntil - time.monotonic()), 1),
+                'avg_wait_ms': round(self.waitSeconds / self.sent * 1000, 1) if self.sent else 0.0
+            }
+
+
+# Counts events for the developer and sends them as one message every `interval` seconds,
+# e.g. '1,240 matches, 310 misses, 12 limit hits in the last 5 min'. send(text) delivers it.
+class DevDigest():
+
+    # Event name -> how it reads in the digest, in the order they are listed
+    LABELS = {
+        'match': 'matches',
+        'miss': 'misses',
+        'limit': 'limit hits',
+        'cooldown': 'cooldowns',
+        'invalid_file': 'invalid files',
+        'maintenance': 'messages during maintenance',
+    }
+
+    def __init__(self, send, interval=300):
+        self.send = send
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._events = Counter()
+        self._commands = Counter()
+        self._users = set()
+        self._since = time.monotonic()
+        self._stopped = threading.Event()
+        self.digests = 0
+        self._thread = threading.Thread(target=self._run, name='SongIDDigest', daemon=True)
+        self._thread.start()
+
+    def record(self, event, userID=None):
+        with self._lock:
+            self._events[event] += 1
+            if userID is not None:
+                self._users.add(userID)
+
+    def command(self, text, userID=None):
+        with self._lock:
+            self._commands[text.split(' ')[0].split('@')[0] if text.startswith('/') else 'text'] += 1
+            if userID is not None:
+                self._users.add(userID)
+
+    # The digest for everything recorded since the last one, or None if nothing happened
+    def summary(self):
+        with self._lock:
+            events, commands, users = self._events, self._commands, len(self._users)
+            minutes = max(1, round((time.monotonic() - self._since) / 60))
+            self._events, self._commands, self._users = Counter(), Counter(), set()
+            self._since = time.monotonic()
+        if not events and not commands:
+            return None
+        counts = [f'{events.pop(event):,} {label}' for event, label in self.LABELS.items() if events.get(event)]
+        counts += [f'{count:,} {event}' for event, count in events.most_common()]
+        text = f'{", ".join(counts) or "No files"} in the last {minutes} min ({users:,} users)'
+        if commands:
+            text += '\nMessages: ' + ', '.join(f'{command} {count:,}' for command, count in commands.most_common())
+        return text
+
+    def flush(self):
+        text = self.summary()
+        if text is not None:
+            self.digests += 1
+            try:
+                self.send(text)
+            except Exception as e:
+                logger.warning(f'SongIDDigest: Failed to send digest: {e}')
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    # Send what has been counted so far and stop
+    def stop(self):
+        self._stopped.set()
+        self.flush()
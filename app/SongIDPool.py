@@ -0,0 +1,225 @@
+# SongID client pools
+# Long-lived recogniser clients that are created once and borrowed per request, instead of
+# building a new client (and new connections) for every file.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+
+
+import asyncio, threading, time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Bookkeeping shared by the thread and asyncio pools
+class _PoolStats():
+
+    def __init__(self, name, size, idleTimeout):
+        self.name = name
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.created = 0
+        self.closed = 0
+        self.inUse = 0
+        self.peakInUse = 0
+        self.waiting = 0
+        self.borrows = 0
+        self.waits = 0  # Borrows that found every client busy
+        self.waitSeconds = 0.0
+
+    def stats(self, idle):
+        return {
+            'name': self.name,
+            'size': self.size,
+            'idle': idle,
+            'in_use': self.inUse,
+            'peak_in_use': self.peakInUse,
+            'waiting': self.waiting,
+            'saturation': round(self.inUse / self.size, 3),
+            'created': self.created,
+            'closed': self.closed,
+            'borrows': self.borrows,
+            'waits': self.waits,
+            'avg_wait_ms': round(self.waitSeconds / self.borrows * 1000, 2) if self.borrows else 0.0
+        }
+
+
+# Thread-safe pool of up to `size` clients made by factory().
+# Clients idle for longer than idleTimeout are closed (with closer, if given) and replaced on next use.
+class ClientPool(_PoolStats):
+
+    def __init__(self, factory, size=4, idleTimeout=300, name='', closer=None):
+        super().__init__(name, size, idleTimeout)
+        self.factory = factory
+        self.closer = closer
+        self._idle = deque()  # (last used, client)
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def borrow(self, timeout=None):
+        client = self._acquire(timeout)
+        try:
+            yield client
+        finally:
+            self._release(client)
+
+    def _acquire(self, timeout):
+        start = time.monotonic()
+        with self._cond:
+            self.borrows += 1
+            if not self._idle and self.inUse >= self.size:
+                self.waits += 1
+            self.waiting += 1
+            try:
+                while not self._idle and self.inUse >= self.size:
+                    remaining = None if timeout is None else timeout - (time.monotonic() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout(f'No {self.name} client free after {timeout}s')
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            client = self._takeIdle()
+            self.inUse += 1
+            self.peakInUse = max(self.peakInUse, self.inUse)
+            self.waitSeconds += time.monotonic() - start
+        if client is None:
+            try:
+                client = self.factory()
+            except:
+                with self._cond:
+                    self.inUse -= 1
+                    self._cond.notify()
+                raise
+            self.created += 1
+        return client
+
+    # Pop the most recently used idle client, closing any that have sat unused for too long
+    def _takeIdle(self):
+        now = time.monotonic()
+        while self._idle:
+            lastUsed, client = self._idle.pop()
+            if now - lastUsed <= self.idleTimeout:
+                self._closeStale(now)
+                return client
+            self._close(client)
+        return None
+
+    def _closeStale(self, now):
+        while self._idle and now - self._idle[0][0] > self.idleTimeout:
+            self._close(self._idle.popleft()[1])
+
+    def _close(self, client):
+        self.closed += 1
+        if self.closer is not None:
+            try:
+                self.closer(client)
+            except Exception:
+                pass
+
+    def _release(self, client):
+        with self._cond:
+            self.inUse -= 1
+            self._idle.append((time.monotonic(), client))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop()[1])
+
+    def stats(self):
+        return super().stats(len(self._idle))
+
+
+# asyncio flavour of ClientPool. factory and closer may be plain functions or coroutines.
+class AsyncClientPool(_PoolStats):
+
+    def __init__(self, factory, size=4, idleTimeout=300, name='', closer=None):
+        super().__init__(name, size, idleTimeout)
+        self.factory = factory
+        self.closer = closer
+        self._idle = deque()
+        self._cond = None  # Created on first use, inside the running event loop
+
+    @asynccontextmanager
+    async def borrow(self, timeout=None):
+        client = await self._acquire(timeout)
+        try:
+            yield client
+        finally:
+            await self._release(client)
+
+    async def _acquire(self, timeout):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        start = time.monotonic()
+        async with self._cond:
+            self.borrows += 1
+            if not self._idle and self.inUse >= self.size:
+                self.waits += 1
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._idle or self.inUse < self.size), timeout
+                )
+            except asyncio.TimeoutError:
+                raise PoolTimeout(f'No {self.name} client free after {timeout}s')
+            finally:
+                self.waiting -= 1
+            stale, client = self._takeIdle()
+            self.inUse += 1
+            self.peakInUse = max(self.peakInUse, self.inUse)
+            self.waitSeconds += time.monotonic() - start
+        for old in stale:
+            await self._close(old)
+        if client is None:
+            try:
+                client = self.factory()
+                if asyncio.iscoroutine(client):
+                    client = await client
+            except:
+                async with self._cond:
+                    self.inUse -= 1
+                    self._cond.notify()
+                raise
+            self.created += 1
+        return client
+
+    def _takeIdle(self):
+        now = time.monotonic()
+        stale = []
+        client = None
+        while self._idle:
+            lastUsed, candidate = self._idle.pop()
+            if now - lastUsed <= self.idleTimeout:
+                client = candidate
+                break
+            stale.append(candidate)
+        while self._idle and now - self._idle[0][0] > self.idleTimeout:
+            stale.append(self._idle.popleft()[1])
+        return stale, client
+
+    async def _close(self, client):
+        self.closed += 1
+        if self.closer is not None:
+            try:
+                result = self.closer(client)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                pass
+
+    async def _release(self, client):
+        async with self._cond:
+            self.inUse -= 1
+            self._idle.append((time.monotonic(), client))
+            self._cond.notify()
+
+    async def close(self):
+        while self._idle:
+            await self._close(self._idle.pop()[1])
+
+    def stats(self):
+        return super().stats(len(self._idle))
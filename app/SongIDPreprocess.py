@@ -0,0 +1,93 @@
+# SongID audio pre-processing
+# Decode only the part of an upload the recogniser listens to, downmixed and resampled to a
+# small mono WAV, so we stop shipping video frames and unused audio to ACRCloud/Shazam.
+# Uses the ffmpeg binary when it is installed, and passes the original file through when it isn't.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+
+
+import logging, shutil, struct, subprocess
+
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = shutil.which('ffmpeg')
+
+
+def available():
+    return FFMPEG is not None
+
+
+# True for MP4/MOV data whose moov atom (the index ffmpeg needs before it can read any audio)
+# comes after mdat, as in most phone recordings. ffmpeg has to seek back for it, which a pipe can't do.
+def needsSeek(data):
+    if bytes(data[4:8]) != b'ftyp':
+        return False
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        if kind == b'moov':
+            return False
+        if kind == b'mdat':
+            return True
+        if size == 1:
+            if offset + 16 > len(data):
+                break
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+        if size < 8:
+            break  # 0 runs to the end of the file, anything else is damaged
+        offset += size
+    return True  # No moov before the data ran out, let ffmpeg look for it
+
+
+# Decode [start, start+duration) seconds of source (bytes or a path) to 16-bit mono WAV.
+# In-memory MP4s that need seeking are written to a workspace (from `workspaces`, a
+# SongIDWorkspace.Workspaces) first and decoded from there; everything else goes through a pipe.
+# Returns the WAV bytes, or None if ffmpeg is missing or could not decode the file.
+def decodeWindow(source, start=0, duration=30, sampleRate=16000, timeout=30, workspaces=None):
+    if FFMPEG is None:
+        return None
+    inMemory = isinstance(source, (bytes, bytearray, memoryview))
+    if inMemory and workspaces is not None and needsSeek(source):
+        try:
+            workspace = workspaces.open('preprocess', reserve=len(source))
+        except Exception as e:
+            # Quota used up: the pipe still works for files ffmpeg can read without seeking
+            logger.warning(f'Preprocess: no workspace for a file that needs seeking, trying a pipe: {e}')
+        else:
+            with workspace:
+                path = workspace.file('input.mp4')
+                with open(path, 'wb') as f:
+                    f.write(source)
+                return decodeWindow(path, start, duration, sampleRate, timeout)
+    cmd = [
+        FFMPEG, '-hide_banner', '-loglevel', 'error',
+        '-ss', str(start), '-t', str(duration),
+        '-i', 'pipe:0' if inMemory else str(source),
+        '-vn', '-sn', '-dn',  # Drop video, subtitle and data streams without decoding them
+        '-ac', '1', '-ar', str(sampleRate), '-sample_fmt', 's16',
+        '-f', 'wav', 'pipe:1'
+    ]
+    if inMemory:
+        feed = {'input': bytes(source)}
+    else:
+        feed = {'stdin': subprocess.DEVNULL}
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=timeout, **feed)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f'Preprocess: ffmpeg failed to run: {e}')
+        return None
+    if proc.returncode != 0 or len(proc.stdout) <= 44:  # 44 bytes is an empty WAV header
+        logger.warning(f'Preprocess: ffmpeg could not decode the file: {proc.stderr.decode(errors="replace").strip()[:200]}')
+        return None
+    return proc.stdout
+
+
+# Return the trimmed WAV if it could be produced and is actually smaller, otherwise the original source
+def prepare(source, start=0, duration=30, sampleRate=16000, timeout=30, workspaces=None):
+    wav = decodeWindow(source, start, duration, sampleRate, timeout, workspaces)
+    if wav is None:
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)) and len(wav) >= len(source):
+        return source
+    logger.debug(f'Preprocess: trimmed to {len(wav)} bytes of audio')
+    return wav
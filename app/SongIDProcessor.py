@@ -1,16 +1,11 @@
-from ACRAPI import ACRAPI
+from ACRAPI import ACRAPI, shazamio
 from SongIDCore import *
+from SongIDHedge import HedgedRecogniser, HedgeTimeout, parsePolicy
+import math
 
 
 
 
-# Save user data from the "userdata" variable contents to data/userdata.json
-def saveUserData():
-    with open('data/userdata.json', 'w') as f:
-        json.dump(userdata, f)
-    logger.info('User data has been saved')
-
-
 # Format milliseconds to minutes:seconds (used for track-length)
 def msConvert(ms):
     ms = int(ms)
@@ -20,70 +15,60 @@ def msConvert(ms):
 
 # Return how long the user has until they can make another API request
 def timeLeft(update):
-    logger.debug('timeLeft(0/3)')
-    last_call = SIDProcessor.getUserData(update)['last_call']
-    logger.debug('timeLeft(1/2)')
-    dur_since_last_call = round(time.time()) - int(last_call)
-    logger.debug('timeLeft(2/2)')
-    return int(20 - round(dur_since_last_call))
+    return math.ceil(userRate.wait(update.effective_user.id))
 
 
-# Return whether the user has surpassed their API cooldown or not
+# Return whether the user has surpassed their API cooldown or not, and count the call if they have
 def authorised(update):
-    logger.debug('authorised(0/3)')
-    alldata=SIDProcessor.getUserData(update)
-    api_calls = alldata['api_calls']
-    last_call = alldata['last_call']
-    logger.debug('authorised(1/3)')
-    if timeLeft(update) <= 0:
-        #api_calls = getUserData(f'{update.effective_chat.id}')['api_calls']
-        logger.debug('authorised(2/3)')
-        api_calls = int(api_calls) + 1
-        last_call = round(time.time())
-        SIDProcessor.addUserData(update, f'{api_calls}', f'{last_call}')
-        logger.debug('authorised(3/3)')
-        return True
-    else:
-        logger.debug('authorised(3/3)')
-        return False
+    allowed, wait = userRate.take(update.effective_user.id)
+    if allowed:
+        userStore.recordCall(update.effective_user.id, f'{update.effective_chat.username}', f'{update.effective_user.first_name} {update.effective_user.last_name}', round(time.time()))
+    return allowed
+
+
+# Answer used when a project's daily budget is spent, handled by dataProcess like ACRCloud's own 3003
+QUOTA_EXHAUSTED = {'status': {'code': 3003, 'msg': 'Daily budget reached'}}
+
+
+# Get the audio/video/document/voice object the user uploaded
+def fileAttachment(update):
+    message = update.effective_message
+    for attachment in (message.audio, message.video, message.document, message.voice):
+        if attachment is not None:
+            return attachment
+    return None
 
 
 # Download the users uploaded file
-def fileDownload(update, context):
+def fileDownload(update, context, processor):
+    attachment = fileAttachment(update)
     file_id = None
-    while file_id == None:
-        # Get the file-id
-        try:
-            file_id = update.effective_message.audio.file_id
-            break
-        except:
-            pass
-        try:
-            file_id = update.effective_message.video.file_id
-            break
-        except:
-            pass
-        try:
-            file_id = update.effective_message.document.file_id
-            break
-        except:
-            pass
-        try:
-            file_id = update.effective_message.voice.file_id
-            break
-        except:
-            logbotsend(update, context, f'⚠️ Sorry, we don\'t support that filetype.')
-        break
+    if attachment is not None:
+        file_id = attachment.file_id
+    else:
+        logbotsend(update, context, f'⚠️ Sorry, we don\'t support that filetype.')
     try:
-        file_info = context.bot.get_file(file_id)
-        file_size = file_info["file_size"]
-        if 20000000 - int(file_size) >= 0:
+        with metrics.stage('get_file', handler=processor, provider='telegram'):
+            file_info = context.bot.get_file(file_id)
+        file_size = int(file_info["file_size"])
+        if 20000000 - file_size < 0:
+            raise ValueError(f'File too big: {file_size} bytes')
+        if file_size > int(env['spill_threshold']):
+            # Too big to hold in memory, so spill it to a workspace that is removed when the buffer is closed
             web_path = file_info["file_path"]  # Get the original filename
             extension = os.path.splitext(f'{web_path}')[1]  # Get the file extension (.mp3, .mp4 etc)
-            fileName = f'{update.effective_chat.id}_{update.effective_message.message_id}_{file_id}{extension}'
-            newFile = context.bot.get_file(file_id)
-            newFile.download(f'{downloadDIR}/{fileName}')
-            return fileName
+            workspace = workspaces.open(processor, reserve=file_size)
+            try:
+                filePath = workspace.file(f'{file_id}{extension}')
+                with metrics.stage('download_file', handler=processor, provider='telegram') as timer:
+                    file_info.download(filePath)
+                    timer.outcome = 'spilled'
+            except BaseException:
+                workspace.close()
+                raise
+            return MediaBuffer(path=filePath, owned=True, onClose=workspace.close)
+        with metrics.stage('download_file', handler=processor, provider='telegram'):
+            return MediaBuffer(bytes(file_info.download_as_bytearray()))
     except Exception as e:
         botsend(update, context, f'⚠️ Sorry, your file is too big for us to process.\nFile size limit: 20MB')
         logbot(update, '*Sent file-size limit error*')
@@ -92,6 +77,89 @@ def fileDownload(update, context):
 
 
 
+# Trim an ACRCloud response down to the parts dataProcess reads so it can be cached.
+# Only matches and clean misses are cached, errors such as the 3003 limit are not.
+def cacheableResult(data):
+    code = data["status"]["code"]
+    if code == 0:
+        return {'status': data["status"], 'metadata': {'music': data["metadata"]["music"][:1]}}
+    elif code == 1001:
+        return {'status': data["status"]}
+    return None
+
+
+# Wrap an ACRCloud project so every call is counted against its daily budget
+def acrBackend(project, recognise):
+    def call(source):
+        if not quotaTracker.reserve(project):
+            logger.info(f'ACR: {project} budget spent, not sending the file')
+            return QUOTA_EXHAUSTED
+        data = recognise(source)
+        if data["status"]["code"] == 3003:
+            quotaTracker.markExhausted(project)
+        return data
+    return call
+
+
+# How a recognition response is counted in the metrics
+def responseOutcome(data):
+    code = data["status"]["code"]
+    return {0: 'match', 1001: 'no_match', 3003: 'limit'}.get(code, 'error')
+
+
+# Time every call to a backend, labelled with how it answered
+def instrumented(name, recognise):
+    def call(source):
+        with metrics.stage('recognise', handler='backend', provider=name) as timer:
+            data = recognise(source)
+            timer.outcome = responseOutcome(data)
+        return data
+    return call
+
+
+# A match is confident enough to stop asking other backends once ACRCloud scores it at least min_score
+def confidentMatch(data):
+    return data["status"]["code"] == 0 and int(data["metadata"]["music"][0].get("score", 0)) >= int(env['hedge']['min_score'])
+
+
+# Recognition backends and the order (and delays) each kind of upload tries them in
+backends = {'noisy': instrumented('noisy', acrBackend('noisy', ACRAPI.noisy)), 'hum': instrumented('hum', acrBackend('hum', ACRAPI.hum))}
+if shazamio.available:
+    backends['shazam'] = instrumented('shazam', ACRAPI.shazam)
+policies = {processor: parsePolicy(env['hedge'][processor]) for processor in ('noisy', 'hum')}
+for processor, policy in policies.items():
+    for name, delay in policy:
+        if name not in backends:
+            logger.warning(f'Recognition policy for {processor} uses unavailable backend \'{name}\', skipping it')
+hedger = HedgedRecogniser(backends, confidentMatch, workers=int(env['hedge']['workers']), timeout=float(env['hedge']['timeout']))
+
+
+# Whether any backend in the processor's policy still has calls left today
+def canRecognise(processor):
+    return any(name in backends and quotaTracker.remaining(name) != 0 for name, delay in policies[processor])
+
+
+# Send a downloaded file (bytes or a path) to the recognition backends unless its contents have already been recognised
+def recognise(processor, source, fileUniqueId):
+    with metrics.stage('hash', handler=processor, provider='local'):
+        fileHash = contentHash(source)
+    with metrics.stage('cache_lookup', handler=processor, provider='cache') as timer:
+        data = recognitionCache.lookup(processor, content_hash=fileHash)
+        timer.outcome = 'miss' if data is None else 'hit'
+    if data is not None:
+        logger.info('ACR: Using cached result for file contents')
+    else:
+        with metrics.stage('hedge', handler=processor, provider='hedge') as timer:
+            backend, data = hedger.recognise(policies[processor], source)
+            timer.outcome = responseOutcome(data)
+        logger.info(f'Recognition: Answer from {backend}')
+        data = cacheableResult(data) or data
+    if data["status"]["code"] in (0, 1001):
+        ttl = int(env['cache']['ttl']) if data["status"]["code"] == 0 else int(env['cache']['miss_ttl'])
+        recognitionCache.store(data, processor, file_unique_id=fileUniqueId, content_hash=fileHash, ttl=ttl)
+    return data
+
+
 # Process the JSON response from the ACRCloud API
 def dataProcess(update, context, data):
     context.bot.sendChatAction(chat_id=update.effective_chat.id, action=telegram.ChatAction.TYPING, timeout=20)  # Display a typing 'chat action' from the bot for the respective user
@@ -113,7 +181,9 @@ def dataProcess(update, context, data):
         #    artists=artists+str(data["artists"][int(value)]["name"])+', '
         #print(artists_dict)
         #artists=data["artists"][0:]["name"]
-        duration=msConvert(data["duration_ms"])
+        duration=None
+        if "duration_ms" in data:  # Not every backend knows the track length
+            duration=msConvert(data["duration_ms"])
         try:
             # Get the YouTube link for the song if it exists
             youtube=None
@@ -160,7 +230,8 @@ def dataProcess(update, context, data):
         response += f'\n\n<b>{artist}</b> - <b>{title}</b>\n'
         if album != None:
             response += f'\nAlbum: {album}'
-        response += f'\nLength: {duration}'
+        if duration != None:
+            response += f'\nLength: {duration}'
         if release_date != None:
             response += f'\nRelease date: {release_date}'
         response += f'\n'
@@ -175,14 +246,12 @@ def dataProcess(update, context, data):
         # Send the respective user this information
         botsend(update, context, response)
         logbot(update, '*Sent song information*')
-        context.bot.send_message(
-            devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) identified a song!')
+        devDigest.record('match', update.effective_user.id)
     elif data["status"]["code"] == 3003:
         logger.info('ACR: Limit exceeded')
         botsend(update, context,
                 'We\'ve hit our daily API limit. Type /limit for more info')
-        context.bot.send_message(
-            devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) hit the limit')
+        devDigest.record('limit', update.effective_user.id)
     else:  # If no match was found by ACRCloud
         logger.info('ACR: Failed to find a match')
         botsend(update, context, '''No Match :(
@@ -194,7 +263,7 @@ Tips for a higher chance of matching:
 - When recording with the Telegram Voice Recorder, try to record for at least 10 seconds, preferably during the chorus of a song where it's most iconic.
 - When uploading a file, try to make sure the audio quality is the best you have accessible.''')
         logbot(update, 'No Match :(')
-        context.bot.send_message(devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) couldn\'t find a match')
+        devDigest.record('miss', update.effective_user.id)
 
 
 
@@ -213,21 +282,20 @@ class SIDProcessor():
     def addUserIfNotExists(update):
         userID=str(update.effective_chat.id)
         username=str(update.effective_chat.username)
-        if userID not in userdata:
-            logger.info(f'User does not exist: {update.effective_user.id}')
-            SIDProcessor.addUserData(update, '0', '0')
+        with userStore.transaction():
+            if userID not in userStore:
+                logger.info(f'User does not exist: {update.effective_user.id}')
+                SIDProcessor.addUserData(update, '0', '0')
 
-    # Add user data to the 'userdata' variable and save it to disk
+    # Add/update the user's record in the user store (written to disk in batches)
     def addUserData(update, apiCalls, lastCall):
-        userdata[f'{update.effective_user.id}'] = {'username': f'{update.effective_chat.username}', 'name': f'{update.effective_user.first_name} {update.effective_user.last_name}', 'api_calls': f'{apiCalls}', 'last_call': f'{lastCall}'}
+        userStore.upsert(update.effective_user.id, f'{update.effective_chat.username}', f'{update.effective_user.first_name} {update.effective_user.last_name}', apiCalls, lastCall)
         logger.info(f'User data added/updated: [{update.effective_user.id}: {update.effective_user.username}, {update.effective_user.first_name} {update.effective_user.last_name}, {apiCalls}, {lastCall}]')
-        saveUserData()
 
     # Get user data for the respective user
     def getUserData(update):
-        #update = json.loads(update)
         logger.debug('getUserData(0/1)')
-        data = userdata[f'{update.effective_user.id}']
+        data = userStore.get(update.effective_user.id)
         logger.debug('getUserData(1/1)')
         return data
 
@@ -237,44 +305,91 @@ class SIDProcessor():
     # If authorised, download the users uploaded file and send it to the API response processor, and then delete the downloaded file from disk
     def fileProcess(update, context, processor):
         logusr(update)
-        for attempt in range(0,10):
+        with metrics.stage('total', handler=processor, provider='songid') as total:
             try:
-                logger.info('fileProcess: Attempting to send ChatAction.TYPING')
-                context.bot.sendChatAction(chat_id=update.effective_chat.id, action=telegram.ChatAction.TYPING, timeout=10)
-                logger.info('fileProcess: Successfully sent ChatAction.TYPING')
-            except:
-                logger.info('fileProcess: Failed to send ChatAction.TYPING')
-                continue
-            logger.info('fileProcess: Breaking from ChatAction loop')
-            break
+                SIDProcessor._fileProcess(update, context, processor, total)
+            except Exception:
+                total.outcome = 'error'
+                raise
+            finally:
+                metrics.count('requests_total', handler=processor, outcome=total.outcome or 'ok')
+
+    # fileProcess without the overall timer; sets total.outcome to how the request ended
+    def _fileProcess(update, context, processor, total):
+        with metrics.stage('chat_action', handler=processor, provider='telegram'):
+            for attempt in range(0,10):
+                try:
+                    logger.info('fileProcess: Attempting to send ChatAction.TYPING')
+                    context.bot.sendChatAction(chat_id=update.effective_chat.id, action=telegram.ChatAction.TYPING, timeout=10)
+                    logger.info('fileProcess: Successfully sent ChatAction.TYPING')
+                except:
+                    logger.info('fileProcess: Failed to send ChatAction.TYPING')
+                    continue
+                logger.info('fileProcess: Breaking from ChatAction loop')
+                break
         if authorised(update):
-            context.bot.sendChatAction(chat_id=update.effective_chat.id, action=telegram.ChatAction.RECORD_AUDIO, timeout=20)
-            fileName = fileDownload(update, context)
-            if fileName != 'FILE_TOO_BIG':
-                deleteSuccess = 0
-                while deleteSuccess != 5:
+            # Files that have been recognised before are answered without downloading them again
+            attachment = fileAttachment(update)
+            fileUniqueId = attachment.file_unique_id if attachment is not None else None
+            with metrics.stage('cache_lookup', handler=processor, provider='cache') as timer:
+                cached = recognitionCache.lookup(processor, file_unique_id=fileUniqueId)
+                timer.outcome = 'miss' if cached is None else 'hit'
+            if cached is not None:
+                logger.info('fileProcess: Using cached result')
+                total.outcome = 'cached'
+                with metrics.stage('reply', handler=processor, provider='telegram'):
+                    dataProcess(update, context, cached)
+                return
+            # Don't bother downloading the file if there are no ACRCloud calls left today
+            if not canRecognise(processor):
+                logger.info(f'fileProcess: {processor} budget spent, skipping download')
+                total.outcome = 'no_budget'
+                with metrics.stage('reply', handler=processor, provider='telegram'):
+                    dataProcess(update, context, QUOTA_EXHAUSTED)
+                return
+            with metrics.stage('chat_action', handler=processor, provider='telegram'):
+                context.bot.sendChatAction(chat_id=update.effective_chat.id, action=telegram.ChatAction.RECORD_AUDIO, timeout=20)
+            media = fileDownload(update, context, processor)
+            if media != 'FILE_TOO_BIG':
+                # Leaving the with block drops the buffer (and deletes the file if it was spilled to disk)
+                with media:
                     try:
-                        if processor == 'noisy':
-                            dataProcess(update, context, ACRAPI.noisy(f'{downloadDIR}/{fileName}'))
-                            os.remove(f'{downloadDIR}/{fileName}')
-                        elif processor == 'clear':
-                            dataProcess(update, context, ACRAPI.clear(f'{downloadDIR}/{fileName}'))
-                            os.remove(f'{downloadDIR}/{fileName}')
-                        elif processor == 'hum':
-                            dataProcess(update, context, ACRAPI.hum(f'{downloadDIR}/{fileName}'))
-                            os.remove(f'{downloadDIR}/{fileName}')
-                        deleteSuccess = 5
-                    except:
-                        deleteSuccess+=1
-                        continue
+                        data = recognise(processor, media.source(), fileUniqueId)
+                    except HedgeTimeout as e:
+                        # The backends are still busy with this file, asking again would only pile more calls on
+                        logger.warning(f'fileProcess: {e}')
+                        total.outcome = 'timeout'
+                        botsend(update, context, f'⚠️ Sorry, recognising your file took too long. Please try again later.')
+                        return
+                    except Exception as e:
+                        # Every backend failed; each one has already been billed for this file
+                        logger.error(f'fileProcess: Recognition failed: {e}')
+                        total.outcome = 'error'
+                        botsend(update, context, f'⚠️ Sorry, something went wrong recognising your file. Please try again later.')
+                        return
+                total.outcome = responseOutcome(data)
+                # Only the reply is retried: recognising again would reserve quota and call every backend again
+                for attempt in range(5):
+                    try:
+                        with metrics.stage('reply', handler=processor, provider='telegram'):
+                            dataProcess(update, context, data)
+                        break
+                    except (telegram.error.TelegramError, OutboxFull) as e:
+                        logger.warning(f'fileProcess: Failed to send the result (attempt {attempt + 1}/5): {e}')
+                        time.sleep(1)
+                else:
+                    total.outcome = 'error'
+            else:
+                total.outcome = 'too_big'
         else:
+            total.outcome = 'cooldown'
             timeLeft_int = timeLeft(update)
             if timeLeft_int == 1:
                 time_msg = f'{timeLeft_int} second'
             else:
                 time_msg = f'{timeLeft_int} seconds'
-            logbotsend(update, context, f'Due to an increased volume of requests, a 20 second cooldown has been put in place to benefit the user.\n\nPlease wait {time_msg} before making another request')
-            context.bot.send_message(devid, f'User @{update.effective_user.username} ({update.effective_chat.id}) hit the cooldown ({time_msg} left)')
+            logbotsend(update, context, f'Due to an increased volume of requests, a {round(userRate.interval)} second cooldown has been put in place to benefit the user.\n\nPlease wait {time_msg} before making another request')
+            devDigest.record('cooldown', update.effective_user.id)
     # Split the command arguments into an array
     def commandArgs(update, context):
         whitespace=[]
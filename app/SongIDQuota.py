@@ -0,0 +1,164 @@
+# SongID quotas
+# Daily ACRCloud call budgets per project, persisted so a restart doesn't forget what has been
+# spent, and a per-user token bucket for the request cooldown.
+
+
+import logging, os, sqlite3, threading, time
+from datetime import datetime, timedelta, timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+# Counts ACRCloud calls per project (clear/noisy/hum) against a daily budget.
+# A day starts at resetHour:00 UTC, matching when the provider resets its counters.
+# A budget of 0 means unlimited, but the project can still be marked exhausted when
+# ACRCloud itself answers with 3003.
+class QuotaTracker():
+
+    def __init__(self, path, budgets, resetHour=0):
+        self.path = path
+        self.budgets = dict(budgets)
+        self.resetHour = resetHour
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._period = None
+        self._used = {}  # project -> calls made this period
+        self._exhausted = set()  # projects ACRCloud has told us are out of calls this period
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS quota (project TEXT NOT NULL, period TEXT NOT NULL, used INTEGER NOT NULL DEFAULT 0, exhausted INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (project, period))')
+        with self._lock:
+            self._rollover()
+
+    # The provider's day that `now` falls in, e.g. '2024-05-01'
+    def _currentPeriod(self, now=None):
+        now = datetime.fromtimestamp(time.time() if now is None else now, timezone.utc)
+        return (now - timedelta(hours=self.resetHour)).strftime('%Y-%m-%d')
+
+    # Load this period's counters, starting from zero when the day has changed
+    def _rollover(self):
+        period = self._currentPeriod()
+        if period == self._period:
+            return
+        if self._period is not None:
+            logger.info(f'SongIDQuota: New quota period {period}, used last period: {self._used}')
+        self._period = period
+        rows = self._db.execute('SELECT project, used, exhausted FROM quota WHERE period = ?', (period,)).fetchall()
+        self._used = {project: used for project, used, exhausted in rows}
+        self._exhausted = {project for project, used, exhausted in rows if exhausted}
+        self._db.execute('DELETE FROM quota WHERE period < ?', ((datetime.strptime(period, '%Y-%m-%d') - timedelta(days=30)).strftime('%Y-%m-%d'),))
+
+    def _save(self, project):
+        self._db.execute(
+            'INSERT OR REPLACE INTO quota (project, period, used, exhausted) VALUES (?, ?, ?, ?)',
+            (project, self._period, self._used.get(project, 0), int(project in self._exhausted))
+        )
+
+    def _spent(self, project):
+        budget = self.budgets.get(project, 0)
+        return project in self._exhausted or (budget > 0 and self._used.get(project, 0) >= budget)
+
+    # Calls the project has left today, None when it has no local budget (does not use one, or count as a rejection)
+    def remaining(self, project):
+        with self._lock:
+            self._rollover()
+            if project in self._exhausted:
+                return 0
+            budget = self.budgets.get(project, 0)
+            return max(0, budget - self._used.get(project, 0)) if budget > 0 else None
+
+    # Use one call from the project's budget. Returns False (and uses nothing) if it is spent.
+    def reserve(self, project):
+        with self._lock:
+            self._rollover()
+            if self._spent(project):
+                self.rejected += 1
+                return False
+            self._used[project] = self._used.get(project, 0) + 1
+            self._save(project)
+            return True
+
+    # ACRCloud answered 3003 (limit exceeded), so stop sending it anything until the next reset
+    def markExhausted(self, project):
+        with self._lock:
+            self._rollover()
+            if project not in self._exhausted:
+                logger.warning(f'SongIDQuota: {project} marked exhausted until the next reset')
+                self._exhausted.add(project)
+                self._save(project)
+
+    # Seconds until the budgets reset
+    def resetsIn(self):
+        now = datetime.now(timezone.utc)
+        reset = now.replace(hour=self.resetHour, minute=0, second=0, microsecond=0)
+        if reset <= now:
+            reset += timedelta(days=1)
+        return int((reset - now).total_seconds())
+
+    def stats(self):
+        with self._lock:
+            self._rollover()
+            projects = {
+                project: {
+                    'used': self._used.get(project, 0),
+                    'budget': budget,
+                    'remaining': max(0, budget - self._used.get(project, 0)) if budget > 0 else None,
+                    'exhausted': self._spent(project)
+                }
+                for project, budget in self.budgets.items()
+            }
+            return {'period': self._period, 'resets_in': self.resetsIn(), 'rejected': self.rejected, 'projects': projects}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Per-key token bucket: each key may burst `burst` requests and earns one more every `interval` seconds.
+# Only the buckets that are not full are kept, so memory follows active users rather than all users.
+class TokenBucket():
+
+    def __init__(self, interval=20, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self._buckets = {}  # key -> (tokens, last updated)
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) / self.interval)
+
+    # Take a token if one is available. Returns (allowed, seconds until the next token).
+    def take(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                self._prune(now)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0
+            self._buckets[key] = (tokens, now)
+            return False, (1 - tokens) * self.interval
+
+    # Seconds until the key has a token again (0 if it has one now)
+    def wait(self, key):
+        now = time.monotonic()
+        with self._lock:
+            return max(0, (1 - self._tokens(key, now)) * self.interval)
+
+    # Drop buckets that have refilled, they behave the same as a missing one
+    def _prune(self, now):
+        full = [key for key in self._buckets if self._tokens(key, now) >= self.burst]
+        for key in full:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
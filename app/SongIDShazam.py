@@ -0,0 +1,111 @@
+# SongID Shazam clients
+# shazamio is asyncio only, while the app/ pipeline recognises files on worker threads. Instead of a
+# new event loop, client and HTTP session for every file, one long-lived event loop thread owns a
+# pool of Shazam clients sharing a keep-alive HTTP session, and worker threads hand it their files.
+#
+#     clients = ShazamClients(shazamio, size=4)
+#     response = clients.recognise(data, timeout=60)  # From any thread
+
+
+import asyncio, concurrent.futures, logging, threading
+from urllib.parse import urlsplit, urlunsplit
+from SongIDPool import AsyncClientPool
+
+
+logger = logging.getLogger(__name__)
+
+
+# HTTP client for shazamio that keeps one aiohttp session (and its connections) alive.
+# apiUrl sends every request to another server instead (test servers, benchmarks).
+class KeepAliveHTTPClient():
+
+    def __init__(self, limitPerHost=4, keepaliveTimeout=300, timeout=30, apiUrl=None):
+        self.limitPerHost = limitPerHost
+        self.keepaliveTimeout = keepaliveTimeout
+        self.timeout = timeout
+        self.apiUrl = urlsplit(apiUrl) if apiUrl else None
+        self._session = None
+
+    # The shared session, created inside the running event loop (aiohttp comes with shazamio)
+    def session(self):
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.limitPerHost, keepalive_timeout=self.keepaliveTimeout),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    # Same interface as shazamio's HTTPClient.request
+    async def request(self, method, url, *args, **kwargs):
+        if self.apiUrl is not None:
+            parts = urlsplit(url)
+            url = urlunsplit((self.apiUrl.scheme, self.apiUrl.netloc, parts.path, parts.query, ''))
+        async with self.session().request(method.upper(), url, *args, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class ShazamClients():
+
+    def __init__(self, shazamio, size=4, idleTimeout=300, apiUrl=None, timeout=30):
+        self.shazamio = shazamio  # The module, or a SongIDLazy.LazyModule standing in for it
+        self.http = KeepAliveHTTPClient(limitPerHost=size, keepaliveTimeout=idleTimeout, timeout=timeout, apiUrl=apiUrl)
+        self.pool = AsyncClientPool(self._create, size=size, idleTimeout=idleTimeout, name='shazam')
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+
+    def _create(self):
+        try:
+            return self.shazamio.Shazam(http_client=self.http)
+        except TypeError:
+            # Older shazamio releases do not accept a custom HTTP client
+            logger.warning('SongIDShazam: shazamio does not support http_client, Shazam connections will not be reused')
+            return self.shazamio.Shazam()
+
+    # The event loop thread, started on first use
+    def _eventLoop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='SongIDShazam', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    async def _recognise(self, data):
+        async with self.pool.borrow() as shazam:
+            return await shazam.recognize(data)
+
+    # Blocking: recognise data (bytes) with a pooled client, from any thread but the loop's own.
+    # Raises TimeoutError after `timeout` seconds, cancelling the request so it doesn't keep a client busy.
+    def recognise(self, data, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(self._recognise(data), self._eventLoop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f'Shazam did not answer within {timeout}s')
+
+    def stop(self, timeout=5):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), loop).result(timeout)
+        except Exception as e:
+            logger.warning(f'SongIDShazam: Failed to close the Shazam session: {e}')
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout)
+
+    async def _close(self):
+        await self.pool.close()
+        await self.http.close()
+
+    def stats(self):
+        return self.pool.stats()
@@ -0,0 +1,213 @@
+# SongID user store
+# Per-user records in SQLite (WAL mode) with batched write-back, replacing the full rewrite
+# of data/userdata.json on every request. Usage totals are kept up to date alongside them
+# (see SongIDAnalytics). With background=True the database is opened (and the JSON imported) on
+# a thread, so start-up doesn't wait for it; methods block until it is ready.
+
+
+import atexit, json, logging, os, sqlite3, threading, time
+from contextlib import contextmanager
+from SongIDAnalytics import Aggregates
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserStore():
+
+    def __init__(self, path, jsonPath=None, flushInterval=2.0, maxPending=500, background=False):
+        self.path = path
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self._pending = {}  # userID -> record waiting to be written
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._ready = threading.Event()
+        self._loadError = None
+        self.loadSeconds = None
+        self.aggregates = None
+        atexit.register(self.close)
+        if background:
+            threading.Thread(target=self._open, args=(jsonPath,), name='UserStoreOpen', daemon=True).start()
+        else:
+            self._open(jsonPath)
+            if self._loadError is not None:
+                raise self._loadError
+
+    def _open(self, jsonPath):
+        start = time.monotonic()
+        try:
+            self._connect(jsonPath)
+        except Exception as e:
+            logger.exception(f'UserStore: Unable to open {self.path}')
+            self._loadError = e
+        else:
+            self.loadSeconds = time.monotonic() - start
+            logger.info(f'UserStore: Ready in {round(self.loadSeconds * 1000)}ms')
+        finally:
+            self._ready.set()
+
+    def _connect(self, jsonPath):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, username TEXT, name TEXT, api_calls INTEGER NOT NULL DEFAULT 0, last_call INTEGER NOT NULL DEFAULT 0)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS users_username ON users (username)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.commit()
+        if jsonPath is not None:
+            self._importJSON(jsonPath)
+        self.aggregates = Aggregates(self._db)
+        self._flusher = threading.Thread(target=self._flushLoop, name='UserStoreFlush', daemon=True)
+        self._flusher.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set() and self._loadError is None
+
+    # Block until the database has been opened, re-raising whatever stopped it from opening
+    def wait(self, timeout=None):
+        if not self._ready.wait(timeout):
+            return False
+        if self._loadError is not None:
+            raise self._loadError
+        return True
+
+    # One-off migration of the old data/userdata.json, skipped once it has been imported
+    def importJSON(self, jsonPath):
+        self.wait()
+        return self._importJSON(jsonPath)
+
+    def _importJSON(self, jsonPath):
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'imported_json'").fetchone():
+                return 0
+            if not os.path.exists(jsonPath):
+                return 0
+            logger.info(f'UserStore: Importing {jsonPath}')
+            with open(jsonPath) as f:
+                userdata = json.load(f)
+            rows = [
+                (userID, data.get('username'), data.get('name'), int(data.get('api_calls', 0)), int(data.get('last_call', 0)))
+                for userID, data in userdata.items()
+            ]
+            self._db.executemany('INSERT OR REPLACE INTO users (id, username, name, api_calls, last_call) VALUES (?, ?, ?, ?, ?)', rows)
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_json', ?)", (str(round(time.time())),))
+            if self.aggregates is not None:
+                self.aggregates.backfill()
+            self._db.commit()
+            logger.info(f'UserStore: Imported {len(rows):,} users')
+            return len(rows)
+
+    def _row(self, row):
+        return {'username': row[0], 'name': row[1], 'api_calls': row[2], 'last_call': row[3]}
+
+    # Return the user's record, or None if we have never seen them
+    def get(self, userID):
+        self.wait()
+        userID = str(userID)
+        with self._lock:
+            if userID in self._pending:
+                return dict(self._pending[userID])
+            row = self._db.execute('SELECT username, name, api_calls, last_call FROM users WHERE id = ?', (userID,)).fetchone()
+        return self._row(row) if row is not None else None
+
+    def __contains__(self, userID):
+        return self.get(userID) is not None
+
+    # Insert or replace the user's record. The write reaches disk within flushInterval seconds.
+    def upsert(self, userID, username, name, apiCalls, lastCall):
+        self.wait()
+        record = {'username': username, 'name': name, 'api_calls': int(apiCalls), 'last_call': int(lastCall)}
+        with self._lock:
+            self.aggregates.userChanged(self.get(userID), record)
+            self._pending[str(userID)] = record
+            if len(self._pending) >= self.maxPending:
+                self._wake.set()
+
+    # Count an API call for the user, reading their record at most once
+    def recordCall(self, userID, username, name, lastCall):
+        self.wait()
+        userID = str(userID)
+        with self._lock:
+            record = self.get(userID)
+            apiCalls = record['api_calls'] + 1 if record is not None else 1
+            self._pending[userID] = {'username': username, 'name': name, 'api_calls': apiCalls, 'last_call': int(lastCall)}
+            self.aggregates.userChanged(record, self._pending[userID])
+            self.aggregates.callMade(userID, lastCall)
+            if len(self._pending) >= self.maxPending:
+                self._wake.set()
+        return apiCalls
+
+    # Hold the store lock so a read-check-upsert on a user can't interleave with another thread's
+    @contextmanager
+    def transaction(self):
+        self.wait()
+        with self._lock:
+            yield self
+
+    # Find a user ID from their username (without the @)
+    def findByUsername(self, username):
+        self.wait()
+        with self._lock:
+            for userID, record in self._pending.items():
+                if record['username'] == username:
+                    return userID
+            row = self._db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Yield (userID, record) for every user without loading them all into memory
+    def iterUsers(self, batchSize=1000):
+        self.flush()
+        lastID = ''
+        while True:
+            with self._lock:
+                rows = self._db.execute('SELECT id, username, name, api_calls, last_call FROM users WHERE id > ? ORDER BY id LIMIT ?', (lastID, batchSize)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row[0], self._row(row[1:])
+            lastID = rows[-1][0]
+
+    def count(self):
+        self.flush()
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    # Write every pending record in a single transaction
+    def flush(self):
+        self.wait()
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            rows = [(userID, r['username'], r['name'], r['api_calls'], r['last_call']) for userID, r in pending.items()]
+            self._db.executemany('INSERT OR REPLACE INTO users (id, username, name, api_calls, last_call) VALUES (?, ?, ?, ?, ?)', rows)
+            self.aggregates.write()
+            self._db.commit()
+        logger.debug(f'UserStore: Flushed {len(rows)} users')
+        return len(rows)
+
+    def _flushLoop(self):
+        while not self._closed:
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        if not self._ready.wait(30) or self._loadError is not None:
+            return
+        self.flush()
+        with self._lock:
+            self._db.close()
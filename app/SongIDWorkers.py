@@ -0,0 +1,156 @@
+# SongID worker pool
+# Runs slow handlers (download + ACRCloud) on a fixed number of threads, so one user's
+# upload no longer holds up everyone else's updates on the dispatcher thread.
+# Updates from the same chat are still handled one at a time, in the order they arrived.
+
+
+import logging, threading, time
+from collections import deque, defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Latency samples for one handler (the last `window` are kept for percentiles)
+class _HandlerStats():
+
+    def __init__(self, window=500):
+        self.calls = 0
+        self.errors = 0
+        self.runSeconds = 0.0
+        self.waitSeconds = 0.0
+        self.maxRun = 0.0
+        self._recent = deque(maxlen=window)
+
+    def record(self, waited, ran, failed):
+        self.calls += 1
+        self.errors += failed
+        self.runSeconds += ran
+        self.waitSeconds += waited
+        self.maxRun = max(self.maxRun, ran)
+        self._recent.append(ran)
+
+    def stats(self):
+        recent = sorted(self._recent)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': round(self.runSeconds / self.calls * 1000, 1) if self.calls else 0.0,
+            'p95_ms': round(recent[int(0.95 * (len(recent) - 1))] * 1000, 1) if recent else 0.0,
+            'max_ms': round(self.maxRun * 1000, 1),
+            'avg_wait_ms': round(self.waitSeconds / self.calls * 1000, 1) if self.calls else 0.0
+        }
+
+
+# Fixed pool of threads with a queue per chat.
+# A chat is only ever worked on by one thread at a time, so its updates keep their order,
+# while different chats are handled in parallel. At most maxQueued jobs may be waiting.
+class ChatWorkerPool():
+
+    def __init__(self, workers=4, maxQueued=500, onError=None, onFull=None, name='SongIDWorker'):
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.onError = onError  # Called with (job args, exception) when a handler raises
+        self.onFull = onFull  # Called with the job args when dispatch() finds the queue full
+        self._chats = {}  # chatID -> deque of (queued at, handler, args) waiting to run
+        self._ready = deque()  # Chats with waiting jobs and no thread working on them
+        self._cond = threading.Condition()
+        self._queued = 0
+        self._running = 0
+        self._stopped = False
+        self.peakQueued = 0
+        self.rejected = 0
+        self._handlers = defaultdict(_HandlerStats)
+        self._threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue handler(*args) behind any earlier jobs from the same chat
+    def submit(self, chatID, handler, *args):
+        with self._cond:
+            if self._queued >= self.maxQueued:
+                self.rejected += 1
+                raise QueueFull(f'{self._queued} jobs already waiting')
+            jobs = self._chats.get(chatID)
+            if jobs is None:
+                # No jobs waiting or running for this chat, so it can be picked up straight away
+                jobs = self._chats[chatID] = deque()
+                self._ready.append(chatID)
+                self._cond.notify()
+            jobs.append((time.monotonic(), handler, args))
+            self._queued += 1
+            self.peakQueued = max(self.peakQueued, self._queued)
+
+    # Wrap a PTB handler so the dispatcher only queues it and moves on to the next update
+    def dispatch(self, handler):
+        def queued(update, context):
+            try:
+                self.submit(update.effective_chat.id, handler, update, context)
+            except QueueFull:
+                if self.onFull is None:
+                    raise
+                self.onFull((update, context))
+        queued.__name__ = handler.__name__
+        return queued
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._ready:
+                    return
+                chatID = self._ready.popleft()
+                queuedAt, handler, args = self._chats[chatID][0]
+                self._queued -= 1
+                self._running += 1
+            start = time.monotonic()
+            failed = False
+            try:
+                handler(*args)
+            except Exception as e:
+                failed = True
+                if self.onError is not None:
+                    try:
+                        self.onError(args, e)
+                    except Exception:
+                        logger.exception(f'SongIDWorkers: Error handler failed for {handler.__name__}')
+                else:
+                    logger.exception(f'SongIDWorkers: {handler.__name__} failed')
+            end = time.monotonic()
+            with self._cond:
+                self._running -= 1
+                self._handlers[handler.__name__].record(start - queuedAt, end - start, failed)
+                jobs = self._chats[chatID]
+                jobs.popleft()
+                if jobs:
+                    # Next update from this chat goes to the back of the line, behind other chats
+                    self._ready.append(chatID)
+                    self._cond.notify()
+                else:
+                    del self._chats[chatID]
+
+    # Let queued jobs finish, then end the threads
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'queued': self._queued,
+                'peak_queued': self.peakQueued,
+                'max_queued': self.maxQueued,
+                'rejected': self.rejected,
+                'chats': len(self._chats),
+                'handlers': {name: handler.stats() for name, handler in self._handlers.items()}
+            }
@@ -0,0 +1,251 @@
+# SongID workspaces
+# A private scratch directory per request instead of temp files in the working directory.
+#  - Directories live under one root, on tmpfs (/dev/shm) when it is available and has room.
+#  - Leaving the with block removes the directory, whatever happened inside it.
+#  - Every open workspace reserves the bytes it expects to write against a global quota; once
+#    the quota is used up, open() raises WorkspaceFull instead of filling the disk.
+#  - A janitor removes directories left behind by processes that died, at start-up and then
+#    every janitorInterval seconds.
+# Only uses the standard library so it can be shared by bot.py and the app/ pipeline.
+#
+#     with workspaces.open('youtube', reserve=50 * 1024 * 1024) as workspace:
+#         download(workspace.file('video.mp4'))
+
+
+import glob, itertools, logging, os, shutil, tempfile, threading, time
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'ws'
+
+
+class WorkspaceFull(Exception):
+    pass
+
+
+# tmpfs if it exists, is writable and has room for the whole quota, otherwise the system temp directory
+def defaultRoot(quota, name='songid'):
+    shm = '/dev/shm'
+    try:
+        if os.path.isdir(shm) and os.access(shm, os.W_OK):
+            stats = os.statvfs(shm)
+            if stats.f_bavail * stats.f_frsize >= quota:
+                return os.path.join(shm, name)
+    except OSError:
+        pass
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def _dirSize(path):
+    total = 0
+    for directory, subdirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Someone else's process
+    return True
+
+
+class Workspace():
+
+    def __init__(self, manager, path, reserved):
+        self.manager = manager
+        self.path = path
+        self.reserved = reserved
+        self.kept = False
+        self.closed = False
+
+    # Path of a file inside the workspace
+    def file(self, name):
+        return os.path.join(self.path, os.path.basename(name) or 'file')
+
+    # Keep the directory after the with block, e.g. while a user finishes a metadata edit.
+    # Its bytes stay counted against the quota until Workspaces.remove(path).
+    def keep(self):
+        self.kept = True
+        return self.path
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.manager._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+        return False
+
+
+class Workspaces():
+
+    def __init__(self, root=None, quota=1024 * 1024 * 1024, orphanAge=3600, janitorInterval=300, legacy=()):
+        self.quota = quota
+        self.root = root or defaultRoot(quota)
+        self.onTmpfs = self.root.startswith('/dev/shm/')
+        self.orphanAge = orphanAge
+        self.janitorInterval = janitorInterval
+        self.legacy = tuple(legacy)  # Globs of scratch files from before workspaces, cleaned up by the janitor
+        self._lock = threading.Lock()
+        self._active = {}  # path -> Workspace
+        self._kept = {}  # path -> bytes held by workspaces kept after their request
+        self._reserved = 0
+        self._counter = itertools.count(1)
+        self._stopped = threading.Event()
+        self._thread = None
+        self.opened = 0
+        self.rejected = 0
+        self.orphansRemoved = 0
+        self.peakBytes = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    # Create a workspace, reserving `reserve` bytes of the quota for it (raises WorkspaceFull)
+    def open(self, name='', reserve=0):
+        with self._lock:
+            used = self._reserved + sum(self._kept.values())
+            if used + reserve > self.quota:
+                self.rejected += 1
+                raise WorkspaceFull(f'{used:,} of {self.quota:,} bytes in use, {reserve:,} more needed')
+            self._reserved += reserve
+            self.peakBytes = max(self.peakBytes, used + reserve)
+            # The pid lets the janitor tell a live process' workspaces from a dead one's
+            path = os.path.join(self.root, f'{PREFIX}_{os.getpid()}_{next(self._counter)}_{name}'.rstrip('_'))
+            workspace = self._active[path] = Workspace(self, path, reserve)
+            self.opened += 1
+        try:
+            os.makedirs(path)
+        except BaseException:
+            self._release(workspace)
+            raise
+        return workspace
+
+    def _release(self, workspace):
+        size = _dirSize(workspace.path) if workspace.kept else 0
+        if not workspace.kept:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+        with self._lock:
+            self._active.pop(workspace.path, None)
+            self._reserved -= workspace.reserved
+            if workspace.kept:
+                self._kept[workspace.path] = size
+
+    # Remove a kept workspace (or any path inside the root) and give its bytes back
+    def remove(self, path):
+        existed = os.path.exists(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif existed:
+            os.remove(path)
+        with self._lock:
+            self._kept.pop(path, None)
+        return existed
+
+    # Mark kept workspaces as still in use, so the janitor doesn't take them for orphans after orphanAge
+    def touch(self, paths):
+        for path in paths:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+    # Remove workspaces left by processes that are gone, kept ones nobody removed within orphanAge,
+    # and legacy scratch files. Returns how many were removed.
+    def clean(self):
+        now = time.time()
+        removed = 0
+        try:
+            entries = os.listdir(self.root)
+        except FileNotFoundError:
+            os.makedirs(self.root, exist_ok=True)
+            entries = []
+        for entry in entries:
+            path = os.path.join(self.root, entry)
+            parts = entry.split('_')
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if parts[0] == PREFIX and len(parts) > 2 and parts[1].isdigit():
+                pid = int(parts[1])
+                if pid == os.getpid():
+                    # Checked now rather than from a snapshot, workspaces open while we go through the list
+                    with self._lock:
+                        orphan = path not in self._active and (path not in self._kept or age > self.orphanAge)
+                else:
+                    orphan = not _pidAlive(pid)
+                if orphan:
+                    self.remove(path)
+                    removed += 1
+            elif os.path.isdir(path):
+                # A shared directory such as the spill directory: only its old files go
+                removed += self._removeOld(os.path.join(path, '*'), now)
+            elif age > self.orphanAge:
+                self.remove(path)
+                removed += 1
+        for pattern in self.legacy:
+            removed += self._removeOld(pattern, now)
+        with self._lock:
+            self._kept = {path: size for path, size in self._kept.items() if os.path.exists(path)}
+            self.orphansRemoved += removed
+        if removed:
+            logger.info(f'SongIDWorkspace: Removed {removed} orphaned workspaces from {self.root}')
+        return removed
+
+    def _removeOld(self, pattern, now):
+        removed = 0
+        for path in glob.glob(pattern):
+            try:
+                if now - os.path.getmtime(path) > self.orphanAge:
+                    self.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _run(self):
+        while not self._stopped.wait(self.janitorInterval):
+            try:
+                self.clean()
+            except Exception as e:
+                logger.exception(e)
+
+    # Clean up once now, then every janitorInterval seconds on a background thread
+    def startJanitor(self):
+        self.clean()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='SongIDWorkspaceJanitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            kept = sum(self._kept.values())
+            return {
+                'root': self.root,
+                'tmpfs': self.onTmpfs,
+                'active': len(self._active),
+                'kept': len(self._kept),
+                'reserved_bytes': self._reserved,
+                'kept_bytes': kept,
+                'quota_bytes': self.quota,
+                'peak_bytes': self.peakBytes,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'orphans_removed': self.orphansRemoved,
+            }
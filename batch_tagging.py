@@ -0,0 +1,196 @@
+import asyncio
+import io
+import logging
+import os
+import re
+import shutil
+import time
+import zipfile
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import tagging
+
+logger = logging.getLogger(__name__)
+
+# "3. Intro", "3) Title: Intro; Artist: Someone", "3 - Intro"
+_TRACK_LINE = re.compile(r'^\s*(\d+)\s*[.):\-]\s*(.*)$')
+
+
+class BatchTooLarge(Exception):
+    """Raised when a zip has more files or bytes than a batch may hold"""
+
+
+def parse_batch_metadata(text: str) -> Tuple[Dict[str, str], Dict[int, Dict[str, str]]]:
+    """Split a batch's metadata message into fields shared by every track and per-track overrides.
+
+    `Field: value` lines apply to every track; lines starting with a track number
+    (`3. Title: Intro; Artist: Someone`, or just `3. Intro` for the title) only to
+    that track. Values may use {n} (track number), {total} and {name} (file name
+    without its extension), e.g. `Track: {n}/{total}` or `Title: {name}`.
+    """
+    shared, overrides = {}, {}
+    for line in text.splitlines():
+        match = _TRACK_LINE.match(line)
+        if match:
+            fields = {}
+            for part in match.group(2).split(';'):
+                key, separator, value = part.partition(':')
+                if separator:
+                    fields[key] = value
+                elif part.strip():
+                    fields['title'] = part
+            overrides.setdefault(int(match.group(1)), {}).update(tagging.normalize_fields(fields))
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            shared[key] = value
+    return tagging.normalize_fields(shared), overrides
+
+
+class _Placeholders(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def track_fields(shared: Dict[str, str], overrides: Dict[int, Dict[str, str]], number: int, total: int, file_name: str) -> Dict[str, str]:
+    """The fields for track `number` (1-based) of `total`, with the placeholders filled in"""
+    fields = dict(shared)
+    fields.update(overrides.get(number, {}))
+    values = _Placeholders(n=number, total=total, name=os.path.splitext(file_name)[0])
+    for key, value in fields.items():
+        try:
+            fields[key] = value.format_map(values)
+        except (ValueError, IndexError, AttributeError):
+            pass  # Stray braces, keep the value as it was written
+    return fields
+
+
+def _natural_key(name: str):
+    """Sort '2 Song' before '10 Song'"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def _audio_members(archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    """The audio files tagging supports in a zip, in natural name order"""
+    members = [
+        member for member in archive.infolist()
+        if not member.is_dir()
+        and not member.filename.startswith('__MACOSX/')
+        and not os.path.basename(member.filename).startswith('.')
+        and os.path.splitext(member.filename)[1].lower() in tagging.EXTENSIONS
+    ]
+    return sorted(members, key=lambda member: _natural_key(member.filename))
+
+
+def _extract(archive: zipfile.ZipFile, members: List[zipfile.ZipInfo], directory: str) -> List[Tuple[str, str, int]]:
+    extracted = []
+    names = set()
+    for member in members:
+        # Only the base name is used, so entries can't write outside the directory
+        name = os.path.basename(member.filename)
+        stem, extension = os.path.splitext(name)
+        copy = 2
+        while name.lower() in names:
+            name = f'{stem} ({copy}){extension}'
+            copy += 1
+        names.add(name.lower())
+        path = os.path.join(directory, name)
+        with archive.open(member) as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        extracted.append((path, name, member.file_size))
+    return extracted
+
+
+def save_upload(workspaces, data: bytes, file_name: str, max_files: int, max_bytes: int) -> Tuple[str, List[Tuple[str, str, int]]]:
+    """Blocking: keep an uploaded file, or the audio files in an uploaded zip, in a workspace of their own.
+
+    Returns the workspace's path and (path, file name, size) for each file. Raises
+    BatchTooLarge if that would be more than max_files files or max_bytes bytes
+    (checked from the zip's directory before anything is extracted; zipfile stops
+    each entry at its declared size, so this holds for zip bombs too), and
+    tagging.UnsupportedFormat for anything tagging can't edit.
+    """
+    if data[:4] == b'PK\x03\x04':
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        members = _audio_members(archive)
+        if not members:
+            raise tagging.UnsupportedFormat(f"No audio files in {file_name}")
+        if len(members) > max_files:
+            raise BatchTooLarge(f"{len(members)} audio files, at most {max_files} allowed")
+        total = sum(member.file_size for member in members)
+        if total > max_bytes:
+            raise BatchTooLarge(f"{total:,} bytes uncompressed, at most {max_bytes:,} allowed")
+        with workspaces.open('album', reserve=total) as workspace:
+            files = _extract(archive, members, workspace.path)
+            workspace.keep()
+        return workspace.path, files
+
+    if tagging.detect_format(data[:64], file_name) is None:
+        raise tagging.UnsupportedFormat(f"Can't tag {file_name}")
+    if max_files < 1 or len(data) > max_bytes:
+        raise BatchTooLarge(f"No room for {file_name} ({len(data):,} bytes)")
+    with workspaces.open('album', reserve=len(data)) as workspace:
+        path = workspace.file(file_name)
+        with open(path, 'wb') as target:
+            target.write(data)
+        workspace.keep()
+    return workspace.path, [(path, os.path.basename(path), len(data))]
+
+
+class ThrottledEditor:
+    """Keeps one status message showing the latest progress text, editing it at most once every `interval` seconds.
+
+    Telegram limits how often a message can be edited, and a batch can finish a
+    track every few milliseconds, so updates in between are coalesced: update()
+    edits straight away if the last edit is old enough, otherwise it schedules a
+    single edit for when it is, which shows whatever text is newest by then.
+    """
+
+    def __init__(self, edit: Callable[[str], Awaitable], interval: float = 3.0):
+        self._edit = edit
+        self.interval = interval
+        self._text: Optional[str] = None
+        self._shown: Optional[str] = None
+        self._last = 0.0
+        self._pending: Optional[asyncio.Task] = None
+        self.edits = 0
+        self.skipped = 0
+
+    def update(self, text: str):
+        self._text = text
+        if self._pending is not None:
+            self.skipped += 1
+            return
+        delay = max(self._last + self.interval - time.monotonic(), 0)
+        self._pending = asyncio.get_running_loop().create_task(self._flush(delay))
+
+    async def _send(self, text: str):
+        self._last = time.monotonic()
+        self._shown = text  # Even if the edit fails, so a deleted message isn't retried forever
+        try:
+            await self._edit(text)
+            self.edits += 1
+        except Exception as e:
+            # e.g. the user deleted the message; progress is best effort
+            logger.warning(f"Progress edit failed: {e}")
+
+    async def _flush(self, delay: float):
+        # Stays pending for an interval after each edit, so updates in that time are coalesced into the next one
+        try:
+            while True:
+                if delay:
+                    await asyncio.sleep(delay)
+                if self._text == self._shown:
+                    return
+                await self._send(self._text)
+                delay = self.interval
+        finally:
+            self._pending = None
+
+    async def finish(self, text: str):
+        """Show the final text now, dropping any edit still waiting"""
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._text = text
+        if text != self._shown:
+            await self._send(text)
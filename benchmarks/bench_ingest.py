@@ -0,0 +1,164 @@
+"""Compare update throughput of long polling and the webhook server.
+
+Runs entirely offline against benchmarks/fake_telegram.py. For each mode and rate,
+updates are generated at a steady rate for --duration seconds. A minimal bot echoes
+every update after --work-ms of simulated (non-blocking) handler work. The script
+reports replies per second and update -> reply latency.
+
+Polling mode queues updates on the fake server for bot.polling() to fetch.
+Webhook mode POSTs them to a WebhookServer over up to --connections parallel
+connections, like Telegram's max_connections.
+
+    python benchmarks/bench_ingest.py --rates 100 1000 --duration 10 --json ingest.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from fake_telegram import FakeTelegram
+from webhook_server import SECRET_HEADER, WebhookServer
+
+SECRET = 'bench-secret'
+
+
+def make_bot(fake, work_ms):
+    asyncio_helper.API_URL = fake.api_url
+    bot = AsyncTeleBot(fake.token)
+
+    @bot.message_handler(func=lambda message: True)
+    async def echo(message):
+        await asyncio.sleep(work_ms / 1000)
+        await bot.send_message(message.chat.id, message.text)
+
+    return bot
+
+
+async def generate(rate, duration, chats, emit):
+    """Call emit(i) for rate * duration updates, spread evenly over duration seconds"""
+    total = int(rate * duration)
+    start = time.perf_counter()
+    for i in range(total):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        emit(i % chats)
+    return total
+
+
+async def drain(fake, total, timeout):
+    """Wait until every update has been answered, or timeout seconds pass"""
+    deadline = time.perf_counter() + timeout
+    while len(fake.replied) < total and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_polling(fake, args, rate):
+    bot = make_bot(fake, args.work_ms)
+    poller = asyncio.create_task(bot.polling(non_stop=True, interval=0, timeout=1))
+    total = await generate(rate, args.duration, args.chats, lambda chat: fake.push(fake.make_update(1000 + chat)))
+    await drain(fake, total, args.drain)
+    bot.stop_polling()
+    await asyncio.wait_for(poller, 5)
+    await bot.close_session()
+    return total, {}
+
+
+async def run_webhook(fake, args, rate):
+    bot = make_bot(fake, args.work_ms)
+    server = WebhookServer(bot, '/webhook', SECRET, args.max_in_flight)
+    await server.start('127.0.0.1', args.webhook_port)
+    url = f'http://127.0.0.1:{args.webhook_port}/webhook'
+    posts = set()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as session:
+
+        async def post(update):
+            async with session.post(url, json=update, headers={SECRET_HEADER: SECRET}) as response:
+                response.raise_for_status()
+
+        def emit(chat):
+            task = asyncio.create_task(post(fake.make_update(1000 + chat)))
+            posts.add(task)
+            task.add_done_callback(posts.discard)
+
+        total = await generate(rate, args.duration, args.chats, emit)
+        if posts:
+            await asyncio.wait(set(posts), timeout=args.drain)
+        await drain(fake, total, args.drain)
+    await server.stop()
+    await bot.close_session()
+    return total, server.stats()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+
+async def bench(mode, rate, args):
+    fake = FakeTelegram()
+    await fake.start()
+    try:
+        runner = run_polling if mode == 'polling' else run_webhook
+        started = time.perf_counter()
+        total, server_stats = await runner(fake, args, rate)
+    finally:
+        await fake.stop()
+    latencies = [(fake.replied[i] - fake.created[i]) * 1000 for i in fake.replied]
+    finished = max(fake.replied.values(), default=started)
+    row = {
+        'mode': mode,
+        'rate': rate,
+        'updates': total,
+        'replied': len(fake.replied),
+        'throughput': round(len(fake.replied) / (finished - started), 1) if fake.replied else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        'get_updates_calls': fake.calls['getUpdates'],
+    }
+    if server_stats:
+        row['webhook'] = server_stats
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', choices=['polling', 'webhook'], default=['polling', 'webhook'])
+    parser.add_argument('--rates', nargs='+', type=int, default=[100, 1000], help='updates per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per run')
+    parser.add_argument('--drain', type=float, default=60, help='seconds to wait for the backlog afterwards')
+    parser.add_argument('--work-ms', type=float, default=50, help='simulated handler time per update')
+    parser.add_argument('--chats', type=int, default=50, help='distinct chats the updates come from')
+    parser.add_argument('--connections', type=int, default=40, help='parallel webhook connections')
+    parser.add_argument('--max-in-flight', type=int, default=256)
+    parser.add_argument('--webhook-port', type=int, default=8444)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    rows = []
+    for rate in args.rates:
+        for mode in args.modes:
+            row = asyncio.run(bench(mode, rate, args))
+            rows.append(row)
+            print(f"{row['mode']:>8} @ {row['rate']:>5}/s: {row['replied']:,}/{row['updates']:,} replied, "
+                  f"{row['throughput']:.0f}/s, latency p50 {row['p50_ms']} ms, p95 {row['p95_ms']} ms, "
+                  f"p99 {row['p99_ms']} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""End-to-end load test of bot.py or app/SongID.py against local fake services.
+
+Starts a fake Bot API (benchmarks/fake_telegram.py), fake Shazam and ACRCloud
+servers (benchmarks/fake_services.py) and the bot itself as a subprocess
+pointed at them. It then replays a mixed workload at a steady rate:
+- media: audio uploads, from a pool of --distinct-files files
+- voice: voice messages
+- link: plain download links
+- inline: inline queries
+
+Every update comes from a different user, so each response can be matched to
+the update it answers. The script reports, per handler:
+- throughput;
+- time to first response;
+- p50/p95/p99 time to last response, which includes edits of a status message.
+
+It also reports the bot's peak RSS and open file descriptors (Linux /proc).
+Results are written to --json so runs can be compared between versions.
+
+    python benchmarks/bench_load.py --target bot --rate 20 --duration 30 --json load-bot.json
+    python benchmarks/bench_load.py --target app --mix media=0.7,voice=0.3 --acr-latency-ms 800
+    python benchmarks/bench_load.py --target ingress --workers 4 --rate 80  # bot.py behind ingress.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import FakeACR, FakeShazam
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = {'bot': 'media=0.6,link=0.2,inline=0.2', 'ingress': 'media=0.6,link=0.2,inline=0.2', 'app': 'media=0.7,voice=0.3'}
+QUERIES = ['love', 'night', 'dance', 'summer', 'heart', 'rain', 'fire', 'dream', 'blue', 'home']
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in ('media', 'voice', 'link', 'inline'):
+            raise argparse.ArgumentTypeError(f'unknown workload {kind!r}')
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+class ProcessMonitor:
+    """Samples a process' RSS and open file descriptors from /proc, keeping the peaks.
+
+    Child processes (ingress.py's workers) are included: each one's peak RSS is
+    kept and summed, and their open file descriptors are added to the parent's.
+    """
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = None
+        self.peak_fds = None
+        self.samples = 0
+        self._peaks = {}  # pid -> peak RSS in kB
+
+    def _children(self, pid):
+        try:
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                children = [int(child) for child in f.read().split()]
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return []
+        return children + [grandchild for child in children for grandchild in self._children(child)]
+
+    def sample(self):
+        fds = 0
+        for pid in [self.pid] + self._children(self.pid):
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):  # Peak resident set size
+                            self._peaks[pid] = int(line.split()[1])
+                fds += len(os.listdir(f'/proc/{pid}/fd'))
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                continue
+        if self._peaks:
+            self.peak_rss_kb = sum(self._peaks.values())
+            self.peak_fds = max(self.peak_fds or 0, fds)
+            self.samples += 1
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+def target_process(args, telegram, shazam, acr, workdir):
+    """argv, cwd and environment to run the chosen bot against the fakes"""
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    if args.target in ('bot', 'ingress'):
+        env.update({
+            'BOT_TOKEN': telegram.token,
+            'TELEGRAM_API_URL': telegram.base_url,
+            'SHAZAM_API_URL': shazam.base_url,
+            'CACHE_PATH': os.path.join(workdir, 'recognition_cache.sqlite'),
+            'MEDIA_CACHE_PATH': os.path.join(workdir, 'media_cache.sqlite'),
+            'SPILL_DIR': workdir,
+            'WEBHOOK_URL': '',
+        })
+        if args.target == 'ingress':
+            env['STATE_STORE'] = f"sqlite:{os.path.join(workdir, 'state.sqlite')}"
+            return [sys.executable, os.path.join(ROOT, 'ingress.py'), '--workers', str(args.workers)], workdir, env
+        return [sys.executable, os.path.join(ROOT, 'bot.py')], workdir, env
+    acr_host = f'127.0.0.1:{acr.port}'
+    env.update({
+        'SONGID_ENVIRONMENT': 'development',  # No Sentry
+        'SONGID_LOG_LEVEL': 'WARNING',
+        'SONGID_TELEGRAM_BOT_TOKEN': telegram.token,
+        'SONGID_TELEGRAM_DEV_ID': '1',
+        'SONGID_TELEGRAM_DEV_USERNAME': 'dev',
+        'SONGID_TELEGRAM_API_URL': telegram.base_url,
+        'SONGID_ACR_PING_URL': acr.base_url,
+        'SONGID_SHAZAM_API_URL': shazam.base_url,
+        'SONGID_CACHE_PATH': os.path.join(workdir, 'recognition_cache.sqlite'),
+        'SONGID_STORE_PATH': os.path.join(workdir, 'userdata.sqlite'),
+        'SONGID_QUOTA_PATH': os.path.join(workdir, 'quota.sqlite'),
+        'SONGID_WEBHOOK_URL': '',
+    })
+    for project in ('CLEAR', 'NOISY', 'HUM'):
+        env.update({
+            f'SONGID_ACR_{project}_HOST': acr_host,
+            f'SONGID_ACR_{project}_ACCESS_KEY': 'fake',
+            f'SONGID_ACR_{project}_ACCESS_SECRET': 'fake',
+            f'SONGID_ACR_{project}_TIMEOUT': '30',
+        })
+    return [sys.executable, 'SongID.py'], os.path.join(ROOT, 'app'), env
+
+
+async def wait_ready(telegram, process, timeout):
+    """The bot is ready once it starts polling for updates"""
+    deadline = time.perf_counter() + timeout
+    while telegram.calls['getUpdates'] == 0:
+        if process.returncode is not None:
+            raise RuntimeError(f'bot exited with code {process.returncode} before polling')
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f'bot did not start polling within {timeout}s')
+        await asyncio.sleep(0.1)
+
+
+def make_update(telegram, kind, user_id, rng, args):
+    """Build one update of the given kind; returns (update, response key)"""
+    if kind in ('media', 'voice'):
+        file_unique_id = f'file{rng.randrange(args.distinct_files)}'
+        update = telegram.make_media_update(user_id, file_unique_id, 'audio' if kind == 'media' else 'voice')
+        return update, user_id
+    if kind == 'link':
+        update = telegram.make_update(user_id, telegram.media_url(f'clip{rng.randrange(args.distinct_files)}.wav'))
+        return update, user_id
+    update = telegram.make_inline_update(user_id, rng.choice(QUERIES))
+    return update, update['inline_query']['id']
+
+
+async def generate(telegram, args, sent):
+    """Push updates at --rate for --duration seconds; sent gets (kind, key, created) per update"""
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+    for i in range(total):
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        update, key = make_update(telegram, kind, 100000 + i, rng, args)
+        sent.append((kind, key, time.perf_counter()))
+        telegram.push(update)
+
+
+async def drain(telegram, sent, args):
+    """Wait until every update has a response and no response has arrived for --settle seconds"""
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline:
+        answered = all(telegram.responses.get(key) for kind, key, created in sent)
+        last = max((times[-1] for times in telegram.responses.values() if times), default=0)
+        if answered and time.perf_counter() - last >= args.settle:
+            return
+        await asyncio.sleep(0.1)
+
+
+def summarise(telegram, sent):
+    handlers = {}
+    first_created = min((created for kind, key, created in sent), default=0)
+    last_response = first_created
+    for kind in sorted({kind for kind, key, created in sent}):
+        first, last, unanswered = [], [], 0
+        for sent_kind, key, created in sent:
+            if sent_kind != kind:
+                continue
+            times = telegram.responses.get(key)
+            if not times:
+                unanswered += 1
+                continue
+            first.append(times[0] - created)
+            last.append(times[-1] - created)
+            last_response = max(last_response, times[-1])
+        handlers[kind] = {
+            'updates': len(first) + unanswered,
+            'answered': len(first),
+            'unanswered': unanswered,
+            'first_response_p50_ms': ms(percentile(first, 50)),
+            'p50_ms': ms(percentile(last, 50)),
+            'p95_ms': ms(percentile(last, 95)),
+            'p99_ms': ms(percentile(last, 99)),
+            'max_ms': ms(max(last, default=None)),
+        }
+    answered = sum(handler['answered'] for handler in handlers.values())
+    span = last_response - first_created
+    return handlers, round(answered / span, 2) if span > 0 else 0.0
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    telegram = FakeTelegram()
+    shazam = FakeShazam(latency_ms=args.shazam_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.shazam_error_rate, match_rate=args.match_rate, seed=args.seed)
+    acr = FakeACR(latency_ms=args.acr_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.acr_error_rate, match_rate=args.match_rate, limit_after=args.acr_limit_after, seed=args.seed)
+    for service in (telegram, shazam, acr):
+        await service.start()
+
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    log_path = os.path.join(workdir, f'{args.target}.log')
+    argv, cwd, env = target_process(args, telegram, shazam, acr, workdir)
+    sent = []
+    with open(log_path, 'wb') as log:
+        process = await asyncio.create_subprocess_exec(*argv, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        monitor = ProcessMonitor(process.pid)
+        sampler = asyncio.create_task(monitor.run())
+        try:
+            await wait_ready(telegram, process, args.startup_timeout)
+            started = time.perf_counter()
+            await generate(telegram, args, sent)
+            await drain(telegram, sent, args)
+            elapsed = time.perf_counter() - started
+            monitor.sample()
+        finally:
+            sampler.cancel()
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 10)
+                except asyncio.TimeoutError:
+                    process.kill()
+            for service in (telegram, shazam, acr):
+                await service.stop()
+
+    handlers, throughput = summarise(telegram, sent)
+    return {
+        'target': args.target,
+        'version': git_version(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'elapsed_seconds': round(elapsed, 2),
+        'updates': len(sent),
+        'throughput': throughput,
+        'handlers': handlers,
+        'peak_rss_mb': round(monitor.peak_rss_kb / 1024, 1) if monitor.peak_rss_kb else None,
+        'peak_fds': monitor.peak_fds,
+        'telegram_calls': dict(telegram.calls),
+        'telegram_download_bytes': telegram.downloaded_bytes,
+        'shazam_calls': shazam.stats(),
+        'acr_calls': acr.stats(),
+        'log': log_path,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=['bot', 'ingress', 'app'], default='bot', help='bot.py, bot.py worker processes behind ingress.py, or app/SongID.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='worker processes for --target ingress')
+    parser.add_argument('--mix', type=parse_mix, help='workload weights, e.g. media=0.6,link=0.2,inline=0.2')
+    parser.add_argument('--rate', type=float, default=10, help='updates per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--distinct-files', type=int, default=50, help='different files/links the load is drawn from')
+    parser.add_argument('--shazam-latency-ms', type=float, default=300)
+    parser.add_argument('--acr-latency-ms', type=float, default=500)
+    parser.add_argument('--jitter-ms', type=float, default=200, help='random extra latency for both services')
+    parser.add_argument('--shazam-error-rate', type=float, default=0.0)
+    parser.add_argument('--acr-error-rate', type=float, default=0.0)
+    parser.add_argument('--acr-limit-after', type=int, help='answer 3003 after this many ACRCloud calls')
+    parser.add_argument('--match-rate', type=float, default=0.9)
+    parser.add_argument('--drain', type=float, default=120, help='seconds to wait for the backlog afterwards')
+    parser.add_argument('--settle', type=float, default=2, help='quiet seconds that mean the bot is done')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    if args.mix is None:
+        args.mix = parse_mix(DEFAULT_MIX[args.target])
+
+    result = asyncio.run(run(args))
+
+    print(f"{result['target']} @ {args.rate}/s for {args.duration}s: {result['updates']:,} updates, "
+          f"{result['throughput']}/s answered, peak RSS {result['peak_rss_mb']} MB, peak FDs {result['peak_fds']}")
+    for kind, handler in result['handlers'].items():
+        print(f"    {kind:>6}: {handler['answered']:,}/{handler['updates']:,} answered, "
+              f"p50 {handler['p50_ms']} ms, p95 {handler['p95_ms']} ms, p99 {handler['p99_ms']} ms")
+    print(f"    log: {result['log']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Measure what SongIDMetrics instrumentation costs per stage, enabled and disabled.
+
+Times an empty `with metrics.stage(...)` block (the overhead added to every instrumented
+stage) and a counter increment, next to an empty loop as the baseline.
+
+    python benchmarks/bench_metrics.py --iterations 1000000 --json metrics.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.SongIDMetrics import Metrics
+
+
+def per_call_ns(fn, iterations):
+    start = time.perf_counter()
+    fn(iterations)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def baseline(iterations):
+    for _ in range(iterations):
+        pass
+
+
+def stages(metrics):
+    def run(iterations):
+        for _ in range(iterations):
+            with metrics.stage('download_file', handler='media', provider='telegram') as timer:
+                timer.outcome = 'ok'
+    return run
+
+
+def counts(metrics):
+    def run(iterations):
+        for _ in range(iterations):
+            metrics.count('requests_total', handler='media', outcome='match')
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500000)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    base = per_call_ns(baseline, args.iterations)
+    result = {'iterations': args.iterations, 'baseline_ns': round(base, 1)}
+    for enabled in (False, True):
+        metrics = Metrics(enabled=enabled)
+        label = 'enabled' if enabled else 'disabled'
+        result[f'stage_{label}_ns'] = round(per_call_ns(stages(metrics), args.iterations) - base, 1)
+        result[f'count_{label}_ns'] = round(per_call_ns(counts(metrics), args.iterations) - base, 1)
+
+    for name, value in result.items():
+        print(f'{name:>20}: {value}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
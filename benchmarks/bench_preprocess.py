@@ -0,0 +1,146 @@
+"""Benchmark the decode-and-trim pre-processing stage.
+
+Compares the bytes that would be sent to the recogniser and the time spent, with and
+without SongIDPreprocess, for the given files (or, when none are given, a synthetic 720p
+video saved both with its moov atom first and, like most phone recordings, at the end).
+Pass --shazam and/or the --acr-* options to also time real recognition requests.
+
+    python benchmarks/bench_preprocess.py clip1.mp4 voice.ogg --runs 5 --json preprocess.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import SongIDPreprocess
+from app.SongIDWorkspace import Workspaces
+
+
+def synthesise_video(seconds=60, faststart=True):
+    """Render a test video with a tone, roughly the shape of a screen recording.
+    Without faststart the moov atom is written after the media data, so ffmpeg can't read it from a pipe."""
+    fd, path = tempfile.mkstemp(suffix='.mp4', prefix='bench_faststart_' if faststart else 'bench_moov_end_')
+    os.close(fd)
+    subprocess.run([
+        SongIDPreprocess.FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={seconds}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={seconds}',
+        '-ac', '2', '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac', '-shortest',
+        *(['-movflags', '+faststart'] if faststart else []), path
+    ], check=True)
+    return path
+
+
+def timed(fn, runs):
+    """Run fn several times and return (last result, median seconds)"""
+    timings = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings)
+
+
+def time_shazam(buf, runs):
+    from shazamio import Shazam
+
+    async def recognize():
+        return await Shazam().recognize(buf)
+
+    return timed(lambda: asyncio.run(recognize()), runs)[1]
+
+
+def time_acr(buf, args, runs):
+    from acrcloud.recognizer import ACRCloudRecognizer, ACRCloudRecognizeType
+    recognizer = ACRCloudRecognizer({
+        'host': args.acr_host,
+        'access_key': args.acr_key,
+        'access_secret': args.acr_secret,
+        'recognize_type': ACRCloudRecognizeType.ACR_OPT_REC_AUDIO,
+        'debug': False,
+        'timeout': 30
+    })
+    return timed(lambda: recognizer.recognize_by_filebuffer(buf, 0, args.seconds), runs)[1]
+
+
+def bench_file(path, args, workspaces):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    prepared, prepare_time = timed(
+        lambda: SongIDPreprocess.prepare(raw, args.start, args.seconds, args.sample_rate, workspaces=workspaces), args.runs
+    )
+    row = {
+        'file': os.path.basename(path),
+        'needs_seek': SongIDPreprocess.needsSeek(raw),
+        'decoded': prepared is not raw,  # False when ffmpeg failed and the upload would be sent as it is
+        'raw_bytes': len(raw),
+        'prepared_bytes': len(prepared),
+        'reduction': round(len(raw) / len(prepared), 2) if prepared else None,
+        'prepare_seconds': round(prepare_time, 4),
+    }
+    if args.shazam:
+        row['shazam_raw_seconds'] = round(time_shazam(raw, args.runs), 4)
+        row['shazam_prepared_seconds'] = round(time_shazam(prepared, args.runs) + prepare_time, 4)
+    if args.acr_host:
+        row['acr_raw_seconds'] = round(time_acr(raw, args, args.runs), 4)
+        row['acr_prepared_seconds'] = round(time_acr(prepared, args, args.runs) + prepare_time, 4)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='audio/video files to benchmark')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--start', type=float, default=0)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--sample-rate', type=int, default=16000)
+    parser.add_argument('--shazam', action='store_true', help='also time Shazam recognition (needs network)')
+    parser.add_argument('--acr-host')
+    parser.add_argument('--acr-key')
+    parser.add_argument('--acr-secret')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    if not SongIDPreprocess.available():
+        sys.exit('ffmpeg was not found on PATH, nothing to compare')
+
+    files = args.files
+    synthetic = []
+    if not files:
+        synthetic = [synthesise_video(faststart=True), synthesise_video(faststart=False)]
+        files = synthetic
+
+    # Where MP4s that can't be read from a pipe are written, as in the bot
+    workspaces = Workspaces(root=tempfile.mkdtemp(prefix='bench_workspaces_'))
+    try:
+        rows = [bench_file(path, args, workspaces) for path in files]
+    finally:
+        for path in synthetic:
+            os.remove(path)
+        shutil.rmtree(workspaces.root, ignore_errors=True)
+
+    for row in rows:
+        print(f"{row['file']}: {row['raw_bytes']:,} -> {row['prepared_bytes']:,} bytes "
+              f"({row['reduction']}x smaller) in {row['prepare_seconds'] * 1000:.1f} ms"
+              f"{' (needs seeking)' if row['needs_seek'] else ''}{'' if row['decoded'] else ', NOT DECODED'}")
+        for provider in ('shazam', 'acr'):
+            if f'{provider}_raw_seconds' in row:
+                print(f"    {provider}: {row[f'{provider}_raw_seconds']:.3f}s raw, "
+                      f"{row[f'{provider}_prepared_seconds']:.3f}s prepared (including decode)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Cold-start benchmark of bot.py or app/SongID.py against local fake services.
+
+Starts the bot as a fresh subprocess --runs times, pointed at the fake Bot API
+and fake Shazam/ACRCloud servers from bench_load.py. For each run it measures:
+- time until the bot first polls getUpdates (ready to receive updates);
+- time until it answers a /start pushed as soon as it starts polling;
+- RSS at that point.
+
+It reports the median/min/max over the runs. With --acr-down, the fake
+ACRCloud is unreachable, to check that start-up doesn't wait on provider
+readiness checks. Results are written to --json so runs can be compared
+between versions.
+
+    python benchmarks/bench_startup.py --target bot --runs 10 --json startup-bot.json
+    python benchmarks/bench_startup.py --target app --acr-down
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_load import ProcessMonitor, git_version, ms, target_process
+from fake_services import FakeACR, FakeShazam
+from fake_telegram import FakeTelegram
+
+CHAT_ID = 4242
+
+
+async def first_response(telegram, process, key, deadline):
+    while not telegram.responses.get(key):
+        if process.returncode is not None:
+            raise RuntimeError(f'bot exited with code {process.returncode}')
+        if time.perf_counter() > deadline:
+            return None
+        await asyncio.sleep(0.01)
+    return telegram.responses[key][0]
+
+
+async def cold_start(args, run_index):
+    """Start the bot once; returns the timings of this run"""
+    telegram = FakeTelegram()
+    shazam = FakeShazam(latency_ms=0, jitter_ms=0)
+    acr = FakeACR(latency_ms=0, jitter_ms=0)
+    for service in (telegram, shazam, acr):
+        await service.start()
+    if args.acr_down:
+        await acr.stop()  # Its URL now refuses connections
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    log_path = os.path.join(workdir, f'{args.target}.log')
+    argv, cwd, env = target_process(args, telegram, shazam, acr, workdir)
+    with open(log_path, 'wb') as log:
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*argv, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        monitor = ProcessMonitor(process.pid)
+        try:
+            deadline = started + args.timeout
+            while telegram.calls['getUpdates'] == 0:
+                if process.returncode is not None:
+                    raise RuntimeError(f'bot exited with code {process.returncode} before polling, see {log_path}')
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f'bot did not start polling within {args.timeout}s, see {log_path}')
+                await asyncio.sleep(0.005)
+            polling = time.perf_counter()
+            telegram.push(telegram.make_update(CHAT_ID, '/start'))
+            answered = await first_response(telegram, process, CHAT_ID, deadline)
+            monitor.sample()
+        finally:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 10)
+                except asyncio.TimeoutError:
+                    process.kill()
+            for service in (telegram, shazam) if args.acr_down else (telegram, shazam, acr):
+                await service.stop()
+
+    result = {
+        'run': run_index,
+        'ready_ms': ms(polling - started),
+        'first_response_ms': ms(answered - started) if answered is not None else None,
+        'rss_mb': round(monitor.peak_rss_kb / 1024, 1) if monitor.peak_rss_kb else None,
+        'log': log_path,
+    }
+    print(f"    run {run_index}: polling after {result['ready_ms']} ms, /start answered after {result['first_response_ms']} ms, RSS {result['rss_mb']} MB")
+    return result
+
+
+def spread(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'median': round(statistics.median(values), 1), 'min': min(values), 'max': max(values)}
+
+
+async def run(args):
+    runs = [await cold_start(args, i + 1) for i in range(args.runs)]
+    return {
+        'target': args.target,
+        'version': git_version(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'ready_ms': spread([r['ready_ms'] for r in runs]),
+        'first_response_ms': spread([r['first_response_ms'] for r in runs]),
+        'unanswered': sum(r['first_response_ms'] is None for r in runs),
+        'rss_mb': spread([r['rss_mb'] for r in runs]),
+        'runs': runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=['bot', 'app'], default='bot', help='bot.py or app/SongID.py')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts to measure')
+    parser.add_argument('--acr-down', action='store_true', help='make the fake ACRCloud unreachable')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each start')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    print(f'{args.target}: {args.runs} cold starts{" with ACRCloud down" if args.acr_down else ""}')
+    result = asyncio.run(run(args))
+
+    for name in ('ready_ms', 'first_response_ms', 'rss_mb'):
+        if result[name] is not None:
+            print(f"    {name:>17}: median {result[name]['median']}, min {result[name]['min']}, max {result[name]['max']}")
+    if result['unanswered']:
+        print(f"    {result['unanswered']} runs did not answer /start within {args.timeout}s")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Benchmark tag edits on 5-50MB MP3, M4A, FLAC, Ogg Vorbis and Opus files.
+
+Builds a synthetic file of each format and size (a valid container around filler
+audio, so no encoder is needed) and times:
+- first: tagging the file while it has no tags, so they are inserted and the audio moved;
+- memory: a second edit of the file in memory, which fits in the padding the first
+  one left and only rewrites the tag region;
+- disk: the same second edit on a file on disk, in place;
+- upload: the /edit_metadata flow, editing the saved file in place and reading it
+  once as it is uploaded;
+- legacy: the old flow, saving on disk with mutagen's default padding, then reading
+  the whole file back to upload it.
+
+It reports the median latency and, for tagging.edit_tags, the bytes written.
+
+    python benchmarks/bench_tagging.py --sizes 5 50 --formats mp3 flac --runs 5 --json tagging.json
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import tagging
+
+FIRST = {'title': 'First Title', 'artist': 'First Artist', 'album': 'First Album'}
+SECOND = {'title': 'A Somewhat Longer Second Title', 'artist': 'Second Artist', 'album': 'Second Album', 'date': '2024', 'tracknumber': '3/14'}
+
+
+def _atom(name, payload):
+    return struct.pack('>I4s', 8 + len(payload), name) + payload
+
+
+def _full_atom(name, payload, version=0, flags=0):
+    return _atom(name, struct.pack('>I', version << 24 | flags) + payload)
+
+
+def make_mp3(size):
+    # 128kbps 44.1kHz MPEG-1 Layer III frames of silence, 417 bytes each
+    frame = b'\xff\xfb\x90\x00' + bytes(413)
+    return frame * (size // len(frame))
+
+
+def make_flac(size):
+    streaminfo = struct.pack('>HH', 4096, 4096) + bytes(6)
+    streaminfo += (44100 << 44 | 1 << 41 | 15 << 36 | size // 4).to_bytes(8, 'big') + bytes(16)
+    header = b'fLaC' + bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    return header + bytes(size - len(header))
+
+
+def _ogg(head, tags, setup, size):
+    from mutagen.ogg import OggPage
+    pages = OggPage.from_packets([head], 0)
+    pages += OggPage.from_packets([tags] + ([setup] if setup else []), 1)
+    pages[0].first = True
+    packets = [bytes(4000)] * (size // 4000)
+    data = OggPage.from_packets(packets, len(pages))
+    for index, page in enumerate(data):
+        page.position = (index + 1) * 48000
+    data[-1].last = True
+    out = io.BytesIO()
+    for page in pages + data:
+        page.serial = 1
+        out.write(page.write())
+    return out.getvalue()
+
+
+def make_ogg(size):
+    head = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    tags = b'\x03vorbis' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0) + b'\x01'
+    return _ogg(head, tags, b'\x05vorbis' + bytes(3000), size)
+
+
+def make_opus(size):
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, 312, 48000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0)
+    return _ogg(head, tags, None, size)
+
+
+def make_mp4(size):
+    # ftyp, moov (with a sound track whose chunk offset points into mdat) then mdat,
+    # so tags growing inside moov also has to update the chunk offsets
+    ftyp = _atom(b'ftyp', b'M4A ' + struct.pack('>I', 0) + b'M4A mp42isom')
+    mvhd = _full_atom(b'mvhd', struct.pack('>IIII', 0, 0, 44100, size // 16) + bytes(80))
+    mdhd = _full_atom(b'mdhd', struct.pack('>IIIIHH', 0, 0, 44100, size // 16, 0, 0))
+    hdlr = _full_atom(b'hdlr', struct.pack('>I4s', 0, b'soun') + bytes(12) + b'\x00')
+    stsd = _full_atom(b'stsd', struct.pack('>I', 0))
+
+    def build(offset):
+        stco = _full_atom(b'stco', struct.pack('>II', 1, offset))
+        stbl = _atom(b'stbl', stsd + stco)
+        trak = _atom(b'trak', _atom(b'mdia', mdhd + hdlr + _atom(b'minf', stbl)))
+        return _atom(b'moov', mvhd + trak)
+
+    moov = build(0)
+    moov = build(len(ftyp) + len(moov) + 8)
+    header = ftyp + moov
+    return header + _atom(b'mdat', bytes(size - len(header) - 8))
+
+
+MAKERS = {'mp3': make_mp3, 'mp4': make_mp4, 'flac': make_flac, 'ogg': make_ogg, 'opus': make_opus}
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(fn, runs, setup=lambda: None):
+    """Run fn(setup()) several times, timing only fn; returns (last result, median seconds)"""
+    timings = []
+    result = None
+    for _ in range(runs):
+        prepared = setup()
+        start = time.perf_counter()
+        result = fn(prepared)
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings)
+
+
+def bench(fmt, size_mb, runs, workdir):
+    raw = MAKERS[fmt](size_mb * 1024 * 1024)
+    row = {'format': fmt, 'size_mb': size_mb, 'bytes': len(raw)}
+    path = os.path.join(workdir, f'bench.{fmt}')
+
+    def write_file(data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    # First edit: no tags yet (each run gets a fresh copy, outside the timing)
+    (buffer, edit), seconds = timed(lambda data: tagging.edit_bytes(data, FIRST, fmt), runs, lambda: bytearray(raw))
+    row['first'] = {'ms': ms(seconds), **edit.stats()}
+    tagged = buffer.getvalue()
+
+    # Second edit of a file already in memory
+    (buffer, edit), seconds = timed(lambda data: tagging.edit_bytes(data, SECOND, fmt), runs, lambda: bytearray(tagged))
+    row['memory'] = {'ms': ms(seconds), **edit.stats()}
+
+    # Second edit of a file on disk, in place
+    edit, seconds = timed(lambda _: tagging.edit_tags(path, SECOND, fmt), runs, lambda: write_file(tagged))
+    row['disk'] = {'ms': ms(seconds), **edit.stats()}
+
+    # What /edit_metadata does now: edit the saved file in place, then read it once as it is uploaded
+    def upload_flow(_):
+        tagging.edit_tags(path, SECOND, fmt)
+        with open(path, 'rb') as f:
+            return len(f.read())
+    size, seconds = timed(upload_flow, runs, lambda: write_file(tagged))
+    row['upload'] = {'ms': ms(seconds), 'bytes_read': size}
+
+    # The old flow: save with mutagen's default padding, then read the whole file back to upload it
+    file_type, apply = tagging._file_type(fmt)
+
+    def legacy_flow(_):
+        audio = file_type(path)
+        apply(audio.tags, tagging.normalize_fields(SECOND))
+        audio.save()
+        with open(path, 'rb') as f:
+            return len(f.read())
+    size, seconds = timed(legacy_flow, runs, lambda: write_file(tagged))
+    row['legacy'] = {'ms': ms(seconds), 'bytes_read': size}
+    os.remove(path)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 10, 25, 50], help='file sizes in MB')
+    parser.add_argument('--formats', nargs='+', choices=list(MAKERS), default=list(MAKERS))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--dir', help='where the on-disk edits happen (default: the system temp directory)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_tagging_', dir=args.dir)
+    rows = []
+    try:
+        for fmt in args.formats:
+            for size_mb in args.sizes:
+                row = bench(fmt, size_mb, args.runs, workdir)
+                rows.append(row)
+                print(f"{fmt:>4} {size_mb:>3}MB: first {row['first']['ms']:>8} ms ({row['first']['bytes_written']:,} bytes written), "
+                      f"memory {row['memory']['ms']:>6} ms ({row['memory']['bytes_written']:,} bytes, in place: {row['memory']['in_place']}), "
+                      f"disk {row['disk']['ms']:>6} ms ({row['disk']['bytes_written']:,} bytes), "
+                      f"upload flow {row['upload']['ms']:>6} ms, legacy {row['legacy']['ms']:>6} ms")
+    finally:
+        os.rmdir(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': git_version(), 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'runs': args.runs, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
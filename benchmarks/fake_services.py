@@ -0,0 +1,136 @@
+"""Local stand-ins for Shazam and ACRCloud with configurable latency and error injection.
+
+Both answer every request after latency_ms (plus up to jitter_ms of random
+extra) and fail a random error_rate share of requests: Shazam with an HTTP 500,
+ACRCloud with its 3000 error response. match_rate is the share of recognitions
+that find a song. ACRCloud also starts answering 3003 (limit exceeded) after
+limit_after calls, when set.
+
+Point bot.py at FakeShazam with SHAZAM_API_URL, and app/ at FakeACR with
+SONGID_ACR_*_HOST=127.0.0.1:<port>.
+"""
+import asyncio
+import json
+import random
+from collections import Counter
+
+from aiohttp import web
+
+TRACK = {
+    'key': '12345',
+    'title': 'Fake Song',
+    'subtitle': 'Fake Artist',
+    'sections': [{'type': 'SONG', 'metadata': [{'title': 'Album', 'text': 'Fake Album'}, {'title': 'Released', 'text': '2020'}]}],
+}
+
+ACR_MATCH = {
+    'status': {'msg': 'Success', 'code': 0, 'version': '1.0'},
+    'metadata': {'music': [{
+        'title': 'Fake Song',
+        'artists': [{'name': 'Fake Artist'}],
+        'album': {'name': 'Fake Album'},
+        'duration_ms': 215000,
+        'score': 100,
+        'release_date': '2020-01-01',
+        'external_metadata': {},
+    }]},
+}
+
+
+class _FakeService:
+
+    def __init__(self, latency_ms=200, jitter_ms=100, error_rate=0.0, match_rate=0.9, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.match_rate = match_rate
+        self.calls = Counter()
+        self.port = None
+        self._random = random.Random(seed)
+        self._runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    async def _delay(self):
+        await asyncio.sleep((self.latency_ms + self._random.uniform(0, self.jitter_ms)) / 1000)
+
+    def _fails(self):
+        return self._random.random() < self.error_rate
+
+    def _matches(self):
+        return self._random.random() < self.match_rate
+
+    def stats(self):
+        return dict(self.calls)
+
+
+class FakeShazam(_FakeService):
+    """Answers any path: /tag/ requests are recognitions, search and chart requests return track lists"""
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/{path:.*}', self._handle)
+        return app
+
+    async def _handle(self, request):
+        path = request.match_info['path']
+        if request.can_read_body:
+            await request.read()
+        await self._delay()
+        if self._fails():
+            self.calls['error'] += 1
+            raise web.HTTPInternalServerError()
+        if '/tag/' in f'/{path}':
+            self.calls['recognize'] += 1
+            if self._matches():
+                return web.json_response({'matches': [{'id': TRACK['key']}], 'track': TRACK})
+            return web.json_response({'matches': []})
+        self.calls['search'] += 1
+        tracks = [dict(TRACK, key=str(12345 + i), title=f'Fake Song {i}') for i in range(10)]
+        return web.json_response({'tracks': tracks})
+
+
+class FakeACR(_FakeService):
+    """Answers ACRCloud's /v1/identify"""
+
+    def __init__(self, limit_after=None, **kwargs):
+        super().__init__(**kwargs)
+        self.limit_after = limit_after
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/identify', self._identify)
+        app.router.add_get('/', self._ping)
+        return app
+
+    async def _ping(self, request):
+        # app/SongID.py checks the host is reachable before starting
+        return web.Response(text='ok')
+
+    async def _identify(self, request):
+        await request.post()
+        await self._delay()
+        self.calls['identify'] += 1
+        if self.limit_after is not None and self.calls['identify'] > self.limit_after:
+            self.calls['limit'] += 1
+            body = {'status': {'msg': 'Limit exceeded', 'code': 3003, 'version': '1.0'}}
+        elif self._fails():
+            self.calls['error'] += 1
+            body = {'status': {'msg': 'Http Error', 'code': 3000, 'version': '1.0'}}
+        elif self._matches():
+            body = ACR_MATCH
+        else:
+            body = {'status': {'msg': 'No result', 'code': 1001, 'version': '1.0'}}
+        return web.Response(text=json.dumps(body), content_type='application/json')
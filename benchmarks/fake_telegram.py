@@ -0,0 +1,234 @@
+"""A local stand-in for the Telegram Bot API, for load-testing the bot offline.
+
+Serves getUpdates (long polling) from an in-memory queue, getFile and file
+downloads, and answers every other method with a plausible result. Each
+generated text update carries its update_id as the message text, so a bot that
+echoes it back lets us time update -> reply. Every response is also logged per
+chat (and per inline query id), so a load generator can time update -> last
+response for any handler.
+
+    fake = FakeTelegram()
+    await fake.start(port=8081)
+    telebot.asyncio_helper.API_URL = fake.api_url
+"""
+import asyncio
+import io
+import math
+import struct
+import time
+import wave
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+TOKEN = '123456:fake-token'
+
+
+def tone_wav(seconds=5, frequency=440, sample_rate=16000):
+    """A mono 16-bit sine tone as WAV bytes"""
+    frames = b''.join(
+        struct.pack('<h', int(12000 * math.sin(2 * math.pi * frequency * i / sample_rate)))
+        for i in range(int(seconds * sample_rate))
+    )
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def tagged_wav(base, tag):
+    """base with an extra RIFF chunk holding tag, so every fake file has different contents (and hash)"""
+    tag = tag.encode()
+    chunk = b'junk' + struct.pack('<I', len(tag)) + tag + (b'\0' if len(tag) % 2 else b'')
+    return base[:4] + struct.pack('<I', len(base) - 8 + len(chunk)) + base[8:] + chunk
+
+
+class FakeTelegram:
+
+    def __init__(self, token=TOKEN, audio_seconds=5):
+        self.token = token
+        self.port = None
+        self.calls = Counter()
+        self.created = {}  # update_id -> time the update was generated
+        self.replied = {}  # update_id -> time the first reply arrived
+        self.responses = defaultdict(list)  # chat id or inline query id -> times the bot responded
+        self.downloaded_bytes = 0
+        self._pending = []  # Updates waiting for getUpdates
+        self._arrived = asyncio.Event()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._runner = None
+        self._base_wav = tone_wav(audio_seconds)
+        self._files = {}  # file path -> contents
+
+    @property
+    def api_url(self):
+        """URL template in the form telebot expects ({0} is the token, {1} the method)"""
+        return f'http://127.0.0.1:{self.port}/bot{{0}}/{{1}}'
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self._api)
+        app.router.add_get('/file/bot{token}/{path:.*}', self._file)
+        app.router.add_get('/media/{name}', self._media)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+
+    def _update(self, **payload):
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        self.created[update_id] = time.perf_counter()
+        return dict(update_id=update_id, **payload)
+
+    def _message(self, chat_id, **fields):
+        user = self._user(chat_id)
+        return dict(
+            message_id=self._message_id(),
+            chat={'id': chat_id, 'type': 'private', 'first_name': user['first_name'], 'username': user['username']},
+            date=int(time.time()),
+            **{'from': user},
+            **fields
+        )
+
+    def make_update(self, chat_id, text=None):
+        """A private text message update from chat_id, timestamped now"""
+        update = self._update()
+        update['message'] = self._message(chat_id, text=text if text is not None else str(update['update_id']))
+        return update
+
+    def make_media_update(self, chat_id, file_unique_id, kind='audio'):
+        """An audio (or voice) message; its file downloads as a short WAV unique to file_unique_id"""
+        path = f'music/{file_unique_id}.wav'
+        if path not in self._files:
+            self._files[path] = tagged_wav(self._base_wav, file_unique_id)
+        media = {
+            'file_id': f'{kind}-{file_unique_id}',
+            'file_unique_id': file_unique_id,
+            'file_size': len(self._files[path]),
+            'duration': 5,
+            'mime_type': 'audio/wav',
+        }
+        if kind == 'audio':
+            media['file_name'] = f'{file_unique_id}.wav'
+        update = self._update()
+        update['message'] = self._message(chat_id, **{kind: media})
+        return update
+
+    def make_inline_update(self, user_id, query):
+        update = self._update()
+        update['inline_query'] = {'id': f'iq{update["update_id"]}', 'from': self._user(user_id), 'query': query, 'offset': ''}
+        return update
+
+    def media_url(self, name):
+        """A plain download link served by this server (for the bot's generic link handler)"""
+        return f'{self.base_url}/media/{name}'
+
+    def push(self, update):
+        """Queue an update for the next getUpdates call"""
+        self._pending.append(update)
+        self._arrived.set()
+
+    def _message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    async def _params(self, request):
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+        return params
+
+    async def _api(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method == 'getMe':
+            result = {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method == 'getFile':
+            file_id = str(params.get('file_id'))
+            file_unique_id = file_id.split('-', 1)[-1]
+            path = f'music/{file_unique_id}.wav'
+            result = {'file_id': file_id, 'file_unique_id': file_unique_id, 'file_size': len(self._files.get(path, b'')), 'file_path': path}
+        elif method == 'answerInlineQuery':
+            self.responses[str(params.get('inline_query_id'))].append(time.perf_counter())
+            result = True
+        elif method.startswith('send') or method.startswith('edit'):
+            result = self._reply(method, params)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self._pending = [update for update in self._pending if update['update_id'] >= offset]
+        if not self._pending and timeout:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._pending[:limit]
+
+    def _reply(self, method, params):
+        now = time.perf_counter()
+        text = str(params.get('text') or '')
+        if text.isdigit() and int(text) in self.created and int(text) not in self.replied:
+            self.replied[int(text)] = now
+        chat_id = int(params.get('chat_id') or 0)
+        self.responses[chat_id].append(now)
+        message = {
+            'message_id': int(params.get('message_id') or 0) or self._message_id(),
+            'from': {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'Fake'},
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': int(time.time()),
+        }
+        uploaded = f'upload-{self._message_id()}'
+        if method == 'sendVideo':
+            message['video'] = {'file_id': uploaded, 'file_unique_id': uploaded, 'width': 640, 'height': 360, 'duration': 5}
+        elif method == 'sendAudio':
+            message['audio'] = {'file_id': uploaded, 'file_unique_id': uploaded, 'duration': 5}
+        elif method == 'sendPhoto':
+            message['photo'] = [{'file_id': uploaded, 'file_unique_id': uploaded, 'width': 640, 'height': 360}]
+        else:
+            message['text'] = text
+        return message
+
+    async def _file(self, request):
+        contents = self._files.get(request.match_info['path'])
+        if contents is None:
+            raise web.HTTPNotFound()
+        self.downloaded_bytes += len(contents)
+        return web.Response(body=contents, content_type='audio/wav')
+
+    async def _media(self, request):
+        # Any name serves the same short clip, e.g. /media/clip1.wav
+        self.downloaded_bytes += len(self._base_wav)
+        return web.Response(body=self._base_wav, content_type='audio/wav')
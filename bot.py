@@ -1,7 +1,11 @@
 import asyncio
+import contextlib
+import glob
+import importlib
 import logging
 import os
 import io
+import secrets
 from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
@@ -9,40 +13,41 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+from config import Config
+from app.SongIDCache import RecognitionCache, contentHash
+from app.SongIDBuffer import MediaBuffer
+from app.SongIDMetrics import Metrics
+from app.SongIDLazy import LazyModule
+from app.SongIDWorkspace import Workspaces
+from app import SongIDPreprocess
+
 import telebot
 from telebot import types
+from telebot import asyncio_helper
 from telebot.async_telebot import AsyncTeleBot
 from telebot.asyncio_storage import StateMemoryStorage
 
-from shazamio import Shazam
-from shazamio.schemas.enums import ArtistView
-from shazamio.schemas.artists import ArtistQuery
-
-# For social media downloading, we'll use various libraries
-# YouTube downloading
-try:
-    from pytube import YouTube
-    YOUTUBE_AVAILABLE = True
-except ImportError:
-    YOUTUBE_AVAILABLE = False
-
-# Instagram downloading
-try:
-    import instaloader
-    INSTAGRAM_AVAILABLE = True
-except ImportError:
-    INSTAGRAM_AVAILABLE = False
-
-# For general downloading
-import requests
-
-# For metadata editing
-try:
-    from mutagen.id3 import ID3, TIT2, TPE1, TALB
-    from mutagen.mp3 import MP3
-    METADATA_AVAILABLE = True
-except ImportError:
-    METADATA_AVAILABLE = False
+from shazam_client import create_shazam_pool
+from job_queue import JobScheduler, QueueFull
+from inline_cache import InlineSearchCache, LatestQueryTracker, normalise_query
+from http_downloader import StreamingDownloader, DownloadTooLarge
+from executors import TaskExecutor
+from media_cache import MediaFileCache, normalise_url, instagram_shortcode
+from single_flight import SingleFlight
+from state_store import create_state_store
+from sessions import SessionState
+import tagging
+from batch_tagging import BatchTooLarge, ThrottledEditor, parse_batch_metadata, save_upload, track_fields
+
+# For social media downloading and metadata editing, we'll use various libraries.
+# They are only imported the first time a request needs them (on the I/O pool), so they don't slow down start-up.
+pytube = LazyModule('pytube')  # YouTube downloading
+YOUTUBE_AVAILABLE = pytube.available
+
+instaloader = LazyModule('instaloader')  # Instagram downloading
+INSTAGRAM_AVAILABLE = instaloader.available
+
+METADATA_AVAILABLE = LazyModule('mutagen').available  # Metadata editing (tagging.py imports it on first use)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -50,13 +55,106 @@ logger = logging.getLogger(__name__)
 
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")  # Replace with your actual bot token
+if Config.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = Config.TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = Config.TELEGRAM_API_URL.rstrip('/') + '/file/bot{0}/{1}'
 bot = AsyncTeleBot(BOT_TOKEN, state_storage=StateMemoryStorage())
 
-# User language storage (in production, use a database)
-user_languages = {}
+# Scratch directories for downloads and edits (tmpfs when possible), within a global disk quota
+workspaces = Workspaces(
+    root=Config.WORKSPACE_DIR or None,
+    quota=Config.WORKSPACE_QUOTA,
+    orphanAge=Config.WORKSPACE_ORPHAN_AGE,
+    janitorInterval=Config.WORKSPACE_JANITOR_INTERVAL,
+    legacy=['temp_metadata_*', 'temp_yt_*', 'temp_generic_*', 'temp_*.tmp', 'temp/*']  # Left in the working directory by older versions
+)
+spill_dir = Config.SPILL_DIR or os.path.join(workspaces.root, 'spill')
+os.makedirs(spill_dir, exist_ok=True)
+
+# Per-user state, in this process or shared with the other workers (see ingress.py)
+state_store = create_state_store(Config.STATE_STORE)
+
+# User language storage, capped at the most recently active users
+user_languages = SessionState(state_store, 'languages', max_entries=Config.LANGUAGE_MAX_ENTRIES)
+
+# Store file info for metadata editing. Abandoned edits expire and their downloaded file is deleted.
+user_files = SessionState(
+    state_store,
+    'files',
+    ttl=Config.METADATA_SESSION_TTL,
+    max_entries=Config.METADATA_SESSION_MAX_ENTRIES,
+    files=lambda session: [session.get('workspace') or session['file_path']] if session.get('file_path') else [],
+    size=lambda session: session.get('file_size', 0),
+    remove=workspaces.remove
+)
+
+# Files collected for batch tagging (/edit_album), each upload in a workspace of its own
+user_batches = SessionState(
+    state_store,
+    'batches',
+    ttl=Config.BATCH_SESSION_TTL,
+    max_entries=Config.BATCH_SESSION_MAX_ENTRIES,
+    files=lambda batch: sorted({track['workspace'] for track in batch.get('tracks', [])}),
+    size=lambda batch: sum(track['size'] for track in batch.get('tracks', [])),
+    remove=workspaces.remove
+)
+# Progress message editors of the batches being collected in this process (a chat's updates all reach the same one)
+batch_progress = {}
+
+# Recognition results keyed by file_unique_id and content hash.
+# Both caches are SQLite files every ingress worker shares, so they are only used from the I/O pool, never the event loop.
+recognition_cache = RecognitionCache(
+    Config.CACHE_PATH,
+    memory_entries=Config.CACHE_MEMORY_ENTRIES,
+    ttl=Config.CACHE_TTL,
+    max_bytes=Config.CACHE_MAX_BYTES
+)
+
+# Long-lived Shazam clients, borrowed for every recognition and search
+shazam_pool = create_shazam_pool(Config.SHAZAM_POOL_SIZE, Config.SHAZAM_POOL_IDLE_TIMEOUT, Config.SHAZAM_API_URL or None)
+
+# Recognition jobs, worked through by a fixed number of workers with per-user fairness
+recognition_queue = JobScheduler(
+    workers=Config.QUEUE_WORKERS,
+    max_depth=Config.QUEUE_MAX_DEPTH,
+    max_per_key=Config.QUEUE_MAX_PER_USER
+)
+
+# Inline search results by normalised query, and each user's newest inline query
+inline_cache = InlineSearchCache(
+    ttl=Config.INLINE_SEARCH_TTL,
+    max_entries=Config.INLINE_CACHE_ENTRIES
+)
+inline_queries = LatestQueryTracker()
+
+# Thread pool for blocking library calls (pytube, instaloader, mutagen, ffmpeg, file I/O)
+executor = TaskExecutor(
+    io_workers=Config.EXECUTOR_IO_WORKERS,
+    default_timeout=Config.EXECUTOR_TIMEOUT
+)
+
+# Telegram file_ids of YouTube/Instagram media we have already uploaded, by normalised link
+media_cache = MediaFileCache(Config.MEDIA_CACHE_PATH, ttl=Config.MEDIA_CACHE_TTL, max_bytes=Config.MEDIA_CACHE_MAX_BYTES)
 
-# Store file info for metadata editing
-user_files = {}
+# Recognitions by file_unique_id and downloads by normalised link that are in progress,
+# so the same viral clip or link sent by many users at once is only fetched once
+recognitions = SingleFlight('recognitions')
+link_downloads = SingleFlight('link_downloads')
+
+# Per-stage latency and outcome counters, exposed at /metrics when enabled
+metrics = Metrics(enabled=Config.METRICS_ENABLED)
+user_languages.register_metrics(metrics)
+user_files.register_metrics(metrics)
+user_batches.register_metrics(metrics)
+
+# Shared connection pool for links that are not YouTube/Instagram
+http_downloader = StreamingDownloader(
+    max_bytes=Config.DOWNLOAD_MAX_BYTES,
+    spill_threshold=Config.SPILL_THRESHOLD,
+    spill_dir=spill_dir,
+    timeout=Config.DOWNLOAD_TIMEOUT,
+    connections=Config.DOWNLOAD_CONNECTIONS
+)
 
 # Supported languages
 LANGUAGES = {
@@ -78,13 +176,16 @@ TEXTS = {
                 "/start - Start the bot\n"
                 "/help - Show this help message\n"
                 "/language - Change language\n"
-                "/edit_metadata - Edit music file metadata\n\n"
+                "/edit_metadata - Edit music file metadata\n"
+                "/edit_album - Tag several files (or a zip) at once\n\n"
                 "Simply send me an audio/video file to identify music or a social media link to download content.",
         'choose_language': "Please choose your language:",
         'language_selected': "Language changed to English!",
         'send_audio': "Please send an audio or video file to identify the music.",
         'file_too_large': "File is too large. Please send a file smaller than 20MB.",
         'processing': "Processing your file... Please wait.",
+        'queued': "You're #{position} in the queue. Your file will be processed shortly...",
+        'queue_full': "The bot is very busy right now. Please try again in a minute.",
         'no_match': "Sorry, I couldn't identify this track.",
         'result': "*Title:* {title}\n"
                   "*Artist:* {artist}\n"
@@ -94,6 +195,7 @@ TEXTS = {
         'downloading': "Downloading content... Please wait.",
         'download_complete': "Download complete! Here's your content:",
         'download_failed': "Failed to download content. Please check the link and try again.",
+        'download_too_large': "This file is too large to send. Telegram allows up to 50MB.",
         'edit_metadata': "Please send the music file you want to edit.",
         'send_new_metadata': "Please send the new metadata in this format:\n"
                              "Title: New Title\n"
@@ -104,7 +206,24 @@ TEXTS = {
         'metadata_editing_started': "File received. Now send the new metadata in this format:\n"
                                     "Title: New Title\n"
                                     "Artist: New Artist\n"
-                                    "Album: New Album"
+                                    "Album: New Album",
+        'edit_album': "Send the files you want to tag (up to {max_files}), one by one or as a zip. Then send the tags:\n"
+                      "Artist: Artist\n"
+                      "Album: Album\n"
+                      "Year: 2024\n"
+                      "Track: {{n}}/{{total}}\n"
+                      "Title: {{name}}\n\n"
+                      "A line like \"3. Title: Intro\" only changes track 3. {{n}}, {{total}} and {{name}} (the file name) are filled in for each track.",
+        'album_received': "Files received: {files} ({size_mb} MB)",
+        'album_limit': "A batch can hold up to {max_files} files ({max_mb} MB). Send the tags to finish this one.",
+        'album_unsupported': "Only MP3, M4A, FLAC, Ogg and Opus files (or a zip of them) can be tagged.",
+        'album_no_files': "Send the files first, then the tags.",
+        'album_expired': "This batch has expired. Send /edit_album to start a new one.",
+        'invalid_album_format': "Invalid format. Please use lines like:\nArtist: ...\nAlbum: ...\nTrack: {n}/{total}",
+        'album_tagging': "Tagging {done}/{total} files...",
+        'album_sending': "Sending {sent}/{total} files...",
+        'album_done': "Tagged {done} of {total} files.",
+        'album_failed': "Couldn't tag: {names}"
     },
     'fa': {
         'start': "🎵 به ربات شناسایی موسیقی و دانلود از شبکه های اجتماعی خوش آمدید!\n\n"
@@ -118,13 +237,16 @@ TEXTS = {
                 "/start - شروع ربات\n"
                 "/help - نمایش این پیام راهنما\n"
                 "/language - تغییر زبان\n"
-                "/edit_metadata - ویرایش اطلاعات فایل موسیقی\n\n"
+                "/edit_metadata - ویرایش اطلاعات فایل موسیقی\n"
+                "/edit_album - ویرایش اطلاعات چند فایل (یا یک فایل zip) با هم\n\n"
                 "فقط کافیست یک فایل صوتی/تصویری بفرستید تا موسیقی آن شناسایی شود یا یک لینک شبکه اجتماعی برای دانلود محتوا.",
         'choose_language': "لطفا زبان خود را انتخاب کنید:",
         'language_selected': "زبان به فارسی تغییر یافت!",
         'send_audio': "لطفا یک فایل صوتی یا تصویری برای شناسایی موسیقی بفرستید.",
         'file_too_large': "فایل بسیار بزرگ است. لطفا فایلی کوچکتر از ۲۰ مگابایت بفرستید.",
         'processing': "در حال پردازش فایل... لطفا صبر کنید.",
+        'queued': "شما نفر {position} در صف هستید. فایل شما به زودی پردازش می شود...",
+        'queue_full': "ربات در حال حاضر بسیار شلوغ است. لطفا یک دقیقه دیگر دوباره تلاش کنید.",
         'no_match': "متاسفانه نتوانستم این ترک را شناسایی کنم.",
         'result': "*عنوان:* {title}\n"
                   "*هنرمند:* {artist}\n"
@@ -134,6 +256,7 @@ TEXTS = {
         'downloading': "در حال دانلود محتوا... لطفا صبر کنید.",
         'download_complete': "دانلود تکمیل شد! محتوای شما:",
         'download_failed': "دانلود محتوا ناموفق بود. لطفا لینک را بررسی کرده و دوباره تلاش کنید.",
+        'download_too_large': "این فایل برای ارسال بسیار بزرگ است. تلگرام حداکثر ۵۰ مگابایت را مجاز می داند.",
         'edit_metadata': "لطفا فایل موسیقی که می خواهید اطلاعات آن را ویرایش کنید بفرستید.",
         'send_new_metadata': "لطفا اطلاعات جدید را به این فرمت بفرستید:\n"
                              "Title: عنوان جدید\n"
@@ -144,7 +267,24 @@ TEXTS = {
         'metadata_editing_started': "فایل دریافت شد. حالا اطلاعات جدید را به این فرمت بفرستید:\n"
                                     "Title: عنوان جدید\n"
                                     "Artist: هنرمند جدید\n"
-                                    "Album: آلبوم جدید"
+                                    "Album: آلبوم جدید",
+        'edit_album': "فایل هایی که می خواهید ویرایش کنید را بفرستید (حداکثر {max_files} فایل)، یکی یکی یا در یک فایل zip. سپس اطلاعات را بفرستید:\n"
+                      "Artist: هنرمند\n"
+                      "Album: آلبوم\n"
+                      "Year: 2024\n"
+                      "Track: {{n}}/{{total}}\n"
+                      "Title: {{name}}\n\n"
+                      "خطی مانند \"3. Title: Intro\" فقط ترک ۳ را تغییر می دهد. {{n}}، {{total}} و {{name}} (نام فایل) برای هر ترک جایگزین می شوند.",
+        'album_received': "فایل های دریافت شده: {files} ({size_mb} مگابایت)",
+        'album_limit': "هر دسته حداکثر {max_files} فایل ({max_mb} مگابایت) می تواند داشته باشد. برای تمام کردن این دسته اطلاعات را بفرستید.",
+        'album_unsupported': "فقط فایل های MP3، M4A، FLAC، Ogg و Opus (یا یک فایل zip از آنها) قابل ویرایش هستند.",
+        'album_no_files': "ابتدا فایل ها را بفرستید، سپس اطلاعات را.",
+        'album_expired': "این دسته منقضی شده است. برای شروع دوباره /edit_album را بفرستید.",
+        'invalid_album_format': "فرمت نامعتبر. لطفا از خطوطی مانند این استفاده کنید:\nArtist: ...\nAlbum: ...\nTrack: {n}/{total}",
+        'album_tagging': "در حال ویرایش {done} از {total} فایل...",
+        'album_sending': "در حال ارسال {sent} از {total} فایل...",
+        'album_done': "اطلاعات {done} از {total} فایل ویرایش شد.",
+        'album_failed': "ویرایش این فایل ها ممکن نبود: {names}"
     }
 }
 
@@ -177,8 +317,54 @@ async def language_command(message):
 @bot.message_handler(commands=['edit_metadata'])
 async def edit_metadata_command(message):
     """Handle /edit_metadata command"""
+    # The next file the user sends is kept for editing (handle_media), until the session expires
+    await executor.run_io(user_batches.discard, message.from_user.id)
+    user_files[message.from_user.id] = {'file_path': None, 'file_name': None}
     await bot.reply_to(message, get_text(message.from_user.id, 'edit_metadata'))
 
+def batch_editor(user_id, batch):
+    """The throttled editor of a batch's progress message, recreated from the session after a restart"""
+    editor = batch_progress.get(user_id)
+    if editor is None:
+        chat_id, message_id = batch['status']
+        editor = batch_progress[user_id] = ThrottledEditor(
+            lambda text: bot.edit_message_text(text, chat_id, message_id),
+            Config.BATCH_PROGRESS_INTERVAL
+        )
+    return editor
+
+@bot.message_handler(commands=['edit_album'])
+async def edit_album_command(message):
+    """Handle /edit_album command: collect several files (or a zip) to tag together"""
+    user_id = message.from_user.id
+    # Starting over drops an earlier batch (and its files), and a pending single-file edit
+    await executor.run_io(user_files.discard, user_id)
+    await executor.run_io(user_batches.discard, user_id)
+    for other in [other for other in batch_progress if other == user_id or other not in user_batches]:
+        del batch_progress[other]
+    status = await bot.reply_to(message, get_text(user_id, 'edit_album').format(max_files=Config.BATCH_MAX_FILES))
+    user_batches[user_id] = {'tracks': [], 'status': [status.chat.id, status.message_id]}
+
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in Config.ADMIN_IDS)
+async def stats_command(message):
+    """Handle /stats command (admins only): cache, queue and pool statistics"""
+    cache = await executor.run_io(recognition_cache.stats)
+    media = await executor.run_io(media_cache.stats)
+    queue = recognition_queue.stats()
+    text = (
+        f"Recognition cache: {cache['hits']:,} hits, {cache['misses']:,} misses ({cache['hit_rate'] * 100:.1f}%)\n"
+        f"Media cache: {media['entries']:,} links, {media['hits']:,} hits, {media['misses']:,} misses "
+        f"({media['hit_rate'] * 100:.1f}%), {media['invalidations']:,} invalidated\n"
+        f"Inline cache: {inline_cache.stats()}\n"
+        f"Queue: {queue}\n"
+        f"Coalesced: {recognitions.stats()['coalesced']:,} recognitions, {link_downloads.stats()['coalesced']:,} downloads\n"
+        f"Shazam pool: {shazam_pool.stats()}\n"
+        f"Executors: {executor.stats()}\n"
+        f"Sessions: languages {user_languages.stats()}, metadata edits {user_files.stats()}, batches {user_batches.stats()}\n"
+        f"Workspaces: {workspaces.stats()}"
+    )
+    await bot.reply_to(message, text)
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith('lang_'))
 async def language_callback(call):
     """Handle language selection"""
@@ -193,100 +379,200 @@ async def language_callback(call):
             parse_mode='Markdown'
         )
 
+def get_media(message):
+    """Get the attached audio/video object of a message"""
+    return getattr(message, message.content_type, None)
+
+def summarise_match(recognized):
+    """Reduce a Shazam response to the fields we show, or None if nothing matched"""
+    if not recognized or 'track' not in recognized:
+        return None
+    track = recognized['track']
+    
+    # Try to get album info
+    album = 'Unknown'
+    if 'sections' in track:
+        for section in track['sections']:
+            if 'metadata' in section:
+                for meta in section['metadata']:
+                    if meta.get('title') == 'Album':
+                        album = meta.get('text', 'Unknown')
+                        break
+    
+    return {
+        'title': track.get('title', 'Unknown'),
+        'artist': track.get('subtitle', 'Unknown'),
+        'album': album,
+        'track_id': track.get('key', '')
+    }
+
+def format_match(user_id, match):
+    """Format a summarised match (or a miss) as the message text"""
+    if not match:
+        return get_text(user_id, 'no_match'), None
+    result_text = get_text(user_id, 'result').format(
+        title=match['title'],
+        artist=match['artist'],
+        album=match['album'],
+        track_id=match['track_id'],
+        title_lower=match['title'].lower().replace(' ', '-')
+    )
+    return result_text, 'Markdown'
+
 @bot.message_handler(content_types=['audio', 'voice', 'video', 'video_note', 'document'])
 async def handle_media(message):
     """Handle audio/video files for music recognition"""
     # Check if user is in metadata editing mode
+    if message.from_user.id in user_batches:
+        await handle_batch_file(message)
+        return
     if message.from_user.id in user_files:
         await handle_metadata_file(message)
         return
     
-    # Check file size
-    if message.content_type == 'document':
-        file_size = message.document.file_size
-    elif message.content_type == 'audio':
-        file_size = message.audio.file_size
-    elif message.content_type == 'voice':
-        file_size = message.voice.file_size
-    elif message.content_type == 'video':
-        file_size = message.video.file_size
-    elif message.content_type == 'video_note':
-        file_size = message.video_note.file_size
+    media = get_media(message)
     
-    if file_size > 20 * 1024 * 1024:  # 20MB limit
+    # Check file size
+    if media.file_size > Config.FILE_SIZE_LIMIT:  # 20MB limit
+        metrics.count('requests_total', handler='media', outcome='too_large')
         await bot.reply_to(message, get_text(message.from_user.id, 'file_too_large'))
         return
     
-    # Notify user about processing
-    processing_msg = await bot.reply_to(message, get_text(message.from_user.id, 'processing'))
+    # Answer straight from the cache if this file was recognised before
+    with metrics.stage('cache_lookup', handler='media', provider='cache') as timer:
+        match = await executor.run_io(recognition_cache.lookup, 'shazam', file_unique_id=media.file_unique_id)
+        timer.outcome = 'miss' if match is None else 'hit'
+    if match is not None:
+        metrics.count('requests_total', handler='media', outcome='cached')
+        text, parse_mode = format_match(message.from_user.id, match)
+        with metrics.stage('reply', handler='media', provider='telegram'):
+            await bot.reply_to(message, text, parse_mode=parse_mode)
+        return
+    
+    status = asyncio.get_running_loop().create_future()
     
+    # Someone else's copy of this file is already being recognized, wait for that instead of queueing.
+    # join() never starts a recognition, so one that finishes while we reply can't make us run it outside the queue.
+    joined = recognitions.join(media.file_unique_id)
+    if joined is not None:
+        try:
+            with metrics.stage('reply', handler='media', provider='telegram'):
+                status.set_result((await bot.reply_to(message, get_text(message.from_user.id, 'processing')), 0))
+        except Exception:
+            joined.close()  # Stop following, the recognition carries on for everyone else
+            raise
+        await recognize_media(message, media, status, joined)
+        return
+    
+    # Queue the download and recognition, a fixed pool of workers drains the queue
     try:
-        # Download file
-        if message.content_type == 'document':
-            file_info = await bot.get_file(message.document.file_id)
-        elif message.content_type == 'audio':
-            file_info = await bot.get_file(message.audio.file_id)
-        elif message.content_type == 'voice':
-            file_info = await bot.get_file(message.voice.file_id)
-        elif message.content_type == 'video':
-            file_info = await bot.get_file(message.video.file_id)
-        elif message.content_type == 'video_note':
-            file_info = await bot.get_file(message.video_note.file_id)
-        
+        position = recognition_queue.submit(message.from_user.id, recognize_media, message, media, status)
+    except QueueFull:
+        metrics.count('requests_total', handler='media', outcome='queue_full')
+        await bot.reply_to(message, get_text(message.from_user.id, 'queue_full'))
+        return
+    
+    # Notify user about processing (or about their place in the queue)
+    try:
+        if position:
+            text = get_text(message.from_user.id, 'queued').format(position=position)
+        else:
+            text = get_text(message.from_user.id, 'processing')
+        with metrics.stage('reply', handler='media', provider='telegram'):
+            status.set_result((await bot.reply_to(message, text), position))
+    except Exception as e:
+        status.set_exception(e)
+
+async def identify_media(media):
+    """Download and recognize a file, returning the summarised match ({} when nothing matched)"""
+    # A copy of this file queued earlier may have been recognized while this one waited
+    match = await executor.run_io(recognition_cache.lookup, 'shazam', file_unique_id=media.file_unique_id)
+    if match is not None:
+        return match
+    
+    # Download file
+    with metrics.stage('get_file', handler='media', provider='telegram'):
+        file_info = await bot.get_file(media.file_id)
+    with metrics.stage('download_file', handler='media', provider='telegram'):
         downloaded_file = await bot.download_file(file_info.file_path)
+    
+    # The same audio may have been forwarded under another file_unique_id
+    with metrics.stage('hash', handler='media', provider='local'):
+        content_hash = await executor.run_io(contentHash, downloaded_file)
+    with metrics.stage('cache_lookup', handler='media', provider='cache') as timer:
+        match = await executor.run_io(recognition_cache.lookup, 'shazam', content_hash=content_hash)
+        timer.outcome = 'miss' if match is None else 'hit'
+    if match is None:
+        # Hand the bytes straight to the recognizer, only spilling very large files to disk
+        with metrics.stage('buffer', handler='media', provider='local') as timer:
+            media_buffer = MediaBuffer.fromBytes(downloaded_file, Config.SPILL_THRESHOLD, spill_dir)
+            timer.outcome = 'memory' if media_buffer.inMemory else 'spilled'
+        with media_buffer:
+            audio = media_buffer.source()
+            if Config.PREPROCESS_ENABLED:
+                # Only decode the window Shazam listens to, as mono WAV
+                with metrics.stage('preprocess', handler='media', provider='ffmpeg'):
+                    audio = await executor.run_io(
+                        SongIDPreprocess.prepare,
+                        audio,
+                        Config.PREPROCESS_START,
+                        Config.PREPROCESS_SECONDS,
+                        Config.PREPROCESS_SAMPLE_RATE,
+                        workspaces=workspaces
+                    )
+            
+            # Recognize music using ShazamIO
+            with metrics.stage('recognize', handler='media', provider='shazam') as timer:
+                async with shazam_pool.borrow() as shazam:
+                    recognized = await shazam.recognize(audio)
+                match = summarise_match(recognized) or {}
+                timer.outcome = 'match' if match else 'no_match'
+    
+    await executor.run_io(
+        recognition_cache.store,
+        match, 'shazam',
+        file_unique_id=media.file_unique_id,
+        content_hash=content_hash,
+        ttl=Config.CACHE_TTL if match else Config.CACHE_MISS_TTL
+    )
+    return match
+
+async def recognize_media(message, media, status, joined=None):
+    """Recognize a queued file (sharing the work with anyone sending the same file), then edit the status message with the result.
+    joined is the recognition of another copy of the file to wait for instead (from recognitions.join)."""
+    processing_msg, position = await status
+    
+    try:
+        if position:
+            with metrics.stage('edit_message', handler='media', provider='telegram'):
+                await bot.edit_message_text(
+                    get_text(message.from_user.id, 'processing'),
+                    message.chat.id,
+                    processing_msg.message_id
+                )
         
-        # Save file temporarily
-        temp_file_path = f"temp_{message.from_user.id}_{message.id}.tmp"
-        with open(temp_file_path, 'wb') as f:
-            f.write(downloaded_file)
-        
-        # Recognize music using ShazamIO
-        shazam = Shazam()
-        recognized = await shazam.recognize(temp_file_path)
-        
-        # Remove temporary file
-        os.remove(temp_file_path)
+        with metrics.stage('identify', handler='media', provider='songid') as timer:
+            if joined is not None:
+                match, shared = await joined, True
+            else:
+                match, shared = await recognitions.do(media.file_unique_id, identify_media, media)
+            timer.outcome = 'shared' if shared else 'ok'
+        if shared:
+            logger.info(f"Shared recognition of {media.file_unique_id} with another request")
+        metrics.count('requests_total', handler='media', outcome='match' if match else 'no_match')
         
-        # Check if recognition was successful
-        if recognized and 'track' in recognized:
-            track = recognized['track']
-            title = track.get('title', 'Unknown')
-            artists = track.get('subtitle', 'Unknown')
-            track_id = track.get('key', '')
-            
-            # Try to get album info
-            album = 'Unknown'
-            if 'sections' in track:
-                for section in track['sections']:
-                    if 'metadata' in section:
-                        for meta in section['metadata']:
-                            if meta.get('title') == 'Album':
-                                album = meta.get('text', 'Unknown')
-                                break
-            
-            # Send result
-            result_text = get_text(message.from_user.id, 'result').format(
-                title=title,
-                artist=artists,
-                album=album,
-                track_id=track_id,
-                title_lower=title.lower().replace(' ', '-')
-            )
-            
+        # Send result
+        text, parse_mode = format_match(message.from_user.id, match)
+        with metrics.stage('edit_message', handler='media', provider='telegram'):
             await bot.edit_message_text(
-                result_text,
+                text,
                 message.chat.id,
                 processing_msg.message_id,
-                parse_mode='Markdown'
-            )
-        else:
-            await bot.edit_message_text(
-                get_text(message.from_user.id, 'no_match'),
-                message.chat.id,
-                processing_msg.message_id
+                parse_mode=parse_mode
             )
     except Exception as e:
         logger.error(f"Error processing media: {e}")
+        metrics.count('requests_total', handler='media', outcome='error')
         await bot.edit_message_text(
             get_text(message.from_user.id, 'no_match'),
             message.chat.id,
@@ -309,15 +595,18 @@ async def handle_metadata_file(message):
         
         downloaded_file = await bot.download_file(file_info.file_path)
         
-        # Save file temporarily
-        temp_file_path = f"temp_metadata_{message.from_user.id}_{message.id}_{file_name}"
-        with open(temp_file_path, 'wb') as f:
-            f.write(downloaded_file)
+        # Keep the file in a workspace of its own until the user sends the new metadata
+        with workspaces.open('metadata', reserve=len(downloaded_file)) as workspace:
+            temp_file_path = workspace.file(file_name or 'audio')
+            await executor.run_io(Path(temp_file_path).write_bytes, downloaded_file)
+            workspace.keep()
         
-        # Store file info
+        # Store file info (replacing an earlier file deletes it)
         user_files[message.from_user.id] = {
+            'workspace': workspace.path,
             'file_path': temp_file_path,
-            'file_name': file_name
+            'file_name': file_name,
+            'file_size': len(downloaded_file)
         }
         
         await bot.reply_to(message, get_text(message.from_user.id, 'metadata_editing_started'))
@@ -325,7 +614,72 @@ async def handle_metadata_file(message):
         logger.error(f"Error handling metadata file: {e}")
         await bot.reply_to(message, get_text(message.from_user.id, 'download_failed'))
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_files and message.text)
+async def handle_batch_file(message):
+    """Add a file, or the audio files in a zip, to the user's batch"""
+    user_id = message.from_user.id
+    media = message.audio or message.document
+    if media is None:
+        await bot.reply_to(message, get_text(user_id, 'album_unsupported'))
+        return
+    if media.file_size and media.file_size > Config.FILE_SIZE_LIMIT:
+        await bot.reply_to(message, get_text(user_id, 'file_too_large'))
+        return
+    limit = get_text(user_id, 'album_limit').format(max_files=Config.BATCH_MAX_FILES, max_mb=Config.BATCH_MAX_BYTES // (1024 * 1024))
+    
+    batch = user_batches.get(user_id) or {'tracks': []}
+    room_files = Config.BATCH_MAX_FILES - len(batch['tracks'])
+    room_bytes = Config.BATCH_MAX_BYTES - sum(track['size'] for track in batch['tracks'])
+    try:
+        file_info = await bot.get_file(media.file_id)
+        downloaded_file = await bot.download_file(file_info.file_path)
+        file_name = media.file_name or os.path.basename(file_info.file_path)
+        workspace, files = await executor.run_io(save_upload, workspaces, downloaded_file, file_name, room_files, room_bytes)
+    except BatchTooLarge:
+        await bot.reply_to(message, limit)
+        return
+    except tagging.UnsupportedFormat:
+        await bot.reply_to(message, get_text(user_id, 'album_unsupported'))
+        return
+    except Exception as e:
+        logger.error(f"Error adding a file to a batch: {e}")
+        await bot.reply_to(message, get_text(user_id, 'download_failed'))
+        return
+    
+    # Other files may have been added (or the batch tagged) while this one downloaded.
+    # Nothing awaits between reading the batch and saving it, so concurrent uploads can't lose each other's tracks.
+    batch = user_batches.get(user_id)
+    if batch is None or len(batch['tracks']) + len(files) > Config.BATCH_MAX_FILES:
+        await executor.run_io(workspaces.remove, workspace)
+        await bot.reply_to(message, get_text(user_id, 'album_expired') if batch is None else limit)
+        return
+    batch['tracks'].extend(
+        {'workspace': workspace, 'path': path, 'name': name, 'size': size, 'order': [message.message_id, index]}
+        for index, (path, name, size) in enumerate(files)
+    )
+    user_batches[user_id] = batch
+    # The batch's earlier uploads are still wanted: keep the janitor from ageing out their workspaces
+    await executor.run_io(workspaces.touch, sorted({track['workspace'] for track in batch['tracks']}))
+    
+    received = get_text(user_id, 'album_received').format(
+        files=len(batch['tracks']),
+        size_mb=round(sum(track['size'] for track in batch['tracks']) / (1024 * 1024), 1)
+    )
+    batch_editor(user_id, batch).update(get_text(user_id, 'edit_album').format(max_files=Config.BATCH_MAX_FILES) + '\n\n' + received)
+
+def write_file_tags(file_path, file_name, metadata):
+    """Blocking: write tags to a saved file, in place when they fit in its padding (runs on the I/O pool)"""
+    with open(file_path, 'rb') as f:
+        fmt = tagging.detect_format(f.read(64), file_name or file_path)
+    return tagging.edit_tags(file_path, metadata, fmt, file_name or file_path)
+
+def tag_saved_file(file_path, file_name, metadata):
+    """Blocking: read a saved file once and tag it in memory, returning it ready to upload (runs on the I/O pool)"""
+    with open(file_path, 'rb') as f:
+        data = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(data)
+    return tagging.edit_bytes(data, metadata, file_name=file_name or file_path)
+
+@bot.message_handler(func=lambda message: message.text and (user_files.get(message.from_user.id) or {}).get('file_path'))
 async def handle_metadata_text(message):
     """Handle metadata text input"""
     try:
@@ -342,101 +696,269 @@ async def handle_metadata_text(message):
             await bot.reply_to(message, get_text(message.from_user.id, 'invalid_metadata_format'))
             return
         
-        # Get file info
-        file_info = user_files[message.from_user.id]
+        # Get file info (the session may have expired since the handler was picked)
+        file_info = user_files.get(message.from_user.id)
+        if not file_info or not file_info.get('file_path'):
+            await bot.reply_to(message, get_text(message.from_user.id, 'edit_metadata'))
+            return
         file_path = file_info['file_path']
         
-        # Update metadata
-        if file_path.endswith('.mp3') and METADATA_AVAILABLE:
-            # Load MP3 file
-            audio_file = MP3(file_path, ID3=ID3)
-            
-            # Add ID3 tag if it doesn't exist
-            try:
-                audio_file.add_tags()
-            except Exception:
-                pass  # Tags already exist
-            
-            # Update metadata
-            audio_file.tags.add(TIT2(encoding=3, text=metadata['title']))
-            audio_file.tags.add(TPE1(encoding=3, text=metadata['artist']))
-            audio_file.tags.add(TALB(encoding=3, text=metadata['album']))
-            
-            # Save file
-            audio_file.save()
-            
-            # Send updated file
-            with open(file_path, 'rb') as audio:
-                await bot.send_audio(message.chat.id, audio)
-            
-            # Clean up
-            del user_files[message.from_user.id]
-            os.remove(file_path)
-            
-            await bot.reply_to(message, get_text(message.from_user.id, 'metadata_updated'))
-        else:
+        # Update metadata off the event loop (MP3, M4A, FLAC, Ogg Vorbis/Opus)
+        try:
+            if not METADATA_AVAILABLE:
+                raise tagging.UnsupportedFormat("mutagen is not installed")
+            with metrics.stage('tag_edit', handler='metadata', provider='mutagen') as timer:
+                audio, edit = await executor.run_io(tag_saved_file, file_path, file_info.get('file_name'), metadata)
+                timer.outcome = 'in_place' if edit.in_place else 'rewritten'
+            metrics.count('tag_bytes_written_total', edit.bytes_written, format=edit.format)
+        except tagging.TagError as e:
+            logger.warning(f"Can't edit metadata of {file_info.get('file_name')}: {e}")
+            await executor.run_io(user_files.discard, message.from_user.id)
             await bot.reply_to(message, get_text(message.from_user.id, 'download_failed'))
+            return
+        
+        # Send the edited copy straight from memory; the saved file is only read, never written back
+        if edit.format in ('mp3', 'mp4'):
+            await bot.send_audio(message.chat.id, audio)
+        else:
+            await bot.send_document(message.chat.id, audio)  # Telegram only plays MP3/M4A as audio
+        
+        # Clean up
+        await executor.run_io(user_files.discard, message.from_user.id)
+        
+        await bot.reply_to(message, get_text(message.from_user.id, 'metadata_updated'))
     except Exception as e:
         logger.error(f"Error updating metadata: {e}")
         await bot.reply_to(message, get_text(message.from_user.id, 'download_failed'))
 
+def album_groups(tagged):
+    """Split tagged tracks into media groups of up to 10, keeping their order.
+
+    Telegram plays MP3/M4A as audio, the rest are sent as documents, and a group can't mix the two.
+    """
+    groups = []
+    for track, edit in tagged:
+        kind = 'audio' if edit.format in ('mp3', 'mp4') else 'document'
+        if not groups or groups[-1][0] != kind or len(groups[-1][1]) == 10:
+            groups.append((kind, []))
+        groups[-1][1].append(track)
+    return groups
+
+async def send_album(chat_id, tagged, progress, user_id):
+    """Send the tagged tracks back as media groups, streamed from their workspaces"""
+    sent = 0
+    for kind, tracks in album_groups(tagged):
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open(track['path'], 'rb')) for track in tracks]
+            if len(files) == 1:
+                # A media group needs at least two items
+                send = bot.send_audio if kind == 'audio' else bot.send_document
+                await send(chat_id, files[0])
+            else:
+                media = types.InputMediaAudio if kind == 'audio' else types.InputMediaDocument
+                await bot.send_media_group(chat_id, [media(f) for f in files])
+        sent += len(tracks)
+        progress.update(get_text(user_id, 'album_sending').format(sent=sent, total=len(tagged)))
+
+def remove_workspaces(paths):
+    """Blocking: remove a finished batch's workspaces (runs on the I/O pool)"""
+    for path in paths:
+        workspaces.remove(path)
+
+@bot.message_handler(func=lambda message: message.text and not message.text.startswith('/') and message.from_user.id in user_batches)
+async def handle_batch_text(message):
+    """Tag every file in the user's batch with the fields they sent, in parallel, and send them back"""
+    user_id = message.from_user.id
+    shared, overrides = parse_batch_metadata(message.text)
+    if not shared and not overrides:
+        await bot.reply_to(message, get_text(user_id, 'invalid_album_format'))
+        return
+    batch = user_batches.get(user_id)
+    if not batch or not batch['tracks']:
+        await bot.reply_to(message, get_text(user_id, 'album_no_files' if batch else 'album_expired'))
+        return
+    
+    # Take the batch out of the session: files sent from now on are recognised as usual, and the sweeper leaves these alone
+    user_batches.pop(user_id)
+    batch_progress.pop(user_id, None)  # An edit it still has pending just shows the final count
+    tracks = sorted(batch['tracks'], key=lambda track: track['order'])
+    total = len(tracks)
+    try:
+        status = await bot.reply_to(message, get_text(user_id, 'album_tagging').format(done=0, total=total))
+        progress = ThrottledEditor(lambda text: bot.edit_message_text(text, status.chat.id, status.message_id), Config.BATCH_PROGRESS_INTERVAL)
+        done = 0
+        failed = []
+        
+        async def tag(number, track):
+            nonlocal done
+            fields = track_fields(shared, overrides, number, total, track['name'])
+            try:
+                edit = await executor.run_io(write_file_tags, track['path'], track['name'], fields)
+                metrics.count('tag_bytes_written_total', edit.bytes_written, format=edit.format)
+            except (tagging.TagError, OSError) as e:
+                # One unreadable or missing file doesn't stop the rest of the batch
+                logger.warning(f"Can't tag {track['name']} in a batch: {e}")
+                failed.append(track['name'])
+                edit = None
+            done += 1
+            progress.update(get_text(user_id, 'album_tagging').format(done=done, total=total))
+            return edit
+        
+        # The I/O pool bounds how many files are tagged at once
+        with metrics.stage('tag_edit', handler='album', provider='mutagen'):
+            edits = await asyncio.gather(*(tag(number, track) for number, track in enumerate(tracks, 1)))
+        tagged = [(track, edit) for track, edit in zip(tracks, edits) if edit is not None]
+        
+        with metrics.stage('upload', handler='album', provider='telegram'):
+            await send_album(message.chat.id, tagged, progress, user_id)
+        
+        summary = get_text(user_id, 'album_done').format(done=len(tagged), total=total)
+        if failed:
+            summary += '\n' + get_text(user_id, 'album_failed').format(names=', '.join(failed))
+        await progress.finish(summary)
+        metrics.count('requests_total', handler='album', outcome='ok' if not failed else 'partial')
+    except Exception as e:
+        logger.error(f"Error tagging a batch: {e}")
+        metrics.count('requests_total', handler='album', outcome='error')
+        await bot.reply_to(message, get_text(user_id, 'download_failed'))
+    finally:
+        await executor.run_io(remove_workspaces, sorted({track['workspace'] for track in tracks}))
+
 @bot.message_handler(func=lambda message: message.text and message.text.startswith('http'))
 async def handle_link(message):
     """Handle social media links"""
     url = message.text
     
     # Notify user about downloading
-    downloading_msg = await bot.reply_to(message, get_text(message.from_user.id, 'downloading'))
+    with metrics.stage('reply', handler='link', provider='telegram'):
+        downloading_msg = await bot.reply_to(message, get_text(message.from_user.id, 'downloading'))
     
     try:
-        # Try to download based on URL
-        if 'youtube.com' in url or 'youtu.be' in url:
-            if YOUTUBE_AVAILABLE:
-                await download_youtube_video(message, url, downloading_msg)
-            else:
-                await download_generic_file(message, url, downloading_msg)
-        elif 'instagram.com' in url:
-            if INSTAGRAM_AVAILABLE:
-                await download_instagram_content(message, url, downloading_msg)
-            else:
-                await download_generic_file(message, url, downloading_msg)
+        # Media someone else already asked for is re-sent by file_id, without downloading it again
+        key = normalise_url(url)
+        if key and await send_cached_media(message, key, downloading_msg):
+            metrics.count('requests_total', handler='link', outcome='cached')
+            return
+        
+        if key:
+            # If someone is already downloading this link, wait for their upload and re-send its file_id
+            sent, shared = await link_downloads.do(key, download_link, message, url, downloading_msg, key)
+            if shared and not (sent and await send_cached_media(message, key, downloading_msg)):
+                sent = False
+                await bot.edit_message_text(
+                    get_text(message.from_user.id, 'download_failed'),
+                    message.chat.id,
+                    downloading_msg.message_id
+                )
+            metrics.count('requests_total', handler='link', outcome=('shared' if shared else 'sent') if sent else 'failed')
         else:
-            await download_generic_file(message, url, downloading_msg)
+            sent = await download_link(message, url, downloading_msg, key)
+            metrics.count('requests_total', handler='link', outcome='sent' if sent else 'failed')
     except Exception as e:
         logger.error(f"Error downloading content: {e}")
+        metrics.count('requests_total', handler='link', outcome='error')
         await bot.edit_message_text(
             get_text(message.from_user.id, 'download_failed'),
             message.chat.id,
             downloading_msg.message_id
         )
 
-async def download_youtube_video(message, url, downloading_msg):
+async def download_link(message, url, downloading_msg, key=None):
+    """Download and send a link's media, returning whether it was sent"""
+    # Try to download based on URL
+    if 'youtube.com' in url or 'youtu.be' in url:
+        if YOUTUBE_AVAILABLE:
+            return await download_youtube_video(message, url, downloading_msg, key)
+        return await download_generic_file(message, url, downloading_msg, key)
+    elif 'instagram.com' in url:
+        if INSTAGRAM_AVAILABLE:
+            return await download_instagram_content(message, url, downloading_msg, key)
+        return await download_generic_file(message, url, downloading_msg, key)
+    return await download_generic_file(message, url, downloading_msg)
+
+def rejected_file_id(error):
+    """Whether Telegram refused a file_id itself (400 wrong file identifier / file reference expired), rather than the request"""
+    description = (error.description or '').lower()
+    return error.error_code == 400 and ('file identifier' in description or 'file reference' in description)
+
+async def send_cached_media(message, key, downloading_msg):
+    """Re-send a previously uploaded file by its file_id. Returns False if there is none (or Telegram no longer accepts it);
+    any other error, such as a 429 flood limit, is raised without touching the cache."""
+    entry = await executor.run_io(media_cache.get, key)
+    if entry is None:
+        return False
+    try:
+        with metrics.stage('upload', handler='link', provider='telegram') as timer:
+            if entry['kind'] == 'video':
+                await bot.send_video(message.chat.id, entry['file_id'])
+            elif entry['kind'] == 'audio':
+                await bot.send_audio(message.chat.id, entry['file_id'])
+            else:
+                await bot.send_photo(message.chat.id, entry['file_id'])
+            timer.outcome = 'file_id'
+    except asyncio_helper.ApiTelegramException as e:
+        if not rejected_file_id(e):
+            # Flood limits, blocked users...: downloading and uploading again would not help, so let the caller handle it
+            raise
+        # Telegram refused the file_id (e.g. the file was removed), so fetch the media again
+        logger.info(f"Cached file for {key} no longer valid: {e}")
+        await executor.run_io(media_cache.invalidate, key)
+        return False
+    await bot.edit_message_text(
+        get_text(message.from_user.id, 'download_complete'),
+        message.chat.id,
+        downloading_msg.message_id
+    )
+    return True
+
+def remember_upload(key, sent):
+    """Blocking: cache the file_id of media we just uploaded for key (runs on the I/O pool)"""
+    if not key:
+        return
+    if sent.video:
+        media_cache.put(key, 'video', sent.video.file_id)
+    elif sent.audio:
+        media_cache.put(key, 'audio', sent.audio.file_id)
+    elif sent.photo:
+        media_cache.put(key, 'photo', sent.photo[-1].file_id)
+
+def fetch_youtube_video(url, video_path):
+    """Blocking: download the best progressive MP4 to video_path (runs on the I/O pool)"""
+    yt = pytube.YouTube(url)
+    stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
+    if not stream:
+        return False
+    stream.download(filename=video_path)
+    return True
+
+async def download_youtube_video(message, url, downloading_msg, key=None):
     """Download YouTube video"""
     try:
-        yt = YouTube(url)
-        stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
-        
-        if stream:
-            video_path = f"temp_yt_{message.from_user.id}_{message.id}.mp4"
-            stream.download(filename=video_path)
+        # The workspace (and the video in it) is removed however the block is left
+        with workspaces.open('youtube', reserve=Config.DOWNLOAD_MAX_BYTES) as workspace:
+            video_path = workspace.file('video.mp4')
             
-            # Send the downloaded video
-            with open(video_path, 'rb') as video:
+            with metrics.stage('download', handler='link', provider='youtube') as timer:
+                fetched = await executor.run_io(fetch_youtube_video, url, video_path, timeout=Config.DOWNLOAD_TASK_TIMEOUT)
+                timer.outcome = 'ok' if fetched else 'no_stream'
+            if fetched:
+                # Send the downloaded video
+                with open(video_path, 'rb') as video:
+                    await bot.edit_message_text(
+                        get_text(message.from_user.id, 'download_complete'),
+                        message.chat.id,
+                        downloading_msg.message_id
+                    )
+                    with metrics.stage('upload', handler='link', provider='telegram'):
+                        sent = await bot.send_video(message.chat.id, video)
+                    await executor.run_io(remember_upload, key, sent)
+                return True
+            else:
                 await bot.edit_message_text(
-                    get_text(message.from_user.id, 'download_complete'),
+                    get_text(message.from_user.id, 'download_failed'),
                     message.chat.id,
                     downloading_msg.message_id
                 )
-                await bot.send_video(message.chat.id, video)
-            
-            # Remove temporary file
-            os.remove(video_path)
-        else:
-            await bot.edit_message_text(
-                get_text(message.from_user.id, 'download_failed'),
-                message.chat.id,
-                downloading_msg.message_id
-            )
     except Exception as e:
         logger.error(f"YouTube download error: {e}")
         await bot.edit_message_text(
@@ -444,47 +966,55 @@ async def download_youtube_video(message, url, downloading_msg):
             message.chat.id,
             downloading_msg.message_id
         )
+    return False
+
+def fetch_instagram_post(shortcode, directory):
+    """Blocking: download a post's image/video into directory and list its media files, videos first (runs on the I/O pool)"""
+    loader = instaloader.Instaloader(dirname_pattern=directory, filename_pattern='{shortcode}', save_metadata=False, download_comments=False)
+    post = instaloader.Post.from_shortcode(loader.context, shortcode)
+    
+    # For simplicity, we'll download the post's image/video
+    loader.download_post(post, target=shortcode)
+    
+    # Find the downloaded file (skipping the caption .txt and the like)
+    files = [path for path in glob.glob(os.path.join(directory, f"{shortcode}*")) if path.endswith(('.mp4', '.jpg', '.jpeg', '.png', '.webp'))]
+    return sorted(files, key=lambda path: (not path.endswith('.mp4'), path))
 
-async def download_instagram_content(message, url, downloading_msg):
+async def download_instagram_content(message, url, downloading_msg, key=None):
     """Download Instagram content"""
     try:
-        loader = instaloader.Instaloader()
-        shortcode = url.split("/")[-2]
-        post = instaloader.Post.from_shortcode(loader.context, shortcode)
-        
-        # For simplicity, we'll download the post's image/video
-        loader.download_post(post, target_profile_name="temp")
-        
-        # Find the downloaded file
-        import glob
-        files = glob.glob(f"temp/{shortcode}*")
-        if files:
-            file_path = files[0]
-            with open(file_path, 'rb') as f:
-                if file_path.endswith('.mp4'):
-                    await bot.edit_message_text(
-                        get_text(message.from_user.id, 'download_complete'),
-                        message.chat.id,
-                        downloading_msg.message_id
-                    )
-                    await bot.send_video(message.chat.id, f)
-                else:
-                    await bot.edit_message_text(
-                        get_text(message.from_user.id, 'download_complete'),
-                        message.chat.id,
-                        downloading_msg.message_id
-                    )
-                    await bot.send_photo(message.chat.id, f)
-            
-            # Clean up
-            import shutil
-            shutil.rmtree("temp")
-        else:
-            await bot.edit_message_text(
-                get_text(message.from_user.id, 'download_failed'),
-                message.chat.id,
-                downloading_msg.message_id
-            )
+        shortcode = instagram_shortcode(url) or url.split("/")[-2]
+        with workspaces.open('instagram', reserve=Config.DOWNLOAD_MAX_BYTES) as workspace:
+            with metrics.stage('download', handler='link', provider='instagram') as timer:
+                files = await executor.run_io(fetch_instagram_post, shortcode, workspace.path, timeout=Config.DOWNLOAD_TASK_TIMEOUT)
+                timer.outcome = 'ok' if files else 'no_files'
+            if files:
+                file_path = files[0]
+                with open(file_path, 'rb') as f:
+                    if file_path.endswith('.mp4'):
+                        await bot.edit_message_text(
+                            get_text(message.from_user.id, 'download_complete'),
+                            message.chat.id,
+                            downloading_msg.message_id
+                        )
+                        with metrics.stage('upload', handler='link', provider='telegram'):
+                            sent = await bot.send_video(message.chat.id, f)
+                    else:
+                        await bot.edit_message_text(
+                            get_text(message.from_user.id, 'download_complete'),
+                            message.chat.id,
+                            downloading_msg.message_id
+                        )
+                        with metrics.stage('upload', handler='link', provider='telegram'):
+                            sent = await bot.send_photo(message.chat.id, f)
+                    await executor.run_io(remember_upload, key, sent)
+                return True
+            else:
+                await bot.edit_message_text(
+                    get_text(message.from_user.id, 'download_failed'),
+                    message.chat.id,
+                    downloading_msg.message_id
+                )
     except Exception as e:
         logger.error(f"Instagram download error: {e}")
         await bot.edit_message_text(
@@ -492,46 +1022,42 @@ async def download_instagram_content(message, url, downloading_msg):
             message.chat.id,
             downloading_msg.message_id
         )
+    return False
 
-async def download_generic_file(message, url, downloading_msg):
+async def download_generic_file(message, url, downloading_msg, key=None):
     """Download generic file"""
     try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        
-        # Try to get file extension from URL or content type
-        content_type = response.headers.get('content-type', '')
-        file_extension = '.mp4'  # default
-        
-        if 'video' in content_type:
-            file_extension = '.mp4'
-        elif 'audio' in content_type:
-            file_extension = '.mp3'
-        elif 'image' in content_type:
-            file_extension = '.jpg'
-        
-        file_path = f"temp_generic_{message.from_user.id}_{message.id}{file_extension}"
-        
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        
-        # Send the downloaded file
-        with open(file_path, 'rb') as f:
+        # Stream the file without blocking the event loop, capped at the upload limit
+        with metrics.stage('download', handler='link', provider='http') as timer:
+            try:
+                download = await http_downloader.fetch(url)
+            except DownloadTooLarge:
+                timer.outcome = 'too_large'
+                raise
+        with download:
             await bot.edit_message_text(
                 get_text(message.from_user.id, 'download_complete'),
                 message.chat.id,
                 downloading_msg.message_id
             )
             
-            if file_extension == '.mp4':
-                await bot.send_video(message.chat.id, f)
-            elif file_extension == '.mp3':
-                await bot.send_audio(message.chat.id, f)
-            else:
-                await bot.send_photo(message.chat.id, f)
-        
-        # Remove temporary file
-        os.remove(file_path)
+            # Send the downloaded file
+            with metrics.stage('upload', handler='link', provider='telegram'):
+                if download.kind == 'video':
+                    sent = await bot.send_video(message.chat.id, download.file)
+                elif download.kind == 'audio':
+                    sent = await bot.send_audio(message.chat.id, download.file)
+                else:
+                    sent = await bot.send_photo(message.chat.id, download.file)
+            await executor.run_io(remember_upload, key, sent)
+        return True
+    except DownloadTooLarge as e:
+        logger.info(f"Generic download too large: {e}")
+        await bot.edit_message_text(
+            get_text(message.from_user.id, 'download_too_large'),
+            message.chat.id,
+            downloading_msg.message_id
+        )
     except Exception as e:
         logger.error(f"Generic download error: {e}")
         await bot.edit_message_text(
@@ -539,70 +1065,159 @@ async def download_generic_file(message, url, downloading_msg):
             message.chat.id,
             downloading_msg.message_id
         )
+    return False
+
+def compact_tracks(result):
+    """Keep only the fields the inline results use"""
+    return [
+        {'title': track.get('title', 'Unknown Track'), 'subtitle': track.get('subtitle', 'Unknown Artist'), 'key': track.get('key', '')}
+        for track in result.get('tracks', [])
+    ]
+
+def build_inline_results(tracks, trending=False):
+    """Turn cached tracks into inline article results"""
+    results = []
+    for i, track in enumerate(tracks):
+        title = track['title']
+        artist = track['subtitle']
+        track_id = track['key']
+        
+        if trending:
+            text = f"🔥 Trending: {title}\n👤 {artist}\n🔗 [Listen on Shazam](https://www.shazam.com/track/{track_id})"
+        else:
+            text = f"🎵 {title}\n👤 {artist}\n🔗 [Listen on Shazam](https://www.shazam.com/track/{track_id})"
+        
+        # Create article result
+        results.append(types.InlineQueryResultArticle(
+            str(i),
+            title=f"{title} - {artist}",
+            description="Trending track" if trending else artist,
+            input_message_content=types.InputTextMessageContent(text, parse_mode='Markdown')
+        ))
+    return results
 
 # Inline mode handler
 @bot.inline_handler(lambda query: True)
 async def inline_query_handler(inline_query):
     """Handle inline queries for music search"""
-    query_text = inline_query.query
+    query_text = normalise_query(inline_query.query)
+    user_id = inline_query.from_user.id
     
+    # A newer keystroke from the same user makes any query still in flight stale
+    inline_queries.begin(user_id)
     try:
-        if query_text:
-            # Search for tracks using ShazamIO
-            shazam = Shazam()
-            search_result = await shazam.search_track(query=query_text, limit=10)
-            
-            results = []
-            if 'tracks' in search_result:
-                for i, track in enumerate(search_result['tracks']):
-                    # Create result item
-                    title = track.get('title', 'Unknown Track')
-                    artist = track.get('subtitle', 'Unknown Artist')
-                    track_id = track.get('key', '')
-                    
-                    # Create article result
-                    result = types.InlineQueryResultArticle(
-                        str(i),
-                        title=f"{title} - {artist}",
-                        description=artist,
-                        input_message_content=types.InputTextMessageContent(
-                            f"🎵 {title}\n👤 {artist}\n🔗 [Listen on Shazam](https://www.shazam.com/track/{track_id})",
-                            parse_mode='Markdown'
-                        )
-                    )
-                    results.append(result)
-            
-            # Answer the inline query
-            await bot.answer_inline_query(inline_query.id, results, cache_time=1, is_personal=True)
-        else:
-            # Show trending tracks if no query
-            shazam = Shazam()
-            trending = await shazam.top_world_tracks(limit=10)
-            
-            results = []
-            if 'tracks' in trending:
-                for i, track in enumerate(trending['tracks']):
-                    title = track.get('title', 'Unknown Track')
-                    artist = track.get('subtitle', 'Unknown Artist')
-                    track_id = track.get('key', '')
-                    
-                    result = types.InlineQueryResultArticle(
-                        str(i),
-                        title=f"{title} - {artist}",
-                        description="Trending track",
-                        input_message_content=types.InputTextMessageContent(
-                            f"🔥 Trending: {title}\n👤 {artist}\n🔗 [Listen on Shazam](https://www.shazam.com/track/{track_id})",
-                            parse_mode='Markdown'
-                        )
-                    )
-                    results.append(result)
-            
-            await bot.answer_inline_query(inline_query.id, results, cache_time=1, is_personal=True)
+        with metrics.stage('cache_lookup', handler='inline', provider='cache') as timer:
+            tracks = inline_cache.get(query_text)
+            timer.outcome = 'miss' if tracks is None else 'hit'
+        if tracks is None:
+            if query_text:
+                # Wait for the user to stop typing before searching
+                await asyncio.sleep(Config.INLINE_DEBOUNCE)
+                
+                # Search for tracks using ShazamIO
+                with metrics.stage('search', handler='inline', provider='shazam'):
+                    async with shazam_pool.borrow() as shazam:
+                        result = await shazam.search_track(query=query_text, limit=Config.INLINE_RESULTS)
+            else:
+                # Show trending tracks if no query
+                with metrics.stage('trending', handler='inline', provider='shazam'):
+                    async with shazam_pool.borrow() as shazam:
+                        result = await shazam.top_world_tracks(limit=Config.INLINE_RESULTS)
+            tracks = compact_tracks(result)
+            inline_cache.put(query_text, tracks, None if query_text else Config.INLINE_TRENDING_TTL)
+        
+        if not inline_queries.is_latest(user_id):
+            metrics.count('requests_total', handler='inline', outcome='stale')
+            return
+        
+        # Search results are the same for everyone, so let Telegram cache them too
+        with metrics.stage('answer', handler='inline', provider='telegram'):
+            await bot.answer_inline_query(
+                inline_query.id,
+                build_inline_results(tracks, trending=not query_text),
+                cache_time=Config.INLINE_CACHE_TIME,
+                is_personal=False
+            )
+        metrics.count('requests_total', handler='inline', outcome='answered')
+    except asyncio.CancelledError:
+        metrics.count('requests_total', handler='inline', outcome='cancelled')
     except Exception as e:
         logger.error(f"Inline query error: {e}")
+        metrics.count('requests_total', handler='inline', outcome='error')
+    finally:
+        inline_queries.end(user_id)
+
+def start_session_sweepers():
+    """Expire abandoned metadata edits and batches (deleting their files) and trim the language table in the background"""
+    user_files.start_sweeper(Config.SESSION_SWEEP_INTERVAL)
+    user_batches.start_sweeper(Config.SESSION_SWEEP_INTERVAL)
+    user_languages.start_sweeper(Config.SESSION_SWEEP_INTERVAL)
+
+# Fire-and-forget tasks, kept here until they finish: the event loop only holds weak references to tasks
+background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def warm_backends():
+    """Import shazamio off the event loop once updates are flowing, so the first recognition doesn't pay for it"""
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, 'shazamio')
+    except ImportError as e:
+        logger.error(f"Shazam backend unavailable: {e}")
+
+async def run_polling():
+    # getUpdates is refused while a webhook is set, e.g. after switching back from webhook mode
+    await bot.remove_webhook()
+    start_background_task(warm_backends())
+    start_session_sweepers()
+    await bot.polling()
+
+async def run_webhook():
+    """Receive updates over HTTPS instead of polling for them"""
+    from webhook_server import WebhookServer
+    secret_token = Config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(bot, Config.WEBHOOK_PATH, secret_token, Config.WEBHOOK_MAX_IN_FLIGHT)
+    await server.start(Config.WEBHOOK_LISTEN, Config.WEBHOOK_PORT)
+    start_background_task(warm_backends())
+    start_session_sweepers()
+    await bot.set_webhook(
+        url=Config.WEBHOOK_URL.rstrip('/') + Config.WEBHOOK_PATH,
+        secret_token=secret_token,
+        max_connections=Config.WEBHOOK_MAX_CONNECTIONS
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        logger.info(f"Webhook stats: {server.stats()}")
+
+async def run_worker():
+    """Handle the updates ingress.py forwards to this process instead of fetching them from Telegram"""
+    from webhook_server import WebhookServer
+    server = WebhookServer(bot, Config.WEBHOOK_PATH, Config.WORKER_SECRET or None, Config.WEBHOOK_MAX_IN_FLIGHT)
+    await server.start('127.0.0.1', Config.WORKER_PORT)
+    start_background_task(warm_backends())
+    start_session_sweepers()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        logger.info(f"Worker stats: {server.stats()}")
 
 # Run the bot
 if __name__ == '__main__':
     print("Bot is starting...")
     print(f"Bot token: {BOT_TOKEN[:5]}...")
-    asyncio.run(bot.polling())
\ No newline at end of file
+    if metrics.enabled:
+        metrics.serve(Config.METRICS_LISTEN, Config.METRICS_PORT)
+    workspaces.startJanitor()
+    if Config.WORKER_PORT:
+        asyncio.run(run_worker())
+    elif Config.WEBHOOK_URL:
+        asyncio.run(run_webhook())
+    else:
+        asyncio.run(run_polling())
\ No newline at end of file
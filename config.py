@@ -8,6 +8,9 @@ class Config:
     # Telegram Bot Token
     BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
     
+    # User IDs allowed to use admin commands such as /stats (comma separated)
+    ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+    
     # File size limit for music recognition (20MB)
     FILE_SIZE_LIMIT = 20 * 1024 * 1024
     
@@ -20,11 +23,101 @@ class Config:
     # Default language
     DEFAULT_LANGUAGE = 'en'
     
-    # Temporary directory for file processing
-    TEMP_DIR = 'temp'
+    # Scratch space: every download/edit gets its own directory under WORKSPACE_DIR, removed when it is done
+    WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "")  # Empty: /dev/shm/songid when there is room for the quota, else the system temp directory
+    WORKSPACE_QUOTA = int(os.getenv("WORKSPACE_QUOTA", 1024 * 1024 * 1024))  # Bytes all workspaces may hold at once
+    WORKSPACE_ORPHAN_AGE = int(os.getenv("WORKSPACE_ORPHAN_AGE", 3600))  # Seconds before leftover scratch files are removed
+    WORKSPACE_JANITOR_INTERVAL = float(os.getenv("WORKSPACE_JANITOR_INTERVAL", 300))  # Seconds between orphan sweeps
+    
+    # Downloads larger than this are spilled to SPILL_DIR instead of being held in memory
+    SPILL_THRESHOLD = int(os.getenv("SPILL_THRESHOLD", FILE_SIZE_LIMIT))
+    SPILL_DIR = os.getenv("SPILL_DIR", None)  # None uses a spill directory in the workspace root
+    
+    # Decode and trim uploads to a short mono WAV (needs ffmpeg) before recognition
+    PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "1") == "1"
+    PREPROCESS_START = float(os.getenv("PREPROCESS_START", 0))  # Seconds to skip from the start
+    PREPROCESS_SECONDS = float(os.getenv("PREPROCESS_SECONDS", 30))  # Length of the window to keep
+    PREPROCESS_SAMPLE_RATE = int(os.getenv("PREPROCESS_SAMPLE_RATE", 16000))
+    
+    # Pooled Shazam clients (shared keep-alive HTTP session)
+    SHAZAM_POOL_SIZE = int(os.getenv("SHAZAM_POOL_SIZE", 8))
+    SHAZAM_POOL_IDLE_TIMEOUT = float(os.getenv("SHAZAM_POOL_IDLE_TIMEOUT", 300))  # Seconds
+    SHAZAM_API_URL = os.getenv("SHAZAM_API_URL", "")  # Send Shazam requests to this server instead (local benchmarks)
+    
+    # Bot API server, e.g. a local telegram-bot-api server or the benchmark's fake one (empty for api.telegram.org)
+    TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+    
+    # Recognition job queue
+    QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", 4))  # Files downloaded/recognized at the same time
+    QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", 200))  # Jobs waiting before new ones are refused
+    QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", 3))  # Jobs one user may have waiting
+    
+    # Inline search
+    INLINE_RESULTS = 10  # Tracks per inline answer
+    INLINE_SEARCH_TTL = int(os.getenv("INLINE_SEARCH_TTL", 600))  # Seconds to keep search results
+    INLINE_TRENDING_TTL = int(os.getenv("INLINE_TRENDING_TTL", 1800))  # Seconds to keep the trending list
+    INLINE_CACHE_ENTRIES = int(os.getenv("INLINE_CACHE_ENTRIES", 5000))
+    INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))  # Seconds Telegram may cache an answer
+    INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.35))  # Seconds to wait for the user to stop typing
+    
+    # Generic link downloads
+    DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", 50 * 1024 * 1024))  # Telegram's bot upload limit
+    DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 30))  # Seconds without data before giving up
+    DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", 20))  # Shared connection pool size
+    DOWNLOAD_TASK_TIMEOUT = float(os.getenv("DOWNLOAD_TASK_TIMEOUT", 300))  # Seconds for a YouTube/Instagram download
+    
+    # Executors for blocking library calls
+    EXECUTOR_IO_WORKERS = int(os.getenv("EXECUTOR_IO_WORKERS", 8))
+    EXECUTOR_TIMEOUT = float(os.getenv("EXECUTOR_TIMEOUT", 120))  # Default seconds per task
+    
+    # Webhook mode: set WEBHOOK_URL (the public https:// base URL) to receive updates over HTTP instead of polling
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # A random one is generated on start when empty
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # Parallel connections Telegram may open
+    WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", 256))  # Updates handled at the same time
+    
+    # Multi-process mode: `python ingress.py` receives updates and routes each chat to one of INGRESS_WORKERS bot.py processes
+    INGRESS_WORKERS = int(os.getenv("INGRESS_WORKERS", os.cpu_count() or 2))
+    INGRESS_BASE_PORT = int(os.getenv("INGRESS_BASE_PORT", 8600))  # Workers listen on 127.0.0.1 from this port up
+    INGRESS_MAX_QUEUED = int(os.getenv("INGRESS_MAX_QUEUED", 1000))  # Updates waiting per worker; more for a worker that can't keep up are dropped
+    INGRESS_DRAIN_TIMEOUT = float(os.getenv("INGRESS_DRAIN_TIMEOUT", 10))  # Seconds on shutdown to hand queued updates to the workers
+    WORKER_PORT = int(os.getenv("WORKER_PORT", 0))  # Set by ingress.py: handle updates it posts here instead of polling
+    WORKER_SECRET = os.getenv("WORKER_SECRET", "")  # Set by ingress.py
+    
+    # Per-user state (language, pending metadata edits): 'memory' or 'sqlite:<path>' to share it between processes
+    STATE_STORE = os.getenv("STATE_STORE", "memory")
+    LANGUAGE_MAX_ENTRIES = int(os.getenv("LANGUAGE_MAX_ENTRIES", 100000))  # Least recently seen users beyond this fall back to the default
+    METADATA_SESSION_TTL = int(os.getenv("METADATA_SESSION_TTL", 1800))  # Seconds before an unfinished metadata edit (and its file) is dropped
+    METADATA_SESSION_MAX_ENTRIES = int(os.getenv("METADATA_SESSION_MAX_ENTRIES", 1000))  # Metadata edits waiting at once
+    BATCH_SESSION_TTL = int(os.getenv("BATCH_SESSION_TTL", 3600))  # Seconds before an unfinished /edit_album batch (and its files) is dropped
+    BATCH_SESSION_MAX_ENTRIES = int(os.getenv("BATCH_SESSION_MAX_ENTRIES", 200))  # Batches waiting at once
+    BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 50))  # Files per batch
+    BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 300 * 1024 * 1024))  # Bytes per batch, after unzipping
+    BATCH_PROGRESS_INTERVAL = float(os.getenv("BATCH_PROGRESS_INTERVAL", 3))  # Seconds between edits of a batch's progress message
+    SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", 60))  # Seconds between sweeps for expired sessions
+    
+    # Prometheus metrics (per-stage latency histograms and counters) served at /metrics
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+    METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
     
     # Data directory for persistent storage
     DATA_DIR = 'data'
+
+    # Telegram file_ids of uploaded YouTube/Instagram media, so popular links are re-sent without downloading
+    MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", os.path.join(DATA_DIR, 'media_cache.sqlite'))
+    MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", 30 * 24 * 3600))  # Seconds to keep a file_id
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+    # Recognition result cache (memory LRU + on-disk SQLite)
+    CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(DATA_DIR, 'recognition_cache.sqlite'))
+    CACHE_MEMORY_ENTRIES = int(os.getenv("CACHE_MEMORY_ENTRIES", 1024))
+    CACHE_TTL = int(os.getenv("CACHE_TTL", 7 * 24 * 3600))  # Seconds to keep a match
+    CACHE_MISS_TTL = int(os.getenv("CACHE_MISS_TTL", 6 * 3600))  # Seconds to remember a file had no match
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
     
     # Enable/disable features
     ENABLE_YOUTUBE_DOWNLOAD = True
@@ -0,0 +1,92 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TaskTimeout(Exception):
+    """Raised when an offloaded task runs past its timeout"""
+
+
+class _PoolStats:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> dict:
+        in_flight = self.submitted - self.finished - self.cancelled
+        busy = self.started - self.finished
+        return {
+            'workers': self.workers,
+            'busy': busy,
+            'queued': max(0, in_flight - busy),
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'cancelled': self.cancelled,
+        }
+
+
+class TaskExecutor:
+    """Runs blocking library calls off the event loop.
+
+    run_io() uses a thread pool for network/disk bound work (pytube, instaloader,
+    mutagen, file writes, hashing, ffmpeg). There is no process pool: hashlib releases
+    the GIL on large buffers and ffmpeg already runs in a process of its own, so
+    pickling 20MB uploads over to another process would only add a copy. Tasks take
+    a timeout; a task that has not started yet is cancelled when it times out or its
+    caller is cancelled.
+    """
+
+    def __init__(self, io_workers: int = 8, default_timeout: Optional[float] = 120):
+        self.default_timeout = default_timeout
+        self._io = concurrent.futures.ThreadPoolExecutor(io_workers, thread_name_prefix='io')
+        self._io_stats = _PoolStats(io_workers)
+
+    def _tracked(self, stats: _PoolStats, fn: Callable, *args, **kwargs):
+        """Wrapper run in the worker thread, so we know when queued work actually starts"""
+        with stats._lock:
+            stats.started += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with stats._lock:
+                stats.finished += 1
+
+    async def _run(self, stats: _PoolStats, future, timeout, name):
+        timeout = self.default_timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            stats.timed_out += 1
+            raise TaskTimeout(f"{name} took longer than {timeout}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.failed += 1
+            raise
+        finally:
+            if future.cancelled():
+                stats.cancelled += 1
+
+    async def run_io(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """Run a blocking I/O bound call on the thread pool"""
+        self._io_stats.submitted += 1
+        future = self._io.submit(self._tracked, self._io_stats, fn, *args, **kwargs)
+        return await self._run(self._io_stats, future, timeout, getattr(fn, '__name__', 'task'))
+
+    def stats(self) -> dict:
+        return {'io': self._io_stats.snapshot()}
+
+    def shutdown(self, wait: bool = False):
+        self._io.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,136 @@
+import io
+import logging
+import os
+import tempfile
+from typing import Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadTooLarge(Exception):
+    """Raised when a download goes over the byte cap"""
+
+
+# (magic bytes, offset, kind, extension). Checked in order, first match wins.
+MAGIC = [
+    (b'ftypM4A', 4, 'audio', '.m4a'),
+    (b'ftyp', 4, 'video', '.mp4'),
+    (b'\x1a\x45\xdf\xa3', 0, 'video', '.webm'),
+    (b'ID3', 0, 'audio', '.mp3'),
+    (b'\xff\xfb', 0, 'audio', '.mp3'),
+    (b'\xff\xf3', 0, 'audio', '.mp3'),
+    (b'\xff\xf2', 0, 'audio', '.mp3'),
+    (b'OggS', 0, 'audio', '.ogg'),
+    (b'fLaC', 0, 'audio', '.flac'),
+    (b'WAVE', 8, 'audio', '.wav'),
+    (b'\xff\xd8\xff', 0, 'image', '.jpg'),
+    (b'\x89PNG', 0, 'image', '.png'),
+    (b'GIF8', 0, 'image', '.gif'),
+    (b'WEBP', 8, 'image', '.webp'),
+]
+
+
+def sniff(content_type: str, head: bytes) -> Tuple[str, str]:
+    """Work out (kind, extension) from the first bytes, falling back to the Content-Type header"""
+    for magic, offset, kind, extension in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return kind, extension
+    content_type = content_type.lower()
+    if 'video' in content_type:
+        return 'video', '.mp4'
+    elif 'audio' in content_type:
+        return 'audio', '.mp3'
+    elif 'image' in content_type:
+        return 'image', '.jpg'
+    return 'video', '.mp4'  # default
+
+
+class Download:
+    """A finished download: in memory, or in a single spill file once it grew past the threshold"""
+
+    def __init__(self, file, size: int, kind: str, extension: str, spill_path: Optional[str] = None):
+        self.file = file
+        self.size = size
+        self.kind = kind
+        self.extension = extension
+        self.spill_path = spill_path
+
+    def close(self):
+        self.file.close()
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingDownloader:
+    """Async HTTP downloader that streams into memory (or one spill file) with a hard byte cap"""
+
+    def __init__(self, max_bytes: int, spill_threshold: int, spill_dir: Optional[str] = None,
+                 timeout: float = 30, connections: int = 20, chunk_size: int = 64 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.timeout = timeout
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Shared session and connection pool, created inside the running event loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=self.timeout)
+            )
+        return self._session
+
+    async def fetch(self, url: str) -> Download:
+        async with self.session().get(url) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > self.max_bytes:
+                raise DownloadTooLarge(f"{url} is {response.content_length} bytes")
+
+            buffer = io.BytesIO()
+            spill_path = None
+            size = 0
+            head = b''
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise DownloadTooLarge(f"{url} is over {self.max_bytes} bytes")
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                    if spill_path is None and size > self.spill_threshold:
+                        # Too big to keep in memory, move what we have to a spill file
+                        fd, spill_path = tempfile.mkstemp(prefix='download_', dir=self.spill_dir)
+                        os.close(fd)
+                        spill = open(spill_path, 'w+b')
+                        spill.write(buffer.getbuffer())
+                        buffer = spill
+                    buffer.write(chunk)
+            except BaseException:
+                buffer.close()
+                if spill_path is not None:
+                    os.remove(spill_path)
+                raise
+
+            kind, extension = sniff(response.headers.get('content-type', ''), head)
+        if spill_path is None:
+            buffer.name = f"download{extension}"  # Telegram uses this as the upload's file name
+        buffer.seek(0)
+        return Download(buffer, size, kind, extension, spill_path)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
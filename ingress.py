@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from config import Config
+from webhook_server import SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Where the chat (or, for updates without one, the user) of each kind of update is found
+_CHAT_PATHS = (
+    ('message', 'chat'), ('edited_message', 'chat'), ('channel_post', 'chat'), ('edited_channel_post', 'chat'),
+    ('callback_query', 'message', 'chat'), ('my_chat_member', 'chat'), ('chat_member', 'chat'), ('chat_join_request', 'chat'),
+)
+_USER_KINDS = ('callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer')
+
+
+def routing_key(update: dict) -> Optional[int]:
+    """The chat id an update belongs to (the user id for inline queries and the like), or None"""
+    for path in _CHAT_PATHS:
+        node = update
+        for part in path:
+            node = node.get(part) if isinstance(node, dict) else None
+        if isinstance(node, dict) and 'id' in node:
+            return node['id']
+    for kind in _USER_KINDS:
+        payload = update.get(kind)
+        if isinstance(payload, dict):
+            user = payload.get('from') or payload.get('user')
+            if isinstance(user, dict) and 'id' in user:
+                return user['id']
+    return None
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Each node is placed on the ring at `replicas` points, so keys spread evenly and
+    adding or removing a node only moves the keys next to its points (about 1/N of
+    them) instead of reshuffling every chat between workers.
+    """
+
+    def __init__(self, nodes: List[int], replicas: int = 128):
+        self._points = sorted((_hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, node in self._points]
+
+    def node_for(self, key) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._points)
+        return self._points[index][1]
+
+
+class Worker:
+    """One bot.py process and the queue of updates waiting to be forwarded to it.
+
+    Updates are posted one at a time in the order they arrived, so a chat's updates
+    reach its worker in order. While the worker is down (starting or restarting)
+    they wait in the queue and are retried. The queue is bounded: once a worker has
+    `max_queued` updates waiting, further ones for it are dropped and counted rather
+    than holding up every other worker's chats.
+    """
+
+    def __init__(self, index: int, port: int, secret: str, env: Dict[str, str], max_queued: int):
+        self.index = index
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}{Config.WEBHOOK_PATH}'
+        self.secret = secret
+        self.env = env
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.forwarded = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.retries = 0
+        self.restarts = 0
+        self._stopping = False
+
+    async def supervise(self):
+        """Run the worker process, restarting it (with backoff) whenever it exits"""
+        backoff = 1.0
+        while not self._stopping:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, 'bot.py'), cwd=ROOT, env=self.env)
+            logger.info(f"Worker {self.index} started (pid {self.process.pid}, port {self.port})")
+            code = await self.process.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, 30.0)
+            logger.error(f"Worker {self.index} exited with code {code}, restarting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+
+    async def forward(self, session: aiohttp.ClientSession):
+        while True:
+            update = await self.queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with session.post(self.url, json=update, headers={SECRET_HEADER: self.secret}) as response:
+                        if response.status < 500:
+                            if response.status == 200:
+                                self.forwarded += 1
+                            else:
+                                self.dropped += 1
+                                logger.error(f"Worker {self.index} refused update {update.get('update_id')}: HTTP {response.status}")
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            self.queue.task_done()
+
+    def offer(self, update: dict) -> bool:
+        """Queue an update without waiting; False if the queue is full"""
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.overflowed += 1
+            return False
+        return True
+
+    async def drain(self, timeout: float):
+        """Wait for everything queued to be forwarded"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Worker {self.index}: {self.queue.qsize()} queued updates were not delivered before shutdown")
+
+    async def stop(self, timeout: float = 10):
+        self._stopping = True
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+    def stats(self) -> dict:
+        return {
+            'pid': self.process.pid if self.process is not None else None,
+            'queued': self.queue.qsize(),
+            'forwarded': self.forwarded,
+            'dropped': self.dropped,
+            'overflowed': self.overflowed,
+            'retries': self.retries,
+            'restarts': self.restarts,
+        }
+
+
+class Ingress:
+    """Receives updates from Telegram once and routes each chat's updates to the same worker process.
+
+    Workers are bot.py processes started with WORKER_PORT set, which makes them handle
+    updates posted to them instead of polling Telegram themselves. Routing is by
+    consistent hashing on the chat id, so a chat's in-memory state (job queue,
+    inline debouncing...) stays in one process and its updates are handled in order,
+    while recognition work is spread over every core.
+    """
+
+    def __init__(self, workers: int, base_port: int, max_queued: int = 1000, drain_timeout: float = 10):
+        self.secret = secrets.token_urlsafe(32)
+        env = dict(os.environ, WORKER_SECRET=self.secret)
+        self.workers = []
+        for index in range(workers):
+            worker_env = dict(env, WORKER_ID=str(index), WORKER_PORT=str(base_port + index), METRICS_PORT=str(Config.METRICS_PORT + 1 + index))
+            self.workers.append(Worker(index, base_port + index, self.secret, worker_env, max_queued))
+        self.ring = HashRing([worker.index for worker in self.workers])
+        api_url = (Config.TELEGRAM_API_URL or 'https://api.telegram.org').rstrip('/')
+        self.api = f'{api_url}/bot{Config.BOT_TOKEN}'
+        self.drain_timeout = drain_timeout
+        self.received = 0
+        self.unroutable = 0
+        self._next_worker = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def route(self, update: dict):
+        """Queue an update for its chat's worker, or drop it if that worker's queue is full"""
+        self.received += 1
+        key = routing_key(update)
+        if key is None:
+            # No chat or user to keep together, so just spread these out
+            self.unroutable += 1
+            worker = self.workers[self._next_worker % len(self.workers)]
+            self._next_worker += 1
+        else:
+            worker = self.workers[self.ring.node_for(key)]
+        # Telegram considers the update delivered already, but waiting here would stall every other worker too
+        if not worker.offer(update):
+            logger.warning(f"Worker {worker.index} has {worker.queue.qsize()} updates queued, dropped update {update.get('update_id')}")
+
+    async def _call(self, session: aiohttp.ClientSession, method: str, http_timeout: float = 10, **params):
+        params = {name: value for name, value in params.items() if value is not None}
+        async with session.post(f'{self.api}/{method}', json=params, timeout=aiohttp.ClientTimeout(total=http_timeout)) as response:
+            data = await response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"{method} failed: {data.get('description')}")
+        return data['result']
+
+    async def poll(self, session: aiohttp.ClientSession, timeout: int = 30):
+        """Long-poll getUpdates and route everything it returns"""
+        # getUpdates is refused while a webhook is set, e.g. after switching back from webhook mode
+        await self._call(session, 'deleteWebhook')
+        offset = None
+        while True:
+            try:
+                updates = await self._call(session, 'getUpdates', http_timeout=timeout + 10, offset=offset, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                logger.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.route(update)
+
+    async def serve_webhook(self, session: aiohttp.ClientSession):
+        """Receive updates from Telegram over HTTPS and route them"""
+        secret = Config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+        async def receive(request: web.Request) -> web.Response:
+            if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), secret.encode()):
+                return web.Response(status=401)
+            try:
+                update = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            self.route(update)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(Config.WEBHOOK_PATH, receive)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, Config.WEBHOOK_LISTEN, Config.WEBHOOK_PORT).start()
+        await self._call(session, 'setWebhook', url=Config.WEBHOOK_URL.rstrip('/') + Config.WEBHOOK_PATH, secret_token=secret, max_connections=Config.WEBHOOK_MAX_CONNECTIONS)
+        logger.info(f"Webhook listening on {Config.WEBHOOK_LISTEN}:{Config.WEBHOOK_PORT}{Config.WEBHOOK_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def report(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"Ingress stats: {self.stats()}")
+
+    async def run(self):
+        async with aiohttp.ClientSession() as session:
+            for worker in self.workers:
+                self._tasks.append(asyncio.create_task(worker.supervise()))
+                self._tasks.append(asyncio.create_task(worker.forward(session)))
+            self._tasks.append(asyncio.create_task(self.report()))
+            try:
+                if Config.WEBHOOK_URL:
+                    await self.serve_webhook(session)
+                else:
+                    await self.poll(session)
+            finally:
+                # Updates already taken from Telegram are only in the queues, so hand them over before the workers stop
+                await asyncio.gather(*(worker.drain(self.drain_timeout) for worker in self.workers))
+                for task in self._tasks:
+                    task.cancel()
+                await asyncio.gather(*(worker.stop() for worker in self.workers))
+                logger.info(f"Ingress stats: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'unroutable': self.unroutable,
+            'workers': {worker.index: worker.stats() for worker in self.workers},
+        }
+
+
+async def _main(args):
+    ingress = Ingress(args.workers, args.base_port, args.max_queued, Config.INGRESS_DRAIN_TIMEOUT)
+    task = asyncio.create_task(ingress.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run bot.py as several worker processes behind one update ingress")
+    parser.add_argument('--workers', type=int, default=Config.INGRESS_WORKERS, help='worker processes (default: one per core)')
+    parser.add_argument('--base-port', type=int, default=Config.INGRESS_BASE_PORT, help='workers listen on this port and the ones after it')
+    parser.add_argument('--max-queued', type=int, default=Config.INGRESS_MAX_QUEUED, help='updates waiting per worker before its new ones are dropped')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from app.SongIDCache import LRUCache
+
+
+def normalise_query(query: str) -> str:
+    """Lower-case and collapse whitespace so 'Beat  It' and 'beat it' share a cache entry"""
+    return ' '.join(query.lower().split())
+
+
+class InlineSearchCache:
+    """TTL + LRU cache of inline search results keyed by the normalised query.
+
+    Only exact queries are answered. Shazam's search is fuzzy and ranked, so a
+    longer query can find tracks a shorter prefix of it never returned; its
+    results can't be filtered out of the prefix's.
+    """
+
+    def __init__(self, ttl: float = 600, max_entries: int = 2000):
+        self._entries = LRUCache(max_entries, ttl)
+
+    def get(self, query: str) -> Optional[List[dict]]:
+        """Cached tracks for an already normalised query, or None"""
+        return self._entries.get(query)
+
+    def put(self, query: str, tracks: List[dict], ttl: Optional[float] = None):
+        self._entries.set(query, tracks, ttl)
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+
+class LatestQueryTracker:
+    """Remember each user's newest inline query task so older, in-flight ones can be dropped"""
+
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.dropped = 0
+
+    def begin(self, user_id: int):
+        """Mark the current task as the user's newest query and cancel the one it replaces"""
+        previous = self._tasks.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.dropped += 1
+        self._tasks[user_id] = asyncio.current_task()
+
+    def is_latest(self, user_id: int) -> bool:
+        return self._tasks.get(user_id) is asyncio.current_task()
+
+    def end(self, user_id: int):
+        if self.is_latest(user_id):
+            del self._tasks[user_id]
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a job is refused because the queue (or the user's share of it) is full"""
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'enqueued')
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.enqueued = time.monotonic()
+
+
+class JobScheduler:
+    """Bounded job queue drained by a fixed pool of asyncio workers.
+
+    Jobs are kept in one FIFO per key (user) and workers take from the keys in
+    round-robin order, so one user flooding the bot cannot starve everyone else.
+    """
+
+    def __init__(self, workers: int = 4, max_depth: int = 100, max_per_key: int = 3, wait_samples: int = 1000):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_per_key = max_per_key
+        self._queues: 'OrderedDict[Hashable, Deque[_Job]]' = OrderedDict()
+        self._depth = 0
+        self._running = 0
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._tasks = []
+        self._waits: Deque[float] = deque(maxlen=wait_samples)
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    def _start(self):
+        """Spawn the workers on first use, inside the running event loop"""
+        self._wakeup = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+
+    def submit(self, key: Hashable, fn: Callable[..., Awaitable], *args) -> int:
+        """Queue fn(*args) for key and return its place in the queue (0 means it starts right away)"""
+        if self._wakeup is None:
+            self._start()
+        queue = self._queues.get(key)
+        if self._depth >= self.max_depth or (queue is not None and len(queue) >= self.max_per_key):
+            self.rejected += 1
+            raise QueueFull(key)
+        ahead = self._jobs_ahead(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(_Job(fn, args))
+        self._depth += 1
+        self.submitted += 1
+        self.peak_depth = max(self.peak_depth, self._depth)
+        asyncio.get_running_loop().create_task(self._notify())
+        idle = self.workers - self._running
+        return max(0, ahead + 1 - idle)
+
+    def _jobs_ahead(self, key: Hashable) -> int:
+        """Jobs that round-robin order will start before a new job for key"""
+        own = len(self._queues.get(key, ()))
+        ahead = own
+        for other, queue in self._queues.items():
+            if other != key:
+                ahead += min(len(queue), own + 1)
+        return ahead
+
+    async def _notify(self):
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    def _next_job(self) -> Optional[_Job]:
+        """Pop the oldest job of the next key in round-robin order"""
+        if not self._queues:
+            return None
+        key, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        self._depth -= 1
+        return job
+
+    async def _worker(self, number: int):
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: self._depth > 0)
+                job = self._next_job()
+                self._running += 1
+            self._waits.append(time.monotonic() - job.enqueued)
+            try:
+                await job.fn(*job.args)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Job failed in worker {number}: {e}")
+            finally:
+                self._running -= 1
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            'workers': self.workers,
+            'running': self._running,
+            'depth': self._depth,
+            'peak_depth': self.peak_depth,
+            'users_waiting': len(self._queues),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait_avg_seconds': round(sum(waits) / len(waits), 3) if waits else 0.0,
+            'wait_p95_seconds': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+            'wait_max_seconds': round(waits[-1], 3) if waits else 0.0,
+        }
@@ -0,0 +1,89 @@
+import re
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from app.SongIDCache import DiskCache
+
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com', 'www.youtube-nocookie.com')
+YOUTUBE_PATH = re.compile(r'^/(?:shorts|embed|live|v)/([A-Za-z0-9_-]{11})')
+YOUTUBE_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
+INSTAGRAM_PATH = re.compile(r'^/(?:[A-Za-z0-9_.]+/)?(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)')
+
+
+def youtube_id(url: str) -> Optional[str]:
+    """The 11 character video id of a YouTube link, or None"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().split(':')[0]
+    if host in ('youtu.be', 'www.youtu.be'):
+        video_id = parsed.path.strip('/').split('/')[0]
+    elif host in YOUTUBE_HOSTS:
+        match = YOUTUBE_PATH.match(parsed.path)
+        video_id = match.group(1) if match else parse_qs(parsed.query).get('v', [''])[0]
+    else:
+        return None
+    return video_id if YOUTUBE_ID.match(video_id) else None
+
+
+def instagram_shortcode(url: str) -> Optional[str]:
+    """The shortcode of an Instagram post/reel link, or None"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().split(':')[0]
+    if host not in ('instagram.com', 'www.instagram.com', 'm.instagram.com'):
+        return None
+    match = INSTAGRAM_PATH.match(parsed.path)
+    return match.group(1) if match else None
+
+
+def normalise_url(url: str) -> Optional[str]:
+    """Cache key shared by every form of the same YouTube video or Instagram post, or None for other links"""
+    video_id = youtube_id(url)
+    if video_id:
+        return f'yt:{video_id}'
+    shortcode = instagram_shortcode(url)
+    if shortcode:
+        return f'ig:{shortcode}'
+    return None
+
+
+class MediaFileCache:
+    """Persistent map from a normalised link to the Telegram file_id of our first upload of it.
+
+    Sending a cached file_id again costs no download or upload. An entry is dropped
+    with invalidate() when Telegram no longer accepts its file_id.
+    """
+
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600, max_bytes: int = 16 * 1024 * 1024):
+        self._entries = DiskCache(path, ttl, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        """{'kind': 'video' | 'photo' | 'audio', 'file_id': ...} or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, kind: str, file_id: str, ttl: Optional[float] = None):
+        self._entries.set(key, {'kind': kind, 'file_id': file_id}, ttl)
+
+    def invalidate(self, key: str) -> bool:
+        removed = self._entries.delete(key)
+        if removed:
+            self.invalidations += 1
+        return removed
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        stats = self._entries.stats()
+        return {
+            'entries': stats['entries'],
+            'bytes': stats['bytes'],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+
+from state_store import StateMap, StateStore
+
+logger = logging.getLogger(__name__)
+
+
+def _remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class SessionState(StateMap):
+    """Per-user state that expires and is bounded, with a sweeper that deletes the files it points to.
+
+    Each entry lives for `ttl` seconds after it was last written, and at most
+    `max_entries` are kept (the least recently used go first). `files(value)` lists
+    the files on disk an entry owns, e.g. a download waiting for metadata; they are
+    deleted (with `remove(path)`, os.remove by default) when the entry expires, is
+    evicted, or is replaced by one that doesn't own them. Sizes come from `size(value)` so the bytes held on disk can be reported
+    without touching the files; they are kept per key as entries are written and
+    removed, and recounted by every sweep, so the gauges never read the store.
+    """
+
+    def __init__(self, store: StateStore, namespace: str, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 files: Optional[Callable[[dict], List[str]]] = None, size: Optional[Callable[[dict], int]] = None,
+                 remove: Callable[[str], bool] = _remove_file):
+        super().__init__(store, namespace, ttl)
+        self.max_entries = max_entries
+        self._files = files
+        self._size = size
+        self._remove_path = remove
+        self.expired = 0
+        self.evicted = 0
+        self.files_removed = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._sizes: Dict[str, int] = self._measure()
+
+    def _remove(self, paths: Iterable[str]) -> int:
+        removed = 0
+        for path in paths:
+            try:
+                removed += bool(self._remove_path(path))
+            except OSError as e:
+                logger.warning(f"Could not remove session file {path}: {e}")
+        return removed
+
+    def _owned(self, value) -> List[str]:
+        return list(self._files(value)) if self._files is not None and value is not None else []
+
+    def _measure(self) -> Dict[str, int]:
+        if self._size is None:
+            return {}
+        return {key: self._size(value) for key, value in self.store.items(self.namespace)}
+
+    def __setitem__(self, key, value):
+        # Only entries that own files need the one they replace
+        previous = self.get(key) if self._files is not None else None
+        super().__setitem__(key, value)
+        if self._size is not None:
+            self._sizes[str(key)] = self._size(value)
+        stale = set(self._owned(previous)) - set(self._owned(value))
+        if stale:
+            self.files_removed += self._remove(stale)
+        if self.max_entries is not None and self.store.count(self.namespace) > self.max_entries:
+            if self._sweeper is None:
+                self.sweep()
+            else:
+                # Trimmed by the sweeper, off the event loop
+                self._loop.call_soon_threadsafe(self._wake.set)
+
+    def pop(self, key, default=None):
+        """Remove the entry without deleting its files, for a caller that is about to use them"""
+        value = self.get(key, default)
+        self.store.delete(self.namespace, str(key))
+        self._sizes.pop(str(key), None)
+        return value
+
+    def discard(self, key):
+        """Remove the entry and delete its files"""
+        value = self.pop(key)
+        self.files_removed += self._remove(self._owned(value))
+
+    def sweep(self) -> int:
+        """Purge expired entries and any over max_entries, deleting their files; returns how many went"""
+        expired, evicted = self.store.purge(self.namespace, self.max_entries)
+        # Recounted here, off the event loop, which also picks up entries other processes wrote
+        self._sizes = self._measure()
+        if not expired and not evicted:
+            return 0
+        self.expired += len(expired)
+        self.evicted += len(evicted)
+        self.files_removed += self._remove(path for key, value in expired + evicted for path in self._owned(value))
+        logger.info(f"Sessions {self.namespace}: {len(expired)} expired, {len(evicted)} evicted over the limit of {self.max_entries}")
+        return len(expired) + len(evicted)
+
+    async def _sweep_loop(self, interval: float):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                logger.error(f"Sessions {self.namespace}: sweep failed: {e}")
+
+    def start_sweeper(self, interval: float = 60):
+        """Sweep every `interval` seconds from the running event loop"""
+        if self._sweeper is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._sweeper = self._loop.create_task(self._sweep_loop(interval))
+
+    def live(self) -> int:
+        """Entries held, counting expired ones until the sweep that removes them"""
+        return self.store.count(self.namespace)
+
+    def disk_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def register_metrics(self, metrics):
+        metrics.gauge('sessions_live', self.live, kind=self.namespace)
+        if self._size is not None:
+            metrics.gauge('sessions_disk_bytes', self.disk_bytes, kind=self.namespace)
+
+    def stats(self) -> dict:
+        return {
+            'live': self.live(),
+            'disk_bytes': self.disk_bytes(),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'files_removed': self.files_removed,
+        }
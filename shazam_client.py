@@ -0,0 +1,66 @@
+import logging
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+
+from app.SongIDPool import AsyncClientPool
+
+logger = logging.getLogger(__name__)
+
+
+class KeepAliveHTTPClient:
+    """HTTP client for shazamio that keeps one aiohttp session (and its connections) alive"""
+
+    def __init__(self, limit_per_host: int = 4, keepalive_timeout: float = 300, timeout: float = 30,
+                 base_url: Optional[str] = None):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.base_url = urlsplit(base_url) if base_url else None  # Send every request here instead (test servers)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Get the shared session, creating it inside the running event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def request(self, method: str, url: str, *args, **kwargs) -> dict:
+        """Same interface as shazamio's HTTPClient.request"""
+        if self.base_url is not None:
+            parts = urlsplit(url)
+            url = urlunsplit((self.base_url.scheme, self.base_url.netloc, parts.path, parts.query, ''))
+        async with self.session().request(method.upper(), url, *args, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def create_shazam_pool(size: int, idle_timeout: float, base_url: Optional[str] = None) -> AsyncClientPool:
+    """Pool of Shazam clients that all share one keep-alive HTTP session"""
+    http_client = KeepAliveHTTPClient(limit_per_host=size, keepalive_timeout=idle_timeout, base_url=base_url)
+
+    def factory():
+        # Imported on first use, it takes a while and isn't needed to start serving updates
+        from shazamio import Shazam
+        try:
+            return Shazam(http_client=http_client)
+        except TypeError:
+            # Older shazamio releases do not accept a custom HTTP client
+            logger.warning("shazamio does not support http_client, Shazam connections will not be reused")
+            return Shazam()
+
+    pool = AsyncClientPool(factory, size=size, idleTimeout=idle_timeout, name='shazam')
+    pool.http_client = http_client
+    return pool
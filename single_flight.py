@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its result with everyone who asks meanwhile.
+
+    The first caller for a key (the leader) starts fn(*args) in its own task; callers
+    that arrive while it runs (followers) wait for that task instead of starting
+    their own. All of them get the same result, or the same exception. Nothing is
+    remembered once the call finishes, so a failed call is retried by the next request.
+
+    A caller that is cancelled only stops waiting. The shared call keeps going for
+    the others, and is cancelled only when every caller has gone away.
+
+    join() only ever follows: it is for callers that must not start the call
+    themselves (e.g. because starting it has to go through a queue), and checks and
+    joins in one step so the call can't finish in between.
+    """
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.abandoned = 0
+
+    def join(self, key: Hashable) -> Optional[Awaitable]:
+        """An awaitable for the result of the call in flight for key, or None (starting nothing) if there is none.
+
+        Await it, or close() it if you end up not waiting after all.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            return None
+        self.coalesced += 1
+        return self._wait(call)
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable], *args) -> Tuple[object, bool]:
+        """Return (result, shared): shared is True when the result came from another caller's call"""
+        joined = self.join(key)
+        if joined is not None:
+            return await joined, True
+        self.calls += 1
+        call = self._calls[key] = _Call(asyncio.ensure_future(fn(*args)))
+        call.task.add_done_callback(lambda task: self._finished(key, call))
+        return await self._wait(call), False
+
+    async def _wait(self, call: _Call):
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                # Nobody else is waiting for the result any more
+                self.abandoned += 1
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _finished(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled() and call.task.exception() is not None:
+            self.failed += 1
+            logger.info(f"{self.name or 'SingleFlight'}: call for {key} failed: {call.task.exception()}")
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'abandoned': self.abandoned,
+        }
@@ -0,0 +1,391 @@
+import abc
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class StateStore(abc.ABC):
+    """Small key-value store for per-user state (language, pending metadata edits...), split into namespaces.
+
+    Values must be JSON serialisable. An entry may have a TTL, after which it reads
+    as missing until purge() removes it; reading an entry marks it as recently used,
+    which is the order purge() evicts in once a namespace holds too many entries.
+    MemoryStateStore keeps them in this process; SQLiteStateStore keeps them in a
+    file that every worker process started by ingress.py shares, so state survives
+    restarts and chats moving between workers.
+    """
+
+    @abc.abstractmethod
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def items(self, namespace: str) -> List[Tuple[str, Any]]:
+        """Every unexpired entry"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self, namespace: str) -> int:
+        """Entries stored, including expired ones that haven't been purged yet"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def purge(self, namespace: str, max_entries: Optional[int] = None) -> Tuple[List[Tuple[str, Any]], List[Tuple[str, Any]]]:
+        """Remove expired entries, then the least recently used past max_entries; returns both lists of (key, value)"""
+        raise NotImplementedError
+
+    def keys(self, namespace: str) -> List[str]:
+        return [key for key, value in self.items(namespace)]
+
+    def load(self, namespace: str):
+        """Read a namespace in ahead of use, for stores that keep a copy of it"""
+
+    def close(self):
+        pass
+
+    def map(self, namespace: str) -> 'StateMap':
+        return StateMap(self, namespace)
+
+
+class MemoryStateStore(StateStore):
+    """State kept in dicts, for a single bot process"""
+
+    def __init__(self):
+        self._namespaces: Dict[str, 'OrderedDict[str, Tuple[str, Optional[float]]]'] = {}  # Least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entries = self._namespaces.get(namespace, {})
+            entry = entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                return default
+            entries.move_to_end(key)
+        # Stored as JSON too, so callers can't tell the two stores apart (e.g. int keys in values)
+        return json.loads(entry[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        entry = (json.dumps(value, separators=(',', ':')), time.time() + ttl if ttl else None)
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            entries[key] = entry
+            entries.move_to_end(key)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            return self._namespaces.get(namespace, {}).pop(key, None) is not None
+
+    def items(self, namespace):
+        now = time.time()
+        with self._lock:
+            entries = list(self._namespaces.get(namespace, {}).items())
+        return [(key, json.loads(value)) for key, (value, expires) in entries if expires is None or expires > now]
+
+    def count(self, namespace):
+        with self._lock:
+            return len(self._namespaces.get(namespace, {}))
+
+    def purge(self, namespace, max_entries=None):
+        now = time.time()
+        expired, evicted = [], []
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if not entries:
+                return expired, evicted
+            for key in [key for key, (value, expires) in entries.items() if expires is not None and expires <= now]:
+                expired.append((key, entries.pop(key)[0]))
+            while max_entries is not None and len(entries) > max_entries:
+                key, (value, expires) = entries.popitem(last=False)
+                evicted.append((key, value))
+        return [(key, json.loads(value)) for key, value in expired], [(key, json.loads(value)) for key, value in evicted]
+
+
+class SQLiteStateStore(StateStore):
+    """State in a local SQLite file (WAL mode), shared by every process on the machine.
+
+    A read marks an entry as used only when that is more than `touch_slack` seconds
+    out of date, so most reads don't write.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0, touch_slack: float = 60.0):
+        self.path = path
+        self.touch_slack = touch_slack
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL, accessed REAL NOT NULL DEFAULT 0, PRIMARY KEY (namespace, key)) WITHOUT ROWID')
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(state)')}
+        if 'expires' not in columns:
+            # Stores created before entries could expire
+            self._db.execute('ALTER TABLE state ADD COLUMN expires REAL')
+            self._db.execute('ALTER TABLE state ADD COLUMN accessed REAL NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS state_accessed ON state (namespace, accessed)')
+
+    def get(self, namespace, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, accessed FROM state WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)', (namespace, key, now)).fetchone()
+            if row is not None and now - row[1] > self.touch_slack:
+                self._db.execute('UPDATE state SET accessed = ? WHERE namespace = ? AND key = ?', (now, namespace, key))
+        return default if row is None else json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        self.write(namespace, key, json.dumps(value, separators=(',', ':')), now + ttl if ttl else None, now)
+
+    def write(self, namespace: str, key: str, value: str, expires: Optional[float], accessed: float):
+        """Store an already serialised value"""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO state (namespace, key, value, expires, accessed) VALUES (?, ?, ?, ?, ?)', (namespace, key, value, expires, accessed))
+
+    def touch(self, namespace: str, key: str, accessed: float):
+        with self._lock:
+            self._db.execute('UPDATE state SET accessed = ? WHERE namespace = ? AND key = ?', (accessed, namespace, key))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            return self._db.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key)).rowcount > 0
+
+    def items(self, namespace):
+        with self._lock:
+            rows = self._db.execute('SELECT key, value FROM state WHERE namespace = ? AND (expires IS NULL OR expires > ?)', (namespace, time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def count(self, namespace):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM state WHERE namespace = ?', (namespace,)).fetchone()[0]
+
+    def changed(self, namespace: str, since: float = 0) -> List[Tuple[str, str, Optional[float], float]]:
+        """(key, serialised value, expires, accessed) of every entry written or read since `since`, expired ones included"""
+        with self._lock:
+            return self._db.execute('SELECT key, value, expires, accessed FROM state WHERE namespace = ? AND accessed >= ?', (namespace, since)).fetchall()
+
+    def stored_keys(self, namespace: str) -> List[str]:
+        """Every key, expired ones included"""
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT key FROM state WHERE namespace = ?', (namespace,))]
+
+    def purge(self, namespace, max_entries=None):
+        # RETURNING needs SQLite 3.35, so select then delete inside one transaction
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                expired = self._db.execute('SELECT key, value FROM state WHERE namespace = ? AND expires <= ?', (namespace, time.time())).fetchall()
+                self._db.executemany('DELETE FROM state WHERE namespace = ? AND key = ?', [(namespace, key) for key, value in expired])
+                evicted = []
+                if max_entries is not None:
+                    over = self._db.execute('SELECT COUNT(*) FROM state WHERE namespace = ?', (namespace,)).fetchone()[0] - max_entries
+                    if over > 0:
+                        evicted = self._db.execute('SELECT key, value FROM state WHERE namespace = ? ORDER BY accessed LIMIT ?', (namespace, over)).fetchall()
+                        self._db.executemany('DELETE FROM state WHERE namespace = ? AND key = ?', [(namespace, key) for key, value in evicted])
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return [(key, json.loads(value)) for key, value in expired], [(key, json.loads(value)) for key, value in evicted]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CachedStateStore(StateStore):
+    """A per-process copy of a SQLiteStateStore, so reads never wait on the database file.
+
+    Reads are answered from memory. Writes change the copy at once and are written
+    through to SQLite in order by a background thread, so nothing on the event loop
+    waits for another worker's write lock. Ingress keeps a chat on one worker, which
+    makes the copy current for the chats this process handles; purge() (run by the
+    session sweepers, off the loop) also brings in what other workers changed since
+    the previous one. Reads mark an entry as used at most once every `touch_slack`
+    seconds, which is all the eviction order needs.
+    """
+
+    # Rows written by another process just before a sync may commit just after it, so each sync looks back this far
+    SYNC_OVERLAP = 5.0
+
+    def __init__(self, backing: SQLiteStateStore, touch_slack: float = 60.0):
+        self.backing = backing
+        self.touch_slack = touch_slack
+        self._lock = threading.Lock()
+        self._namespaces: Dict[str, Dict[str, list]] = {}  # key -> [serialised value, expires, accessed]
+        self._synced: Dict[str, float] = {}  # When each namespace was last read from the file
+        self._written: Dict[Tuple[str, str], int] = {}  # (namespace, key) -> sequence number of its last local write
+        self._sequence = 0
+        self._writes: queue.Queue = queue.Queue()
+        self.write_errors = 0
+        self._writer = threading.Thread(target=self._write_loop, name='StateStoreWriter', daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            operation, namespace, key, *args = self._writes.get()
+            try:
+                getattr(self.backing, operation)(namespace, key, *args)
+            except sqlite3.Error as e:
+                self.write_errors += 1
+                logger.error(f"State store: {operation} of {namespace}/{key} failed: {e}")
+            finally:
+                self._writes.task_done()
+
+    def _queue_write(self, namespace, key, operation, *args):
+        # Called with the lock held, so writes reach the queue in the order they changed the copy
+        self._sequence += 1
+        self._written[(namespace, key)] = self._sequence
+        self._writes.put((operation, namespace, key, *args))
+
+    def _entries(self, namespace) -> Dict[str, list]:
+        entries = self._namespaces.get(namespace)
+        if entries is None:
+            self.load(namespace)
+            entries = self._namespaces[namespace]
+        return entries
+
+    def load(self, namespace):
+        if namespace not in self._namespaces:
+            self._sync(namespace)
+
+    def _sync(self, namespace):
+        """Bring in entries other processes wrote or removed since the last sync"""
+        with self._lock:
+            start = self._sequence
+            since = self._synced.get(namespace)
+        self.flush()  # Our own earlier writes are in the file before it is read
+        now = time.time()
+        rows = self.backing.changed(namespace, since - self.SYNC_OVERLAP if since is not None else 0)
+        stored = set(self.backing.stored_keys(namespace))
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, {})
+            # Anything written here after the sync started is newer than what was read
+            for key in [key for key in entries if key not in stored and self._written.get((namespace, key), 0) <= start]:
+                del entries[key]
+            for key, value, expires, accessed in rows:
+                if self._written.get((namespace, key), 0) <= start:
+                    entries[key] = [value, expires, accessed]
+            self._written = {written: sequence for written, sequence in self._written.items() if sequence > start}
+            self._synced[namespace] = now
+
+    def flush(self):
+        """Wait until every write so far is in the file"""
+        self._writes.join()
+
+    def get(self, namespace, key, default=None):
+        entries = self._entries(namespace)
+        now = time.time()
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                return default
+            value = entry[0]
+            if now - entry[2] > self.touch_slack:
+                entry[2] = now
+                self._writes.put(('touch', namespace, key, now))
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        entries = self._entries(namespace)
+        now = time.time()
+        # Serialised now, so later changes to a mutable value don't leak into the copy or the file
+        entry = [json.dumps(value, separators=(',', ':')), now + ttl if ttl else None, now]
+        with self._lock:
+            entries[key] = entry
+            self._queue_write(namespace, key, 'write', *entry)
+
+    def delete(self, namespace, key):
+        entries = self._entries(namespace)
+        with self._lock:
+            existed = entries.pop(key, None) is not None
+            self._queue_write(namespace, key, 'delete')
+        return existed
+
+    def items(self, namespace):
+        entries = self._entries(namespace)
+        now = time.time()
+        with self._lock:
+            values = [(key, entry[0]) for key, entry in entries.items() if entry[1] is None or entry[1] > now]
+        return [(key, json.loads(value)) for key, value in values]
+
+    def count(self, namespace):
+        entries = self._entries(namespace)
+        with self._lock:
+            return len(entries)
+
+    def purge(self, namespace, max_entries=None):
+        # Purged in the file, so entries every worker wrote are bounded together; the sync then drops them here
+        self.flush()
+        expired, evicted = self.backing.purge(namespace, max_entries)
+        self._sync(namespace)
+        return expired, evicted
+
+    def close(self):
+        self.flush()
+        self.backing.close()
+
+
+class StateMap(MutableMapping):
+    """dict-like view of one namespace. Keys are stored as strings, so user ids can be ints or strs."""
+
+    def __init__(self, store: StateStore, namespace: str, ttl: Optional[float] = None):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        store.load(namespace)
+
+    def __getitem__(self, key):
+        value = self.store.get(self.namespace, str(key), _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.store.get(self.namespace, str(key), default)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.namespace, str(key), value, self.ttl)
+
+    def __delitem__(self, key):
+        if not self.store.delete(self.namespace, str(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.store.get(self.namespace, str(key), _MISSING) is not _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.keys(self.namespace))
+
+    def __len__(self):
+        return len(self.store.items(self.namespace))
+
+
+def create_state_store(url: Optional[str]) -> StateStore:
+    """'memory' (the default) or 'sqlite:<path>'"""
+    if not url or url == 'memory':
+        return MemoryStateStore()
+    if url.startswith('sqlite:'):
+        path = url[len('sqlite:'):]
+        logger.info(f"State store: {path}")
+        return CachedStateStore(SQLiteStateStore(path))
+    raise ValueError(f"Unknown state store {url!r}, expected 'memory' or 'sqlite:<path>'")
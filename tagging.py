@@ -0,0 +1,298 @@
+import io
+import os
+from typing import BinaryIO, Callable, Dict, Optional, Tuple, Union
+
+# Fields that can be edited, in the order they are shown, and what users may call them instead
+FIELDS = ('title', 'artist', 'album', 'albumartist', 'date', 'genre', 'tracknumber', 'discnumber')
+ALIASES = {
+    'album artist': 'albumartist', 'album_artist': 'albumartist',
+    'year': 'date', 'track': 'tracknumber', 'track number': 'tracknumber', 'disc': 'discnumber', 'disc number': 'discnumber',
+}
+
+FORMATS = ('mp3', 'mp4', 'flac', 'ogg', 'opus')
+EXTENSIONS = {
+    '.mp3': 'mp3', '.m4a': 'mp4', '.m4b': 'mp4', '.mp4': 'mp4', '.flac': 'flac',
+    '.ogg': 'ogg', '.oga': 'ogg', '.opus': 'opus',
+}
+
+# Frame / atom / comment names for each field
+_ID3_FRAMES = {
+    'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'albumartist': 'TPE2',
+    'date': 'TDRC', 'genre': 'TCON', 'tracknumber': 'TRCK', 'discnumber': 'TPOS',
+}
+_MP4_ATOMS = {
+    'title': '\xa9nam', 'artist': '\xa9ART', 'album': '\xa9alb', 'albumartist': 'aART',
+    'date': '\xa9day', 'genre': '\xa9gen', 'tracknumber': 'trkn', 'discnumber': 'disk',
+}
+
+
+class TagError(Exception):
+    """Raised when a file's tags can't be edited"""
+
+
+class UnsupportedFormat(TagError):
+    """Raised for files that aren't MP3, M4A/MP4, FLAC or Ogg Vorbis/Opus"""
+
+
+def detect_format(head: bytes, file_name: Optional[str] = None) -> Optional[str]:
+    """One of FORMATS from a file's first bytes (64 are enough), falling back to its extension"""
+    extension = EXTENSIONS.get(os.path.splitext(file_name or '')[1].lower())
+    if head[:4] == b'fLaC':
+        return 'flac'
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:4] == b'OggS':
+        # The first packet (right after the 27 byte page header and its segment table) names the codec
+        packet = head[27 + head[26]:] if len(head) > 26 else b''
+        if packet.startswith(b'OpusHead'):
+            return 'opus'
+        if packet.startswith(b'\x01vorbis'):
+            return 'ogg'
+        return None  # Ogg FLAC, Speex...
+    if head[:3] == b'ID3':
+        # Some FLAC files carry an ID3v2 tag in front of their own
+        return 'flac' if extension == 'flac' else 'mp3'
+    if len(head) >= 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        return 'mp3'
+    return extension
+
+
+def normalize_fields(metadata: Dict[str, str]) -> Dict[str, str]:
+    """Map user-supplied names onto FIELDS, dropping anything else. An empty value removes the field."""
+    fields = {}
+    for key, value in metadata.items():
+        key = key.strip().lower()
+        key = ALIASES.get(key, key)
+        if key in FIELDS:
+            fields[key] = str(value).strip()
+    return fields
+
+
+def _number_pair(value: str) -> Tuple[int, int]:
+    """'3' or '3/14' -> (3, 14), with 0 for an unknown total"""
+    number, _, total = value.partition('/')
+    try:
+        return int(number), int(total or 0)
+    except ValueError:
+        raise TagError(f"Expected a number like 3 or 3/14, got {value!r}")
+
+
+def _apply_id3(tags, fields: Dict[str, str]):
+    from mutagen import id3
+    for field, value in fields.items():
+        frame = _ID3_FRAMES[field]
+        tags.delall(frame)
+        if value:
+            tags.add(getattr(id3, frame)(encoding=3, text=[value]))
+
+
+def _apply_mp4(tags, fields: Dict[str, str]):
+    for field, value in fields.items():
+        atom = _MP4_ATOMS[field]
+        if not value:
+            tags.pop(atom, None)
+        elif field in ('tracknumber', 'discnumber'):
+            tags[atom] = [_number_pair(value)]
+        else:
+            tags[atom] = [value]
+
+
+def _apply_vorbis(tags, fields: Dict[str, str]):
+    for field, value in fields.items():
+        key = field.upper()
+        if not value:
+            if key in tags:
+                del tags[key]
+        else:
+            tags[key] = [value]
+
+
+def _file_type(fmt: str):
+    """The mutagen class for a format and the function that applies fields to its tags (mutagen is imported here, on first use)"""
+    if fmt == 'mp3':
+        from mutagen.mp3 import MP3
+        return MP3, _apply_id3
+    if fmt == 'mp4':
+        from mutagen.mp4 import MP4
+        return MP4, _apply_mp4
+    if fmt == 'flac':
+        from mutagen.flac import FLAC
+        return FLAC, _apply_vorbis
+    if fmt == 'ogg':
+        from mutagen.oggvorbis import OggVorbis
+        return OggVorbis, _apply_vorbis
+    if fmt == 'opus':
+        from mutagen.oggopus import OggOpus
+        return OggOpus, _apply_vorbis
+    raise UnsupportedFormat(f"Can't edit tags of {fmt or 'unknown'} files")
+
+
+class _WriteCounter:
+    """File object wrapper that counts the bytes written through it (mutagen only uses read/write/seek/truncate)"""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class MemoryFile(io.RawIOBase):
+    """Seekable file object over a bytearray, edited where it is.
+
+    io.BytesIO copies the whole file the first time it is written to, even when an
+    edit only touches the tags at the start; this writes straight into the bytearray.
+    It can be passed to bot.send_audio/send_document as is (`name` is the upload's file name).
+    """
+
+    def __init__(self, data: bytearray, name: Optional[str] = None):
+        super().__init__()
+        self.data = data
+        self.name = name
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.data) if size is None or size < 0 else self._position + size
+        chunk = bytes(self.data[self._position:end])
+        self._position += len(chunk)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def write(self, data) -> int:
+        end = self._position + len(data)
+        if self._position > len(self.data):
+            self.data.extend(bytes(self._position - len(self.data)))
+        self.data[self._position:end] = data
+        self._position = end
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self.data)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        size = self._position if size is None else size
+        if size < len(self.data):
+            del self.data[size:]
+        else:
+            self.data.extend(bytes(size - len(self.data)))
+        return size
+
+    def getvalue(self) -> bytes:
+        return bytes(self.data)
+
+
+class TagEdit:
+    """What an edit did to a file"""
+
+    def __init__(self, fmt: str, size_before: int, size_after: int, bytes_written: int):
+        self.format = fmt
+        self.size_before = size_before
+        self.size_after = size_after
+        self.bytes_written = bytes_written
+
+    @property
+    def in_place(self) -> bool:
+        """The new tags fitted in the old tag region and its padding, so nothing after them was moved"""
+        return self.size_before == self.size_after
+
+    def stats(self) -> dict:
+        return {
+            'format': self.format,
+            'size_before': self.size_before,
+            'size_after': self.size_after,
+            'bytes_written': self.bytes_written,
+            'in_place': self.in_place,
+        }
+
+
+def _padding(extra: Optional[int]) -> Callable:
+    """Keep the tags where they are whenever they fit in the old tag region and its padding.
+
+    mutagen's own default also shrinks padding it thinks is too large, which moves the
+    audio just the same. When the tags do have to grow, leave `extra` bytes of padding
+    (mutagen's default, about 1KB + 0.1% of the file, when None) so the next edit fits.
+    """
+    def padding(info):
+        if info.padding >= 0:
+            return info.padding
+        return info.get_default_padding() if extra is None else extra
+    return padding
+
+
+def edit_tags(target: Union[str, BinaryIO], metadata: Dict[str, str], fmt: Optional[str] = None,
+              file_name: Optional[str] = None, padding: Optional[int] = None) -> TagEdit:
+    """Blocking: write metadata to a file path or a seekable in-memory file (MemoryFile, io.BytesIO).
+
+    Only the tag region is rewritten when the new tags fit in the space the old ones
+    and their padding take up; otherwise mutagen moves the rest of the file along
+    (in memory, for in-memory files). The format is detected from the first bytes
+    (or file_name) unless given. The file is left positioned at the start.
+    """
+    fields = normalize_fields(metadata)
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, 'r+b') as file:
+            return edit_tags(file, fields, fmt, file_name or os.fspath(target), padding)
+
+    target.seek(0)
+    if fmt is None:
+        fmt = detect_format(target.read(64), file_name)
+        target.seek(0)
+    file_type, apply = _file_type(fmt)
+    size_before = target.seek(0, io.SEEK_END)
+    target.seek(0)
+
+    counter = _WriteCounter(target)
+    try:
+        audio = file_type(counter)
+        if audio.tags is None:
+            audio.add_tags()
+        apply(audio.tags, fields)
+        target.seek(0)  # Some formats (FLAC) save from wherever loading left the file
+        audio.save(counter, padding=_padding(padding))
+    except TagError:
+        raise
+    except Exception as e:
+        # mutagen raises its own MutagenError subclasses, plus ValueError/struct.error for damaged files
+        raise TagError(f"Couldn't edit {fmt} tags: {e}") from e
+
+    size_after = target.seek(0, io.SEEK_END)
+    target.seek(0)
+    return TagEdit(fmt, size_before, size_after, counter.bytes_written)
+
+
+def edit_bytes(data: Union[bytes, bytearray], metadata: Dict[str, str], fmt: Optional[str] = None,
+               file_name: Optional[str] = None, padding: Optional[int] = None) -> Tuple[MemoryFile, TagEdit]:
+    """Blocking: edit data in memory (a bytearray is edited where it is, bytes are copied first),
+    returning the file (named file_name, ready to upload) and the edit"""
+    buffer = MemoryFile(data if isinstance(data, bytearray) else bytearray(data), file_name)
+    edit = edit_tags(buffer, metadata, fmt, file_name, padding)
+    buffer.name = os.path.basename(file_name or f'audio.{edit.format}')
+    return buffer, edit
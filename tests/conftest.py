@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# bot.py's modules import from the repository root, the app/ pipeline's from inside app/
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'app'))
@@ -0,0 +1,39 @@
+"""Recognition cache tiers keeping each entry's time to live, and the disk tier's writes on reads."""
+import time
+
+import pytest
+
+from SongIDCache import DiskCache, RecognitionCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = RecognitionCache(str(tmp_path / 'cache.sqlite'), ttl=7 * 24 * 3600)
+    yield cache
+    cache.disk.close()
+
+
+def test_disk_hit_keeps_its_remaining_ttl_in_memory(cache):
+    cache.disk.set('fid:shazam:a', {'matches': []}, ttl=60)
+    assert cache.lookup('shazam', file_unique_id='a', content_hash='h') == {'matches': []}
+    for key in ('fid:shazam:a', 'sha:shazam:h'):
+        value, expires = cache.memory.getEntry(key)
+        assert expires <= time.time() + 60
+
+
+def test_expired_disk_entry_is_not_served_from_memory(cache):
+    cache.store({'matches': []}, 'shazam', file_unique_id='a', ttl=0.05)
+    cache.memory.clear()
+    assert cache.lookup('shazam', file_unique_id='a') is not None
+    time.sleep(0.1)
+    assert cache.lookup('shazam', file_unique_id='a') is None
+
+
+def test_recent_hits_do_not_write(tmp_path):
+    disk = DiskCache(str(tmp_path / 'cache.sqlite'), touchSlack=60)
+    disk.set('a', 1)
+    statements = []
+    disk._db.set_trace_callback(statements.append)
+    assert disk.get('a') == 1
+    assert not [statement for statement in statements if statement.startswith('UPDATE')]
+    disk.close()
@@ -0,0 +1,35 @@
+"""Inline search caching against a fuzzy, ranked search."""
+from inline_cache import InlineSearchCache, normalise_query
+
+# What a fuzzy search returns: 'beat' doesn't rank Beat It at all, 'beat it' does
+SEARCH = {
+    'beat': [{'title': 'Beat Street', 'subtitle': 'Grandmaster Flash'}],
+    'beat it': [{'title': 'Beat It', 'subtitle': 'Michael Jackson'}, {'title': 'Beat Street', 'subtitle': 'Grandmaster Flash'}],
+}
+
+
+def cached_search(cache, query, searches):
+    query = normalise_query(query)
+    tracks = cache.get(query)
+    if tracks is None:
+        searches.append(query)
+        tracks = SEARCH[query]
+        cache.put(query, tracks)
+    return tracks
+
+
+def test_longer_query_finds_tracks_its_prefix_did_not():
+    cache = InlineSearchCache()
+    searches = []
+    assert cached_search(cache, 'beat', searches) == SEARCH['beat']
+    assert cached_search(cache, 'Beat  it', searches)[0]['title'] == 'Beat It'
+    assert searches == ['beat', 'beat it']
+
+
+def test_repeated_query_is_served_from_the_cache():
+    cache = InlineSearchCache()
+    searches = []
+    cached_search(cache, 'beat it', searches)
+    cached_search(cache, 'BEAT IT', searches)
+    assert searches == ['beat it']
+    assert cache.stats()['hits'] == 1
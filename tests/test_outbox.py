@@ -0,0 +1,233 @@
+"""Outbox pacing, flood limit handling and the developer digest, on a fake clock.
+
+The outboxes here have no sender threads: the test queues its messages, stops the
+outbox and runs the sender loop itself. Waits move the fake clock on instead of
+sleeping, so every send time is exact.
+"""
+import threading
+
+import pytest
+from telegram.error import RetryAfter
+
+import SongIDOutbox
+from SongIDOutbox import DevDigest, Outbox, OutboxFull
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class ClockCondition(threading.Condition):
+    """Condition whose timed waits move the fake clock on instead of blocking"""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def wait(self, timeout=None):
+        assert timeout is not None, 'the sender would wait forever'
+        # Plus a microsecond of wake-up latency: waits computed from a float clock can come
+        # out a rounding error short, and a wait that doesn't move the clock never ends
+        self.clock.now += timeout + 1e-6
+        return False
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(SongIDOutbox, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def outbox(clock):
+    def make(**kwargs):
+        kwargs.setdefault('globalRate', 1000)
+        outbox = Outbox(senders=0, **kwargs)
+        outbox._cond = ClockCondition(clock)
+        return outbox
+    return make
+
+
+def drain(outbox):
+    """Send everything queued on this thread"""
+    outbox.stop()
+    outbox._work()
+
+
+class Recorder:
+    """Stands in for a Bot method, remembering when each message went out"""
+
+    def __init__(self, clock, failures=()):
+        self.clock = clock
+        self.failures = list(failures)  # Exceptions to raise on the first calls
+        self.sent = []  # (time, chat, text)
+        self.calls = 0
+
+    def __call__(self, chat, text):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((self.clock.now, chat, text))
+        return text
+
+
+def times(sent, chat):
+    return [at for at, to, text in sent if to == chat]
+
+
+def test_chat_messages_go_out_in_order_and_spaced(clock, outbox):
+    out = outbox(chatInterval=1.0)
+    send = Recorder(clock)
+    start = clock.now
+    for text in 'abc':
+        out.send(1, send, 1, text)
+    for text in 'xy':
+        out.send(2, send, 2, text)
+    drain(out)
+
+    assert [text for at, chat, text in send.sent if chat == 1] == ['a', 'b', 'c']
+    assert [text for at, chat, text in send.sent if chat == 2] == ['x', 'y']
+    assert times(send.sent, 1) == pytest.approx([start, start + 1, start + 2], abs=0.01)
+    # Another chat isn't held up by the first one's spacing
+    assert times(send.sent, 2) == pytest.approx([start, start + 1], abs=0.01)
+    assert out.stats()['sent'] == 5
+
+
+def test_groups_use_the_group_interval(clock, outbox):
+    out = outbox(chatInterval=1.0, groupInterval=3.0)
+    send = Recorder(clock)
+    start = clock.now
+    for text in 'ab':
+        out.send(-100, send, -100, text)
+    drain(out)
+
+    assert times(send.sent, -100) == pytest.approx([start, start + 3], abs=0.01)
+
+
+def test_global_rate_spaces_messages_across_chats(clock, outbox):
+    out = outbox(globalRate=10, chatInterval=1.0)
+    send = Recorder(clock)
+    start = clock.now
+    for chat in range(30):
+        out.send(chat, send, chat, 'hi')
+    drain(out)
+
+    sent = [at for at, chat, text in send.sent]
+    assert len(sent) == 30
+    assert [chat for at, chat, text in send.sent] == list(range(30))  # Chats are served in the order they queued
+    assert all(later - earlier >= 0.1 - 1e-6 for earlier, later in zip(sent, sent[1:]))
+    assert sent[-1] - start == pytest.approx(2.9, abs=0.01)
+
+
+def test_retry_after_pauses_every_chat_then_resends(clock, outbox):
+    out = outbox(chatInterval=1.0)
+    send = Recorder(clock, failures=[RetryAfter(5)])
+    start = clock.now
+    first = out.send(1, send, 1, 'first')
+    second = out.send(2, send, 2, 'second')
+    drain(out)
+
+    assert first.result(0) == 'first'
+    assert second.result(0) == 'second'
+    # Chat 2 was waiting behind the flood limit too, and chat 1's message went again once it was over
+    assert times(send.sent, 1) == pytest.approx([start + 5], abs=0.01)
+    assert times(send.sent, 2) == pytest.approx([start + 5], abs=0.01)
+    stats = out.stats()
+    assert (stats['retried'], stats['sent'], stats['failed']) == (1, 2, 0)
+
+
+def test_retry_after_gives_up_after_max_retries(clock, outbox):
+    out = outbox(maxRetries=2)
+    send = Recorder(clock, failures=[RetryAfter(1)] * 3)
+    start = clock.now
+    future = out.send(1, send, 1, 'doomed')
+    after = out.send(1, send, 1, 'after')
+    drain(out)
+
+    with pytest.raises(RetryAfter):
+        future.result(0)
+    # The first try and 2 retries, each after a 1s pause; then the chat moves on to its next message
+    assert send.calls == 3 + 1
+    assert after.result(0) == 'after'
+    stats = out.stats()
+    assert (stats['retried'], stats['failed'], stats['sent']) == (2, 1, 1)
+    assert times(send.sent, 1) == pytest.approx([start + 3], abs=0.01)
+
+
+def test_other_errors_only_fail_their_message(clock, outbox):
+    out = outbox()
+    send = Recorder(clock, failures=[ValueError('blocked by user')])
+    failed = out.send(1, send, 1, 'a')
+    sent = out.send(1, send, 1, 'b')
+    drain(out)
+
+    with pytest.raises(ValueError):
+        failed.result(0)
+    assert sent.result(0) == 'b'
+    assert out.stats()['retried'] == 0
+
+
+def test_full_outbox_turns_messages_away(clock, outbox):
+    out = outbox(maxQueued=2)
+    send = Recorder(clock)
+    futures = [out.send(1, send, 1, text) for text in 'abc']
+    drain(out)
+
+    assert isinstance(futures[2].exception(0), OutboxFull)
+    assert [text for at, chat, text in send.sent] == ['a', 'b']
+    assert out.stats()['rejected'] == 1
+
+
+@pytest.fixture
+def digest(clock):
+    sent = []
+    digest = DevDigest(sent.append, interval=3600)
+    yield digest, sent
+    digest._stopped.set()
+
+
+def test_digest_text(clock, digest):
+    digest, sent = digest
+    for user in (1, 1, 2):
+        digest.record('match', user)
+    digest.record('miss', 2)
+    digest.record('limit')
+    digest.record('restarted')
+    digest.command('/start', 3)
+    digest.command('/start@SongIDBot extra words', 3)
+    digest.command('hello there')
+    clock.now += 5 * 60
+    digest.flush()
+
+    assert sent == [
+        '3 matches, 1 misses, 1 limit hits, 1 restarted in the last 5 min (3 users)\n'
+        'Messages: /start 2, text 1'
+    ]
+    assert digest.digests == 1
+
+
+def test_digest_starts_over_and_skips_quiet_periods(clock, digest):
+    digest, sent = digest
+    digest.command('/help', 1)
+    clock.now += 30
+    digest.flush()
+    digest.flush()  # Nothing since the last one
+
+    assert sent == ['No files in the last 1 min (1 users)\nMessages: /help 1']
+    assert digest.summary() is None
+
+
+def test_digest_send_failures_are_not_raised(clock):
+    def fail(text):
+        raise ConnectionError('Telegram is down')
+
+    digest = DevDigest(fail, interval=3600)
+    digest.record('match')
+    digest.stop()  # Flushes, and logs the failure instead of raising it
+
+    assert digest.digests == 1
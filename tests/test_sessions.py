@@ -0,0 +1,93 @@
+"""Session expiry, bounds and gauges over the in-memory store."""
+import asyncio
+
+import pytest
+
+from sessions import SessionState
+from state_store import MemoryStateStore, SQLiteStateStore
+
+
+class CountingStore(MemoryStateStore):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def get(self, namespace, key, default=None):
+        self.calls.append('get')
+        return super().get(namespace, key, default)
+
+    def items(self, namespace):
+        self.calls.append('items')
+        return super().items(namespace)
+
+
+def files_session(store, removed, **kwargs):
+    return SessionState(store, 'files', files=lambda value: [value['path']], size=lambda value: value['size'],
+                        remove=lambda path: removed.append(path) or True, **kwargs)
+
+
+def test_replaced_and_expired_files_are_removed():
+    removed = []
+    sessions = files_session(MemoryStateStore(), removed)
+    sessions[1] = {'path': 'a', 'size': 10}
+    sessions[1] = {'path': 'b', 'size': 20}
+    assert removed == ['a']
+    sessions.ttl = -1  # Written already expired
+    sessions[2] = {'path': 'c', 'size': 30}
+    assert sessions.sweep() == 1
+    assert removed == ['a', 'c']
+    assert sessions.disk_bytes() == 20
+    assert sessions.stats()['expired'] == 1
+
+
+def test_setting_a_language_reads_nothing():
+    store = CountingStore()
+    languages = SessionState(store, 'languages', max_entries=10)
+    store.calls.clear()
+    languages[1] = 'ru'
+    assert store.calls == []
+
+
+def test_gauges_do_not_read_the_namespace():
+    store = CountingStore()
+    removed = []
+    sessions = files_session(store, removed)
+    sessions[1] = {'path': 'a', 'size': 10}
+    sessions[2] = {'path': 'b', 'size': 5}
+    sessions.discard(1)
+    store.calls.clear()
+    assert sessions.live() == 1
+    assert sessions.disk_bytes() == 5
+    assert store.calls == []
+
+
+def test_sizes_of_existing_entries_are_counted(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / 'state.sqlite'))
+    store.set('files', '1', {'path': 'a', 'size': 7})
+    assert files_session(store, []).disk_bytes() == 7
+    store.close()
+
+
+def test_bound_without_a_sweeper_is_kept_on_set():
+    languages = SessionState(MemoryStateStore(), 'languages', max_entries=2)
+    for user in range(3):
+        languages[user] = 'en'
+    assert sorted(languages) == ['1', '2']
+    assert languages.evicted == 1
+
+
+def test_bound_with_a_sweeper_is_kept_by_the_sweeper():
+    async def run():
+        languages = SessionState(MemoryStateStore(), 'languages', max_entries=2)
+        languages.start_sweeper(interval=3600)
+        for user in range(3):
+            languages[user] = 'en'
+        assert len(languages) == 3  # Not trimmed on the loop
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if languages.evicted:
+                break
+        languages._sweeper.cancel()
+        return sorted(languages)
+
+    assert asyncio.run(run()) == ['1', '2']
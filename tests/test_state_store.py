@@ -0,0 +1,83 @@
+"""The per-process copy of the SQLite state store, with a second store on the same file standing in for another worker."""
+import pytest
+
+from state_store import CachedStateStore, SQLiteStateStore, StateStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'state.sqlite')
+
+
+@pytest.fixture
+def cached(path):
+    store = CachedStateStore(SQLiteStateStore(path))
+    yield store
+    store.close()
+
+
+def test_state_store_is_abstract():
+    with pytest.raises(TypeError):
+        StateStore()
+
+
+def test_writes_reach_the_file(cached, path):
+    cached.set('languages', '1', 'ru')
+    cached.set('languages', '2', 'en')
+    cached.delete('languages', '2')
+    cached.flush()
+    other = SQLiteStateStore(path)
+    assert other.items('languages') == [('1', 'ru')]
+    other.close()
+
+
+def test_values_are_copied_when_set(cached):
+    value = {'file_path': 'a'}
+    cached.set('files', '1', value)
+    value['file_path'] = 'b'
+    assert cached.get('files', '1') == {'file_path': 'a'}
+    cached.flush()
+    assert cached.backing.get('files', '1') == {'file_path': 'a'}
+
+
+def test_reads_come_from_the_copy(cached, path):
+    cached.set('languages', '1', 'ru')
+    cached.flush()
+    other = SQLiteStateStore(path)
+    other.set('languages', '1', 'en')
+    assert cached.get('languages', '1') == 'ru'
+    other.close()
+
+
+def test_purge_brings_in_other_workers_changes(cached, path):
+    cached.set('languages', '1', 'ru')
+    cached.set('languages', '2', 'de')
+    cached.flush()
+    other = SQLiteStateStore(path)
+    other.set('languages', '1', 'en')
+    other.set('languages', '3', 'es')
+    other.delete('languages', '2')
+    other.close()
+    cached.purge('languages')
+    assert sorted(cached.items('languages')) == [('1', 'en'), ('3', 'es')]
+
+
+def test_purge_expires_and_evicts_in_the_file(cached):
+    cached.set('files', '1', 'a', ttl=-1)
+    cached.set('files', '2', 'b')
+    cached.set('files', '3', 'c')
+    expired, evicted = cached.purge('files', max_entries=1)
+    assert expired == [('1', 'a')]
+    assert evicted == [('2', 'b')]
+    assert cached.items('files') == [('3', 'c')]
+    assert cached.backing.items('files') == [('3', 'c')]
+
+
+def test_loads_existing_entries(path):
+    store = SQLiteStateStore(path)
+    store.set('languages', '1', 'ru')
+    store.close()
+    cached = CachedStateStore(SQLiteStateStore(path))
+    assert cached.map('languages')['1'] == 'ru'
+    assert 2 not in cached.map('languages')
+    cached.close()
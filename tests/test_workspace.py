@@ -0,0 +1,20 @@
+"""Kept workspaces and the orphan janitor."""
+import os
+import time
+
+from SongIDWorkspace import Workspaces
+
+
+def test_touched_workspace_outlives_the_orphan_age(tmp_path):
+    workspaces = Workspaces(root=str(tmp_path), orphanAge=60)
+    with workspaces.open('album') as workspace:
+        stale = workspace.keep()
+    with workspaces.open('album') as workspace:
+        touched = workspace.keep()
+    old = time.time() - 120
+    for path in (stale, touched):
+        os.utime(path, (old, old))
+    workspaces.touch([touched])
+    assert workspaces.clean() == 1
+    assert not os.path.exists(stale)
+    assert os.path.exists(touched)
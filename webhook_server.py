@@ -0,0 +1,104 @@
+import asyncio
+import hmac
+import json
+import logging
+import time
+from typing import Optional, Set
+
+from aiohttp import web
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Receives updates from Telegram over HTTP and hands them to an AsyncTeleBot.
+
+    Every request is answered as soon as its update has been parsed and scheduled,
+    so a slow handler never holds up delivery of the next update. At most
+    max_in_flight updates are handled at once; past that, requests wait before
+    being answered, which makes Telegram slow down instead of piling up tasks.
+    """
+
+    def __init__(self, bot, path: str = '/webhook', secret_token: Optional[str] = None, max_in_flight: int = 256):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[web.AppRunner] = None
+        self.max_in_flight = max_in_flight
+        self.received = 0
+        self.rejected = 0
+        self.malformed = 0
+        self.handled = 0
+        self.failed = 0
+        self.peak_in_flight = 0
+        self._handle_seconds = 0.0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._receive)
+        return app
+
+    async def _receive(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None:
+            given = request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(given.encode(), self.secret_token.encode()):
+                self.rejected += 1
+                return web.Response(status=401)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError, json.JSONDecodeError):
+            self.malformed += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        await self._slots.acquire()
+        task = asyncio.create_task(self._handle(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.peak_in_flight = max(self.peak_in_flight, len(self._tasks))
+        return web.Response()
+
+    async def _handle(self, update):
+        start = time.monotonic()
+        try:
+            await self.bot.process_new_updates([update])
+            self.handled += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Webhook update {update.update_id} failed: {e}")
+        finally:
+            self._handle_seconds += time.monotonic() - start
+            self._slots.release()
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Webhook listening on {host}:{port}{self.path}")
+
+    async def stop(self, timeout: float = 10):
+        """Stop accepting updates and give the ones in flight a moment to finish"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def stats(self) -> dict:
+        finished = self.handled + self.failed
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'malformed': self.malformed,
+            'handled': self.handled,
+            'failed': self.failed,
+            'in_flight': len(self._tasks),
+            'peak_in_flight': self.peak_in_flight,
+            'max_in_flight': self.max_in_flight,
+            'avg_handle_ms': round(self._handle_seconds / finished * 1000, 1) if finished else 0.0,
+        }